@@ -0,0 +1,374 @@
+# ann_index.py
+# Approximate nearest-neighbour (IVF) index over text passages: the description
+# columns of funds/sectors/factors plus, optionally, chunked fund factsheets and
+# commentary from fund_documents.csv. build_context queries it for top-k passages.
+#
+# IVF = inverted file: vectors are clustered with k-means into nlist lists; a query
+# only scans the nprobe lists whose centroids are closest. nprobe is the
+# recall/latency knob (nprobe == nlist is an exact search).
+# The index is persisted to .cache/passage_index.npz keyed by passage text hash,
+# so when the CSVs grow only the new passages are embedded and inserted.
+# Descriptions short enough to be a single passage are the semantic index's
+# documents verbatim, so their vectors are copied from its matrix rather than
+# embedded a second time; only long descriptions and fund_documents chunks are.
+import hashlib
+import math
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+import data_loader
+from semantic_index import build_docs, semantic_index_for
+
+Passage = namedtuple("Passage", ["entity_type", "entity_id", "name", "source", "text"])
+PassageHit = namedtuple("PassageHit", ["score", "entity_type", "entity_id", "name", "source", "text"])
+
+# Chunking of long documents (in words); consecutive chunks overlap
+CHUNK_WORDS = 120
+CHUNK_OVERLAP = 30
+
+# Lists scanned per query (ANN_NPROBE overrides); higher = better recall, slower
+DEFAULT_NPROBE = 8
+# Below this many vectors a single list is used (exact search is already fast)
+MIN_TRAIN_SIZE = 2048
+# Retrain the clustering once the index has grown this much since the last training
+RETRAIN_GROWTH = 4.0
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+# Rows per block when assigning vectors to centroids (bounds temporary memory)
+ASSIGN_BLOCK = 8192
+
+# Tables the passages are built from
+PASSAGE_TABLES = ["funds", "sectors", "factors", "fund_documents"]
+
+
+def chunk_text(text, chunk_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    """Splits text into chunks of chunk_words words, each overlapping the previous one."""
+    words = (text or "").split()
+    if len(words) <= chunk_words:
+        return [" ".join(words)] if words else []
+    step = max(1, chunk_words - overlap)
+    return [" ".join(words[i:i + chunk_words]) for i in range(0, len(words) - overlap, step)]
+
+
+def default_nlist(n):
+    """Rule-of-thumb list count: ~4 * sqrt(n), one list for small corpora."""
+    if n < MIN_TRAIN_SIZE:
+        return 1
+    return int(min(65536, max(1, 4 * math.sqrt(n))))
+
+
+def _kmeans(vectors, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """Spherical k-means on a sample of unit vectors; returns (k x dim) unit centroids."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), k * KMEANS_SAMPLE_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        # Re-seed empty lists from random sample points
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index over unit vectors (inner product == cosine).
+    Rows are identified by their insertion position; the list layout (CSR over
+    row numbers) is rebuilt lazily after inserts/removals.
+    """
+
+    def __init__(self, dim, nlist=None, nprobe=DEFAULT_NPROBE):
+        self.dim = dim
+        self.nlist_setting = nlist   # None = derive from the size at training time
+        self.nprobe = nprobe
+        self.centroids = np.zeros((1, dim), dtype=np.float32)
+        self.trained_size = 0
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self._list_rows = None      # row numbers grouped by list
+        self._list_offsets = None   # list l holds _list_rows[offsets[l]:offsets[l + 1]]
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _assign(self, vectors):
+        if self.nlist == 1:
+            return np.zeros(len(vectors), dtype=np.int32)
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), ASSIGN_BLOCK):
+            block = vectors[start:start + ASSIGN_BLOCK]
+            out[start:start + ASSIGN_BLOCK] = np.argmax(block @ self.centroids.T, axis=1)
+        return out
+
+    def train(self):
+        """(Re)clusters all stored vectors and reassigns them to lists."""
+        nlist = self.nlist_setting or default_nlist(len(self.vectors))
+        nlist = max(1, min(nlist, len(self.vectors)))
+        if nlist == 1:
+            self.centroids = np.zeros((1, self.dim), dtype=np.float32)
+        else:
+            self.centroids = _kmeans(self.vectors, nlist)
+        self.assignments = self._assign(self.vectors)
+        self.trained_size = len(self.vectors)
+        self._list_rows = None
+
+    def needs_training(self):
+        """True when the index outgrew its clustering (or never had one worth having)."""
+        n = len(self.vectors)
+        if self.trained_size == 0:
+            return n >= MIN_TRAIN_SIZE or bool(self.nlist_setting and self.nlist_setting > 1)
+        return n > self.trained_size * RETRAIN_GROWTH
+
+    def add(self, vectors):
+        """Appends vectors (incremental insert: assigned to the existing lists)."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if not len(vectors):
+            return
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.assignments = np.concatenate([self.assignments, self._assign(vectors)])
+        self._list_rows = None
+        if self.needs_training():
+            self.train()
+
+    def keep(self, mask):
+        """Drops the rows where mask is False (row numbers of later rows shift down)."""
+        self.vectors = np.ascontiguousarray(self.vectors[mask])
+        self.assignments = self.assignments[mask]
+        self._list_rows = None
+
+    def _lists(self):
+        if self._list_rows is None:
+            self._list_rows = np.argsort(self.assignments, kind="stable").astype(np.int64)
+            counts = np.bincount(self.assignments, minlength=self.nlist)
+            self._list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return self._list_rows, self._list_offsets
+
+    def search(self, queries, top_k=10, nprobe=None):
+        """
+        Returns (scores, rows), each (len(queries) x top_k); rows are -1 where fewer
+        than top_k candidates were found in the probed lists.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        scores_out = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+        rows_out = np.full((len(queries), top_k), -1, dtype=np.int64)
+        if not len(self.vectors):
+            return scores_out, rows_out
+        list_rows, offsets = self._lists()
+        if nprobe >= self.nlist:
+            probes = np.broadcast_to(np.arange(self.nlist), (len(queries), self.nlist))
+        else:
+            probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        for qi, query in enumerate(queries):
+            candidates = np.concatenate([list_rows[offsets[l]:offsets[l + 1]] for l in probes[qi]])
+            if not len(candidates):
+                continue
+            scores = self.vectors[candidates] @ query
+            k = min(top_k, len(candidates))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            scores_out[qi, :k] = scores[top]
+            rows_out[qi, :k] = candidates[top]
+        return scores_out, rows_out
+
+    def exact_search(self, queries, top_k=10):
+        """Brute-force baseline over every stored vector."""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        scores = queries @ self.vectors.T
+        k = min(top_k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+        rows = np.take_along_axis(top, order, axis=1)
+        return np.take_along_axis(scores, rows, axis=1), rows
+
+    def state(self):
+        """Arrays needed to restore the index (see from_state)."""
+        return {"centroids": self.centroids, "vectors": self.vectors, "assignments": self.assignments,
+                "trained_size": np.array(self.trained_size)}
+
+    @classmethod
+    def from_state(cls, state, nlist=None, nprobe=DEFAULT_NPROBE):
+        vectors = state["vectors"]
+        index = cls(vectors.shape[1], nlist, nprobe)
+        index.centroids = np.ascontiguousarray(state["centroids"], dtype=np.float32)
+        index.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        index.assignments = state["assignments"].astype(np.int32)
+        index.trained_size = int(state["trained_size"])
+        return index
+
+
+def _passage_key(passage):
+    return f"{passage.entity_type}\x1f{passage.entity_id}\x1f{passage.source}"
+
+
+def _text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class PassageIndex:
+    """Passages plus their IVF index; search() returns PassageHit lists."""
+
+    def __init__(self, passages, index, embedder):
+        self.passages = list(passages)
+        self.index = index
+        self.embedder = embedder
+
+    @classmethod
+    def build(cls, passages, embedder, persist_path=None, nlist=None, nprobe=DEFAULT_NPROBE, known_vectors=None):
+        """
+        Loads the persisted index (same embedder) if any, drops passages that were
+        removed or edited, embeds and inserts only the new ones, and saves it back.
+        known_vectors maps passage positions to vectors already computed by the same
+        embedder; those passages are inserted without being embedded.
+        """
+        known_vectors = known_vectors or {}
+        passages = list(passages)
+        keys = [_passage_key(p) for p in passages]
+        hashes = [_text_hash(p.text) for p in passages]
+        index, saved_ids = None, []
+        if persist_path and os.path.exists(persist_path):
+            try:
+                with np.load(persist_path, allow_pickle=False) as saved:
+                    if str(saved["model_id"]) == embedder.model_id:
+                        index = IVFIndex.from_state(saved, nlist, nprobe)
+                        saved_ids = list(zip(saved["keys"].tolist(), saved["hashes"].tolist()))
+            except Exception as e:
+                print(f"Warning: ignoring unreadable passage index ({e}).")
+                index, saved_ids = None, []
+
+        wanted = {(key, text_hash): i for i, (key, text_hash) in enumerate(zip(keys, hashes))}
+        changed = False
+        if index is not None:
+            mask = np.array([saved_id in wanted for saved_id in saved_ids], dtype=bool)
+            if not mask.all():
+                index.keep(mask)
+                changed = True
+            order = [wanted[saved_id] for saved_id in saved_ids if saved_id in wanted]
+        else:
+            order = []
+        present = set(order)
+        todo = [i for i in range(len(passages)) if i not in present]
+
+        start = time.perf_counter()
+        # Passages with a known vector go first, then the ones that had to be embedded
+        todo = [i for i in todo if i in known_vectors] + [i for i in todo if i not in known_vectors]
+        n_known = sum(1 for i in todo if i in known_vectors)
+        embedded = embedder.embed([passages[i].text for i in todo[n_known:]]) if len(todo) > n_known else None
+        new_vectors = None
+        if todo:
+            parts = [np.stack([known_vectors[i] for i in todo[:n_known]])] if n_known else []
+            new_vectors = np.concatenate(parts + ([embedded] if embedded is not None else [])).astype(np.float32, copy=False)
+        if index is None:
+            dim = new_vectors.shape[1] if new_vectors is not None else getattr(embedder, "dim", 1)
+            index = IVFIndex(dim, nlist, nprobe)
+        if todo:
+            index.add(new_vectors)
+            changed = True
+            print(f"Passage index: inserted {len(todo)} of {len(passages)} passages "
+                  f"({len(todo) - n_known} embedded, {n_known} from the semantic index) "
+                  f"in {time.perf_counter() - start:.2f}s ({index.nlist} lists).")
+        # Index rows are in saved order followed by the new passages
+        ordered = [passages[i] for i in order + todo]
+        ordered_keys = [keys[i] for i in order + todo]
+        ordered_hashes = [hashes[i] for i in order + todo]
+
+        if persist_path and changed:
+            try:
+                os.makedirs(os.path.dirname(persist_path), exist_ok=True)
+                tmp_path = persist_path + ".tmp.npz"
+                np.savez(tmp_path, model_id=np.array(embedder.model_id), keys=np.array(ordered_keys),
+                         hashes=np.array(ordered_hashes), **index.state())
+                os.replace(tmp_path, persist_path)
+            except Exception as e:
+                print(f"Warning: could not persist passage index: {e}")
+        return cls(ordered, index, embedder)
+
+    def search_batch(self, queries, top_k=5, nprobe=None):
+        """Returns one list of PassageHit (best first) per query."""
+        if not queries:
+            return []
+        scores, rows = self.index.search(self.embedder.embed(list(queries)), top_k, nprobe)
+        return [[PassageHit(float(score), *self.passages[row]) for score, row in zip(q_scores, q_rows) if row >= 0]
+                for q_scores, q_rows in zip(scores, rows)]
+
+    def search(self, query, top_k=5, nprobe=None):
+        """Returns the top_k passages closest to the query."""
+        return self.search_batch([query], top_k, nprobe)[0]
+
+
+def build_passages(tables):
+    """
+    One passage per entity description (chunked if long) plus chunked
+    fund_documents rows, which are attributed to the fund they mention.
+    A description that fits in one chunk keeps the semantic document's text as is.
+    """
+    passages = []
+    for doc in build_docs(tables):
+        chunks = chunk_text(doc.text)
+        if len(chunks) == 1:
+            chunks = [doc.text]
+        for n, chunk in enumerate(chunks):
+            passages.append(Passage(doc.entity_type, doc.entity_id, doc.name, f"description#{n}", chunk))
+
+    documents = tables.get("fund_documents")
+    if documents is not None and not documents.empty:
+        funds = tables.get("funds")
+        fund_lookup = {}
+        if funds is not None and not funds.empty:
+            for fund_id, key, name in zip(funds['fund_id'].tolist(), funds['internal_key'].tolist(), funds['name'].tolist()):
+                fund_lookup.setdefault(fund_id, (key, name))
+        for row, (fund_id, title, text) in enumerate(zip(documents['fund_id'].tolist(), documents['title'].tolist(),
+                                                           documents['text'].tolist())):
+            if not isinstance(text, str):
+                continue
+            key, name = fund_lookup.get(fund_id, (fund_id, fund_id))
+            label = title if isinstance(title, str) and title else f"document {row}"
+            for n, chunk in enumerate(chunk_text(text)):
+                passages.append(Passage("fund", key, f"{name} - {label}", f"doc{row}#{n}", chunk))
+    return passages
+
+
+def semantic_vectors(passages, semantic):
+    """
+    {passage position: vector} for the description passages that are a semantic
+    index document verbatim (rows of semantic.vectors; no copy is made).
+    """
+    rows = {(doc.entity_type, doc.entity_id): row for row, doc in enumerate(semantic.docs)}
+    known = {}
+    for i, passage in enumerate(passages):
+        if passage.source != "description#0":
+            continue
+        row = rows.get((passage.entity_type, passage.entity_id))
+        if row is not None and semantic.docs[row].text == passage.text:
+            known[i] = semantic.vectors[row]
+    return known
+
+
+def get_passage_index():
+    """Returns the passage ANN index for the current knowledge base, building/updating it on first use."""
+    def _build(store):
+        tables = store.get_tables(PASSAGE_TABLES)
+        if tables is None:
+            raise RuntimeError("Passage index tables could not be loaded")
+        persist_path = os.path.join(data_loader.cache_dir_for(store.data_dir), "passage_index.npz") if store.use_snapshot else None
+        nlist = int(os.getenv("ANN_NLIST", "0")) or None
+        nprobe = int(os.getenv("ANN_NPROBE", DEFAULT_NPROBE))
+        # Same store version, so the same description documents and the same embedder
+        semantic = semantic_index_for(store)
+        passages = build_passages(tables)
+        return PassageIndex.build(passages, semantic.embedder, persist_path, nlist, nprobe,
+                                  known_vectors=semantic_vectors(passages, semantic))
+    return data_loader.get_store().derived("passage_index", _build, depends_on=PASSAGE_TABLES)
@@ -0,0 +1,291 @@
+# answer_cache.py
+# Two-tier cache for LLM answers: an in-memory LRU in front of an on-disk
+# SQLite table. Keys hash the model name, generation config, normalized
+# query and exact context string, so only truly identical requests hit.
+# Answers generated speculatively (see prefetch.py) are flagged until their first
+# hit, so the stats show how many prefetched answers were actually asked for.
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from data_loader import store_fingerprint
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Defaults can be overridden from the environment (.env is loaded by llm_handler)
+DEFAULT_DB_PATH = os.path.join(_SCRIPT_DIR, ".cache", "answers.sqlite3")
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MEMORY_ENTRIES = 256
+DEFAULT_DISK_ENTRIES = 5000
+# Data versions whose disk entries are kept; processes sharing the SQLite file may be
+# serving different versions (one has reloaded, another not yet)
+DEFAULT_KEPT_VERSIONS = 3
+
+
+def normalize_query(query):
+    """Lowercases, collapses whitespace and drops trailing punctuation."""
+    query = re.sub(r"\s+", " ", (query or "").strip().lower())
+    return query.rstrip(" ?!.")
+
+
+def make_cache_key(model_name, generation_config, query, context):
+    """Returns a stable SHA-256 key for one LLM request."""
+    payload = json.dumps({
+        "model": model_name,
+        "config": generation_config,
+        "query": normalize_query(query),
+        "context": context,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    In-memory LRU + SQLite answer cache with TTL and size-based eviction.
+    Every entry is tagged with the fingerprint of the knowledge-base version it was
+    answered from and only served while that version is loaded. Once a changed version
+    is loaded the memory tier is cleared; on disk, the entries of the kept_versions most
+    recently used versions stay (other processes may still serve them) and older
+    versions and expired entries are pruned.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_memory_entries=DEFAULT_MEMORY_ENTRIES, max_disk_entries=DEFAULT_DISK_ENTRIES,
+                 fingerprint_fn=store_fingerprint, kept_versions=DEFAULT_KEPT_VERSIONS):
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.kept_versions = max(1, kept_versions)
+        self._fingerprint_fn = fingerprint_fn
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (answer, created_at, prefetched)
+        self._data_version = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0,
+                      "evictions": 0, "expired": 0, "invalidations": 0,
+                      "prefetch_stores": 0, "prefetch_hits": 0}
+
+        self._db = None
+        if db_path:
+            try:
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS answers ("
+                    " key TEXT NOT NULL, answer TEXT NOT NULL, data_version TEXT NOT NULL,"
+                    " created_at REAL NOT NULL, last_access REAL NOT NULL, prefetched INTEGER NOT NULL DEFAULT 0,"
+                    " PRIMARY KEY (key, data_version))"
+                )
+                columns = {row[1]: row[5] for row in self._db.execute("PRAGMA table_info(answers)")}
+                # Caches created before prefetching have no prefetched column yet
+                if "prefetched" not in columns:
+                    self._db.execute("ALTER TABLE answers ADD COLUMN prefetched INTEGER NOT NULL DEFAULT 0")
+                # Caches created before versions were kept side by side are keyed on key alone
+                if not columns["data_version"]:
+                    self._migrate_primary_key()
+                self._db.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_access ON answers(last_access)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Warning: answer cache disk tier disabled ({e}).")
+                self._db = None
+
+    def _migrate_primary_key(self):
+        """Copies an answers table keyed on key alone into one keyed on (key, data_version)."""
+        self._db.execute("ALTER TABLE answers RENAME TO answers_old")
+        self._db.execute("DROP INDEX IF EXISTS idx_answers_last_access")
+        self._db.execute(
+            "CREATE TABLE answers ("
+            " key TEXT NOT NULL, answer TEXT NOT NULL, data_version TEXT NOT NULL,"
+            " created_at REAL NOT NULL, last_access REAL NOT NULL, prefetched INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (key, data_version))"
+        )
+        self._db.execute("INSERT INTO answers (key, answer, data_version, created_at, last_access, prefetched)"
+                         " SELECT key, answer, data_version, created_at, last_access, prefetched FROM answers_old")
+        self._db.execute("DROP TABLE answers_old")
+
+    # --- Internal helpers (call with self._lock held) ---
+    def _check_data_version(self):
+        """
+        Returns the fingerprint of the loaded CSV data (cheap: no stat calls). When it
+        changes, the memory tier is cleared and old versions are pruned from disk.
+        """
+        version = self._fingerprint_fn()
+        if version == self._data_version:
+            return version
+        if self._data_version is not None:
+            self.stats["invalidations"] += 1
+        self._memory.clear()
+        if self._db is not None:
+            self._prune_versions(version)
+        self._data_version = version
+        return version
+
+    def _prune_versions(self, version):
+        """
+        Deletes disk entries of every version but this one and the kept_versions - 1
+        other most recently used ones, plus entries past their TTL. Rows of other
+        processes' current versions stay: they keep touching them.
+        """
+        self._db.execute(
+            "DELETE FROM answers WHERE data_version != ? AND data_version NOT IN ("
+            " SELECT data_version FROM answers WHERE data_version != ?"
+            " GROUP BY data_version ORDER BY MAX(last_access) DESC LIMIT ?)",
+            (version, version, self.kept_versions - 1))
+        if self.ttl_seconds is not None:
+            self._db.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        self._db.commit()
+
+    def _remember(self, key, answer, created_at, prefetched=False):
+        self._memory[key] = (answer, created_at, prefetched)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _expired(self, created_at, now):
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def _prefetch_hit(self, key, version):
+        """Counts the first hit on a prefetched entry and clears its flag in both tiers."""
+        answer, created_at, _ = self._memory[key]
+        self._memory[key] = (answer, created_at, False)
+        if self._db is not None:
+            self._db.execute("UPDATE answers SET prefetched = 0 WHERE key = ? AND data_version = ?", (key, version))
+            self._db.commit()
+        self.stats["prefetch_hits"] += 1
+        metrics.inc("prefetch", result="hit")
+
+    # --- Public API ---
+    def get(self, key):
+        """Returns the cached answer for key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            version = self._check_data_version()
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1], now):
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    if entry[2]:
+                        self._prefetch_hit(key, version)
+                    return entry[0]
+                del self._memory[key]
+                self.stats["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute("SELECT answer, created_at, prefetched FROM answers"
+                                       " WHERE key = ? AND data_version = ?", (key, version)).fetchone()
+                if row is not None:
+                    answer, created_at, prefetched = row
+                    if not self._expired(created_at, now):
+                        self._db.execute("UPDATE answers SET last_access = ? WHERE key = ? AND data_version = ?",
+                                         (now, key, version))
+                        self._db.commit()
+                        self._remember(key, answer, created_at, bool(prefetched))
+                        self.stats["disk_hits"] += 1
+                        if prefetched:
+                            self._prefetch_hit(key, version)
+                        return answer
+                    self._db.execute("DELETE FROM answers WHERE key = ? AND data_version = ?", (key, version))
+                    self._db.commit()
+                    self.stats["expired"] += 1
+
+            self.stats["misses"] += 1
+            return None
+
+    def contains(self, key):
+        """True if an unexpired answer is cached for key; unlike get() it touches no stats or LRU order."""
+        now = time.time()
+        with self._lock:
+            version = self._check_data_version()
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[1], now):
+                return True
+            if self._db is not None:
+                row = self._db.execute("SELECT created_at FROM answers WHERE key = ? AND data_version = ?",
+                                       (key, version)).fetchone()
+                return row is not None and not self._expired(row[0], now)
+            return False
+
+    def put(self, key, answer, prefetched=False):
+        """
+        Stores an answer in both tiers, evicting least recently used entries.
+        prefetched marks an answer nobody has asked for yet (counted on its first hit).
+        """
+        now = time.time()
+        with self._lock:
+            version = self._check_data_version()
+            self._remember(key, answer, now, prefetched)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO answers (key, answer, data_version, created_at, last_access, prefetched)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", (key, answer, version, now, now, int(prefetched)))
+                # Size-based eviction on the disk tier (least recently used first)
+                count = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+                if count > self.max_disk_entries:
+                    self._db.execute(
+                        "DELETE FROM answers WHERE rowid IN ("
+                        " SELECT rowid FROM answers ORDER BY last_access ASC LIMIT ?)",
+                        (count - self.max_disk_entries,))
+                    self.stats["evictions"] += count - self.max_disk_entries
+                self._db.commit()
+            self.stats["stores"] += 1
+            if prefetched:
+                self.stats["prefetch_stores"] += 1
+
+    def clear(self):
+        """Removes every cached answer from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
+
+    def get_stats(self):
+        """Returns a copy of the hit/miss counters plus the current hit rate."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        # Prefetched answers later asked for, per prefetched answer stored (processes sharing
+        # the disk tier also hit each other's, so compare the totals across workers)
+        stats["prefetch_hit_rate"] = (stats["prefetch_hits"] / stats["prefetch_stores"]
+                                      if stats["prefetch_stores"] else 0.0)
+        return stats
+
+
+def _build_default_cache():
+    """Creates the process-wide cache from environment settings (None if disabled)."""
+    if os.getenv("ANSWER_CACHE_DISABLED", "").lower() in ("1", "true", "yes"):
+        return None
+    try:
+        return AnswerCache(
+            db_path=os.getenv("ANSWER_CACHE_PATH", DEFAULT_DB_PATH) or None,
+            ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL", DEFAULT_TTL_SECONDS)),
+            max_memory_entries=int(os.getenv("ANSWER_CACHE_MEMORY_ENTRIES", DEFAULT_MEMORY_ENTRIES)),
+            max_disk_entries=int(os.getenv("ANSWER_CACHE_DISK_ENTRIES", DEFAULT_DISK_ENTRIES)),
+            kept_versions=int(os.getenv("ANSWER_CACHE_KEPT_VERSIONS", DEFAULT_KEPT_VERSIONS)),
+        )
+    except Exception as e:
+        print(f"Error creating answer cache, continuing without it: {e}")
+        return None
+
+
+# One cache per process, created on first use
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_answer_cache():
+    """Returns the process-wide AnswerCache (or None when caching is disabled)."""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = _build_default_cache() or False
+    return _default_cache or None
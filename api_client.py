@@ -0,0 +1,50 @@
+# api_client.py
+# Thin client for api_server.py. When MF_RAG_API_URL is set, app.py sends
+# queries to the API instead of running the pipeline in the Streamlit process.
+# One requests.Session per client keeps the HTTP connection alive between calls.
+import os
+
+import requests
+
+DEFAULT_TIMEOUT_SECONDS = 120.0
+
+
+class APIClient:
+    """Calls /query, /entities and /funds/{id} on a running api_server."""
+
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT_SECONDS):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _get(self, path, **params):
+        response = self.session.get(self.base_url + path, params=params or None, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def query(self, query, profile=None):
+        """Runs the full pipeline remotely; returns the /query result dict (profile: 'cprofile' or 'sample')."""
+        payload = {"query": query, "profile": profile} if profile else {"query": query}
+        response = self.session.post(self.base_url + "/query", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def entities(self):
+        """Returns {"funds": [...], "amcs": [...], "sectors": [...], "factors": [...]}."""
+        return self._get("/entities")
+
+    def metrics(self):
+        """Stage latency quantiles and counters of the worker that answers."""
+        return self._get("/metrics", format="json")
+
+    def fund(self, fund_ref):
+        """Returns one fund by internal_key or fund_id (raises on 404)."""
+        return self._get(f"/funds/{fund_ref}")
+
+
+def get_api_client():
+    """Returns an APIClient for MF_RAG_API_URL, or None to run the pipeline in-process."""
+    base_url = os.getenv("MF_RAG_API_URL")
+    if not base_url:
+        return None
+    return APIClient(base_url, float(os.getenv("MF_RAG_API_TIMEOUT", DEFAULT_TIMEOUT_SECONDS)))
@@ -0,0 +1,364 @@
+# api_server.py
+# Lightweight HTTP/JSON API over the query pipeline, separate from the Streamlit UI,
+# so it can sit behind a load balancer and be called from other systems.
+#
+#   POST /query          {"query": "..."}  (or GET /query?q=...) -> intent, context, answer, timings
+#   GET  /entities       funds, AMCs, sectors and factors (id + name)
+#   GET  /funds/{id}     one fund by internal_key or fund_id
+#   GET  /health         worker pid, knowledge-base version, service (and prompt cache / prefetch) stats
+#   GET  /metrics        Prometheus text metrics of this worker (?format=json for p50/p95/p99)
+#   GET  /profiles       recent per-request profiling reports ({"profile": "cprofile"|"sample"} on /query)
+#
+# Stdlib only (asyncio streams, HTTP/1.1 with keep-alive). With --workers N the
+# parent binds the socket, loads the knowledge base and builds its indexes, then
+# pre-forks N worker processes that accept on the shared socket. Workers inherit
+# the loaded store copy-on-write instead of each loading and indexing it again.
+# With KB_SHARED_MEMORY=1 the parent publishes the tables and indexes once
+# (shared_kb) and workers attach to them zero-copy instead of each building its own.
+#
+# Usage:  python api_server.py --host 0.0.0.0 --port 8000 --workers 4
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import signal
+import socket
+import sys
+from urllib.parse import parse_qs, urlsplit
+
+import data_loader
+import graph_query
+import metrics
+from async_pipeline import QueryService, run_cpu
+from context_blocks import context_blocks_enabled, get_context_blocks
+from entity_matcher import get_entity_matcher
+from fuzzy_matcher import get_fuzzy_matcher
+from intent_classifier import get_intent_classifier, intent_classifier_enabled
+from kg_index import get_graph_index
+from prompt_cache import prompt_cache_enabled, prompt_cache_stats
+from prefetch import prefetch_enabled, prefetch_stats
+import shared_kb
+
+DEFAULT_PORT = 8000
+# Idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE_TIMEOUT = 15.0
+MAX_BODY_BYTES = 1 << 20
+# How often a pending /query checks whether its client disconnected
+DISCONNECT_POLL_SECONDS = 0.1
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class TextResponse(str):
+    """A plain-text response body (e.g. Prometheus metrics) instead of JSON."""
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _jsonable(value):
+    """Replaces NaN (missing CSV cells) with None and stringifies non-JSON values."""
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+# --- Route handlers (return a JSON-serializable object or raise HTTPError) ---
+
+def entities_payload():
+    index = get_graph_index()
+    return {
+        "funds": [{"id": f.get("internal_key"), "fund_id": f.get("fund_id"), "name": f.get("name")}
+                  for f in index.fund_records],
+        "amcs": [{"id": amc_id, "name": r.get("name")} for amc_id, r in index.amc_records.items()],
+        "sectors": [{"id": sector_id, "name": r.get("name")} for sector_id, r in index.sector_records.items()],
+        "factors": [{"id": factor_id, "name": r.get("name")} for factor_id, r in index.factor_records.items()],
+    }
+
+
+def fund_payload(fund_ref):
+    """Fund details by internal_key, falling back to fund_id."""
+    fund = graph_query.get_fund_details(fund_ref)
+    if not fund:
+        index = get_graph_index()
+        positions = index.positions_for_fund_id(fund_ref)
+        if len(positions):
+            fund = graph_query.get_fund_details(index.fund_record(positions[0]).get("internal_key"))
+    if not fund:
+        raise HTTPError(404, f"Fund '{fund_ref}' not found")
+    return fund
+
+
+class APIServer:
+    """Routes requests of one worker process; all connections share one QueryService."""
+
+    def __init__(self, max_concurrency=None):
+        self.service = QueryService(max_concurrency)
+
+    async def handle_query(self, method, params, body, reader):
+        if method == "POST":
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "Request body must be JSON")
+            query = payload.get("query") if isinstance(payload, dict) else None
+            profile = payload.get("profile") if isinstance(payload, dict) else None
+        else:
+            query = (params.get("q") or params.get("query") or [None])[0]
+            profile = (params.get("profile") or [None])[0]
+        if not query or not isinstance(query, str):
+            raise HTTPError(400, "Missing 'query'")
+        if profile not in (None, "cprofile", "sample"):
+            raise HTTPError(400, "profile must be 'cprofile' or 'sample'")
+
+        _, task = self.service.submit(query, profile=profile)
+        # Cancel the work (incl. the LLM call) if the client disconnects while waiting
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if not task.done() and reader.at_eof():
+                task.cancel()
+        return task.result()
+
+    async def dispatch(self, method, path, params, body, reader):
+        if path == "/query":
+            if method not in ("GET", "POST"):
+                raise HTTPError(405, "Use GET or POST")
+            return await self.handle_query(method, params, body, reader)
+        if method != "GET":
+            raise HTTPError(405, "Use GET")
+        if path == "/health":
+            store = data_loader.get_store()
+            health = {"status": "ok", "pid": os.getpid(), "kb_version": store.version,
+                      "service": self.service.get_stats()}
+            if prompt_cache_enabled():
+                health["prompt_cache"] = prompt_cache_stats()
+            if prefetch_enabled():
+                health["prefetch"] = prefetch_stats()
+            return health
+        if path == "/metrics":
+            if (params.get("format") or [""])[0] == "json":
+                return metrics.snapshot()
+            return TextResponse(metrics.prometheus_text())
+        if path == "/profiles":
+            return {"profiles": metrics.recent_profiles()}
+        # Both walk the tables, so they run in the CPU pool like /query's parse and retrieval
+        if path == "/entities":
+            return await run_cpu(entities_payload)
+        if path.startswith("/funds/") and len(path) > len("/funds/"):
+            return await run_cpu(fund_payload, path[len("/funds/"):])
+        raise HTTPError(404, f"No route for {path}")
+
+    async def handle_connection(self, reader, writer):
+        """Serves requests on one connection until the client closes it or it idles out."""
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                keep_alive = await self._handle_request(request_line, reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request_line, reader, writer):
+        """Reads one request, writes its response; returns whether to keep the connection open."""
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            await self._write(writer, 400, {"error": "Malformed request line"}, False)
+            return False
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+        status, payload = 200, None
+        try:
+            length = int(headers.get("content-length", "0") or 0)
+            if length > MAX_BODY_BYTES:
+                raise HTTPError(413, "Request body too large")
+            body = await reader.readexactly(length) if length else b""
+            url = urlsplit(target)
+            payload = await self.dispatch(method.upper(), url.path.rstrip("/") or "/", parse_qs(url.query), body, reader)
+        except HTTPError as e:
+            status, payload = e.status, {"error": e.message}
+        except asyncio.CancelledError:
+            # The client went away mid-request (or the worker is shutting down)
+            return False
+        except Exception as e:
+            print(f"Error handling {method} {target}: {e}")
+            status, payload = 500, {"error": f"Internal error: {e}"}
+        await self._write(writer, status, payload, keep_alive)
+        return keep_alive
+
+    async def _write(self, writer, status, payload, keep_alive):
+        if isinstance(payload, TextResponse):
+            body, content_type = payload.encode("utf-8"), payload.content_type
+        else:
+            body = json.dumps(_jsonable(payload), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        head = (f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'Error')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n")
+        if keep_alive:
+            head += f"Keep-Alive: timeout={int(KEEP_ALIVE_TIMEOUT)}\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+
+
+def _prepare_knowledge_base():
+    """
+    Loads every table once (writing the snapshot if stale), builds the graph index and
+    entity matchers, materializes the context blocks and trains the intent classifier
+    if needed (saving both next to it). Forked workers inherit all of it.
+    With KB_SHARED_MEMORY=1 the tables and indexes are published to shared memory
+    first and this process attaches to them.
+    """
+    if shared_kb.shared_kb_enabled():
+        shared_kb.attach_or_publish()
+    if data_loader.get_store().get_loaded_data() is None:
+        print("Warning: knowledge base failed to load; /query will report data errors.")
+        return
+    for build in (get_graph_index, get_entity_matcher, get_fuzzy_matcher):
+        try:
+            build()
+        except Exception as e:
+            print(f"Warning: could not build {build.__name__[4:]}: {e}")
+    if context_blocks_enabled():
+        try:
+            get_context_blocks()
+        except Exception as e:
+            print(f"Warning: could not materialize context blocks: {e}")
+    if intent_classifier_enabled():
+        try:
+            get_intent_classifier()
+        except Exception as e:
+            print(f"Warning: could not load the intent classifier: {e}")
+
+
+async def _serve_socket(sock, max_concurrency):
+    server = APIServer(max_concurrency)
+    # Stores attached to the shared knowledge base also poll its version counter
+    if os.getenv("KB_HOT_RELOAD", "0") == "1" or data_loader.get_store().shared is not None:
+        data_loader.start_watcher(float(os.getenv("KB_HOT_RELOAD_INTERVAL", "2.0")))
+    async with await asyncio.start_server(server.handle_connection, sock=sock):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C raises KeyboardInterrupt instead
+        await stop.wait()
+
+
+def _worker_store(parent_store):
+    """
+    The store a forked worker serves from: the parent's loaded and indexed store
+    (shared copy-on-write; a hot reload later swaps in a worker-local version), a
+    fresh attachment when the parent attached to the shared knowledge base, or None
+    (a fresh store) when the parent's load failed, so the worker retries it.
+    """
+    if parent_store.shared is not None:
+        return shared_kb.attach()
+    if parent_store.get_loaded_data() is None:
+        return None
+    return parent_store
+
+
+def _worker_main(sock, max_concurrency):
+    store = data_loader.get_store()
+    worker_store = _worker_store(store)
+    if worker_store is not store:
+        data_loader.set_store(worker_store)
+    try:
+        asyncio.run(_serve_socket(sock, max_concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(host="127.0.0.1", port=DEFAULT_PORT, workers=1, max_concurrency=None):
+    """Binds host:port and serves with `workers` pre-forked processes (1 = in-process)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    _prepare_knowledge_base()
+    print(f"Serving on http://{host}:{port} with {workers} worker(s)")
+
+    if workers <= 1 or not hasattr(os, "fork"):
+        if workers > 1:
+            print("Warning: multiple workers need os.fork(); running a single worker.")
+        try:
+            asyncio.run(_serve_socket(sock, max_concurrency))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # Keep the collector from touching (and so copying) the inherited objects in workers
+    gc.freeze()
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            _worker_main(sock, max_concurrency)
+            os._exit(0)
+        children.append(pid)
+
+    def _stop_children(*_):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _stop_children)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        _stop_children()
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP/JSON API for the mutual fund RAG pipeline.")
+    parser.add_argument("--host", default=os.getenv("API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", DEFAULT_PORT)))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("API_WORKERS", "1")))
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="requests in flight per worker (default ASYNC_MAX_CONCURRENCY)")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.max_concurrency)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,26 @@
 # app.py
+import os
+import contextlib
 import streamlit as st
 import pandas as pd # Ensure pandas is imported
 
 # Import functions/modules - Use the new data_loader
 from intent_parser import parse_intent
 from context_builder import build_context
-from llm_handler import get_llm_response
-# Import the DataFrames loaded by data_loader AND the loaded_data dictionary
-from data_loader import funds_df, amcs_df, sectors_df, factors_df, loaded_data
+from context_blocks import context_blocks_enabled, get_context_blocks
+from llm_handler import stream_llm_response, StreamTimer, prompt_tokens, is_error_answer
+# The knowledge base is loaded lazily by data_loader's shared store
+import data_loader
+# Optional knowledge base shared by several app processes (memory-mapped, read-only)
+import shared_kb
 # Also import graph_query if needed for re-querying for viz
 import graph_query
+# Optional thin-client mode: queries go to api_server.py when MF_RAG_API_URL is set
+from api_client import get_api_client
+# Stage timings/counters; the debug panel at the bottom shows them (MF_RAG_DEBUG=1)
+import metrics
+# Optional background answers for suggested follow-up questions (LLM_PREFETCH=1)
+from prefetch import prefetch_follow_ups
 
 
 # Configure Streamlit page settings
@@ -19,6 +30,53 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+# Load the knowledge base once per process and share it across sessions/reruns
+@st.cache_resource
+def init_knowledge_base():
+    # Replicas behind a proxy can share one published copy (KB_SHARED_MEMORY=1)
+    if shared_kb.shared_kb_enabled():
+        shared_kb.attach_or_publish()
+    data_loader.get_store().get_loaded_data()  # Warm the tables on first use
+    if context_blocks_enabled():
+        try:
+            get_context_blocks()  # Render entity and list contexts once, up front
+        except Exception as e:
+            print(f"Warning: could not materialize context blocks: {e}")
+    # Optional hot reload: edited CSVs are picked up without restarting the app
+    # (an attached store also follows versions other replicas publish)
+    if os.getenv("KB_HOT_RELOAD", "0") == "1" or data_loader.get_store().shared is not None:
+        data_loader.start_watcher(float(os.getenv("KB_HOT_RELOAD_INTERVAL", "2.0")))
+    return True
+
+@st.cache_resource
+def init_api_client():
+    return get_api_client()
+
+def load_remote_entities(client):
+    """Entity tables for the explorer, fetched from the API (same columns as the CSVs)."""
+    try:
+        entities = client.entities()
+    except Exception as e:
+        print(f"Error fetching entities from the API: {e}")
+        return None
+    return {
+        "funds": pd.DataFrame(entities["funds"], columns=["id", "fund_id", "name"]).rename(columns={"id": "internal_key"}),
+        "amcs": pd.DataFrame(entities["amcs"], columns=["id", "name"]).rename(columns={"id": "amc_id"}),
+        "sectors": pd.DataFrame(entities["sectors"], columns=["id", "name"]).rename(columns={"id": "sector_id"}),
+        "factors": pd.DataFrame(entities["factors"], columns=["id", "name"]).rename(columns={"id": "factor_id"}),
+    }
+
+api_client = init_api_client()
+if api_client:
+    loaded_data = load_remote_entities(api_client)
+else:
+    init_knowledge_base()
+    # Always read through get_store() so a hot-reloaded version is used on the next rerun
+    loaded_data = data_loader.get_store().get_loaded_data()
+if loaded_data:
+    funds_df, amcs_df = loaded_data["funds"], loaded_data["amcs"]
+    sectors_df, factors_df = loaded_data["sectors"], loaded_data["factors"]
+
 # --- Page Header ---
 st.title("🧠 Mutual Fund RAG Assistant (POC)")
 st.caption("Ask questions about a knowledge base loaded from CSV files.") # Updated caption
@@ -83,18 +141,76 @@ with st.expander("Click to see sample Funds, Factors, AMCs, Sectors"):
              # Optionally add counts for linking tables from data_loader.py if needed
 
 
+def ask_follow_up(query):
+    # Runs before the rerun: fill in the suggested question and ask it right away
+    st.session_state["query_input"] = query
+    st.session_state["ask_follow_up"] = True
+
+def show_follow_ups(queries):
+    """Suggested next questions as buttons (their answers are being prefetched)."""
+    if queries:
+        st.caption("**You might also ask:**")
+        for i, query in enumerate(queries):
+            st.button(query, key=f"follow_up_{i}", on_click=ask_follow_up, args=(query,))
+
 # --- Main Interaction Area ---
 st.divider() # Visual separator
 # Ensure this line is correctly indented at the base level
 user_query = st.text_input("Enter your question here:", key="query_input", placeholder="e.g., Which funds are affected by Crude Oil Price?")
+debug_mode = os.getenv("MF_RAG_DEBUG", "0") == "1"
+profile_mode = st.selectbox("Profile this request", ["off", "cprofile", "sample"], key="profile_mode") if debug_mode else "off"
+profile_mode = None if profile_mode == "off" else profile_mode
 
 # Ensure this 'if' block starts at the base indentation level
-if st.button("Ask Assistant", key="ask_button"):
+if st.button("Ask Assistant", key="ask_button") or st.session_state.pop("ask_follow_up", False):
     if user_query:
+        # Whole-request timing (and optional profiling), closed after the answer is shown
+        request_scope = contextlib.ExitStack()
+        request_scope.enter_context(metrics.timed("request"))
+        request_profile = request_scope.enter_context(metrics.profile_request("streamlit_query", profile_mode))
         # Check if data loaded correctly before proceeding
         # Use the loaded_data dictionary check from data_loader.py
         if not loaded_data:
             st.error("Application Error: Knowledge base data failed to load. Cannot process query.")
+        elif api_client:
+            # Thin-client mode: the API runs parse -> retrieve -> generate
+            st.markdown("---")
+            with st.spinner("Asking the query service..."):
+                try:
+                    result = api_client.query(user_query, profile=profile_mode)
+                except Exception as e:
+                    result = None
+                    st.error(f"Application Error: The query service could not be reached: {e}")
+            if result and result["status"] == "error":
+                st.error(f"Application Error: {result.get('answer') or 'Could not parse intent due to data issues.'}")
+            elif result:
+                st.write(f"**Detected Intent:** `{result['intent']}`")
+                if result.get("entities"):
+                    st.write(f"**Detected Entities:** `{result['entities']}`")
+                st.markdown("---")
+                if result["status"] == "unknown_intent":
+                    st.warning("Sorry, I couldn't fully understand your query based on the available patterns or known entities. Please try rephrasing using terms from the knowledge base explorer above.")
+                else:
+                    st.subheader("Step 1: Retrieving Context from Knowledge Base")
+                    with st.expander("Show Retrieved Context (Passed to LLM)", expanded=False):
+                        st.text(result.get("context") or "No context was retrieved.")
+                        tokens = result.get("tokens") or {}
+                        st.caption(f"~{tokens.get('context', 0)} context tokens, ~{tokens.get('prompt', 0)} prompt tokens")
+                    if result.get("explanation"):
+                        st.info(f"ℹ️ **Explanation:** {result['explanation']}")
+                    if result["status"] == "no_context":
+                        st.warning(f"Could not find relevant information in the knowledge base for: '{user_query}'. Context retrieved: '{result.get('context')}'")
+                    else:
+                        st.subheader("Step 2: Generating Answer using LLM with Context")
+                        st.success("**Assistant's Answer:**")
+                        st.markdown(result.get("answer") or "")
+                        st.caption(f"⏱️ Service time: {result['timings_ms'].get('total', 0) / 1000:.2f}s")
+                        show_follow_ups(result.get("follow_ups"))
+            # No result when the service could not be reached (the error is shown above)
+            if result:
+                for profile in result.get("profiles", []):
+                    with st.expander(f"Profile ({profile['mode']}): {profile['stage']}"):
+                        st.code(profile["report"])
         else:
             st.markdown("---") # Separator before showing results
 
@@ -130,6 +246,8 @@ if st.button("Ask Assistant", key="ask_button"):
                     # Show Retrieved Context
                     with st.expander("Show Retrieved Context (Passed to LLM)", expanded=False):
                         st.text(context if context else "No context was retrieved.")
+                        # Estimated size of what the LLM receives (context is packed to CONTEXT_TOKEN_BUDGET)
+                        st.caption(f"~{prompt_tokens(context or '', user_query)} prompt tokens")
 
                     # Display Explanation (if implemented in Priority 2)
                     if explanation:
@@ -140,12 +258,15 @@ if st.button("Ask Assistant", key="ask_button"):
                     else:
                         # 3. Augment and Generate Response with LLM
                         st.subheader("Step 2: Generating Answer using LLM with Context")
-                        with st.spinner("Asking the LLM..."):
-                            answer = get_llm_response(context, user_query) # LLM still only gets context string
-
-                        # Display the final answer
+                        # Display the answer, rendering chunks as the model streams them
                         st.success("**Assistant's Answer:**")
-                        st.markdown(answer)
+                        stream_timer = StreamTimer()
+                        answer = st.write_stream(stream_timer.wrap(stream_llm_response(context, user_query))) # LLM still only gets context string
+                        if stream_timer.total_time is not None:
+                            ttft = stream_timer.time_to_first_token or 0.0
+                            st.caption(f"⏱️ Time to first token: {ttft:.2f}s · Total time: {stream_timer.total_time:.2f}s")
+                        if not is_error_answer(answer):
+                            show_follow_ups(prefetch_follow_ups(intent, entities))
 
                         # Display Visualization (if implemented in Priority 3)
                         if intent == "find_funds_by_amc" and results_list_of_dicts is not None:
@@ -158,5 +279,27 @@ if st.button("Ask Assistant", key="ask_button"):
                                 st.bar_chart(risk_counts)
                             else:
                                 st.write("No funds found for this AMC to visualize.")
+        request_scope.close()
+        if request_profile.get("report"):
+            with st.expander(f"Profile ({request_profile['mode']}) of this request"):
+                st.code(request_profile["report"])
     else:
-        st.warning("Please enter a question before clicking 'Ask Assistant'.")
\ No newline at end of file
+        st.warning("Please enter a question before clicking 'Ask Assistant'.")
+
+# --- Debug panel: per-stage latency (p50/p95/p99) and counters ---
+if debug_mode:
+    st.divider()
+    with st.expander("Debug: pipeline metrics", expanded=False):
+        try:
+            snapshot = api_client.metrics() if api_client else metrics.snapshot()
+        except Exception as e:
+            snapshot = None
+            st.warning(f"Could not fetch metrics: {e}")
+        if snapshot:
+            if snapshot["stages"]:
+                st.dataframe(pd.DataFrame.from_dict(snapshot["stages"], orient="index"))
+            else:
+                st.write("No requests timed yet.")
+            for counter in snapshot["counters"]:
+                labels = ", ".join(f"{k}={v}" for k, v in counter["labels"].items())
+                st.write(f"- `{counter['name']}` {labels}: {counter['value']}")
\ No newline at end of file
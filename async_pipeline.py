@@ -0,0 +1,176 @@
+# async_pipeline.py
+# Asyncio versions of the query pipeline and a service layer that serves many
+# simultaneous queries per process.
+# parse_intent / build_context are CPU-bound (matcher, graph lookups), so they run
+# in a small thread pool; the LLM call is awaited natively (no thread is held while
+# Gemini is thinking), so a slow answer for one user never blocks the others.
+# A semaphore bounds how many requests are in flight; cancelling a request's task
+# (e.g. the client went away) cancels its pending LLM call.
+#
+# Demo:  python async_pipeline.py "Tell me about FundC Infrastructure" "Find high risk funds"
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import data_loader
+import metrics
+from context_builder import build_context, context_status
+from intent_parser import parse_intent
+from context_assembler import estimate_tokens
+from llm_handler import get_llm_response_async, is_error_answer, prompt_tokens
+# Optional background answers for the likely next questions (LLM_PREFETCH=1)
+from prefetch import prefetch_follow_ups
+
+# Requests processed at once per service (ASYNC_MAX_CONCURRENCY overrides)
+DEFAULT_MAX_CONCURRENCY = 32
+# Threads for the CPU-bound stages (ASYNC_CPU_WORKERS overrides)
+DEFAULT_CPU_WORKERS = min(8, os.cpu_count() or 1)
+
+_cpu_executor = None
+_cpu_executor_lock = threading.Lock()
+
+
+def get_cpu_executor():
+    """Returns the process-wide thread pool for parse/retrieval work, creating it on first use."""
+    global _cpu_executor
+    if _cpu_executor is None:
+        with _cpu_executor_lock:
+            if _cpu_executor is None:
+                workers = int(os.getenv("ASYNC_CPU_WORKERS", DEFAULT_CPU_WORKERS))
+                _cpu_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kb-cpu")
+    return _cpu_executor
+
+
+def _profiled_call(fn, *args):
+    # Profiles the call in the worker thread when the request asked for it
+    with metrics.profile_request(fn.__name__):
+        return fn(*args)
+
+
+async def run_cpu(fn, *args):
+    """Runs fn(*args) in the CPU pool, carrying over context variables (e.g. the pinned store)."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_cpu_executor(), context.run, _profiled_call, fn, *args)
+
+
+async def parse_intent_async(query):
+    """Coroutine version of intent_parser.parse_intent."""
+    return await run_cpu(parse_intent, query)
+
+
+async def build_context_async(intent, entities):
+    """Coroutine version of context_builder.build_context."""
+    return await run_cpu(build_context, intent, entities)
+
+
+class QueryService:
+    """
+    Answers queries concurrently on one event loop: at most max_concurrency
+    requests run at a time, the rest wait in FIFO order for a slot.
+    submit() returns a task that can be cancelled by request id.
+    """
+
+    def __init__(self, max_concurrency=None):
+        self.max_concurrency = max_concurrency or int(os.getenv("ASYNC_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._tasks = {}  # request_id -> asyncio.Task
+        self._ids = itertools.count(1)
+        self.stats = {"active": 0, "completed": 0, "cancelled": 0, "failed": 0}
+
+    async def answer(self, query, profile=None):
+        """
+        Runs parse -> retrieve -> generate for one query.
+        Returns a dict with intent, entities, status, context, explanation, answer, timings_ms,
+        tokens (estimated context / prompt tokens; prompt is 0 when no LLM call was made) and
+        follow_ups (suggested next questions whose answers are being prefetched, usually empty).
+        profile ('cprofile' or 'sample') profiles the CPU-bound stages and adds their reports.
+        """
+        start = time.perf_counter()
+        async with self._semaphore:
+            self.stats["active"] += 1
+            timings = {"queue": round((time.perf_counter() - start) * 1000, 3)}
+            try:
+                # One knowledge-base version for the whole request (copied into the CPU pool)
+                with data_loader.pinned_store(), metrics.request_profiling(profile) as profiles:
+                    stage = time.perf_counter()
+                    intent, entities = await parse_intent_async(query)
+                    timings["parse"] = round((time.perf_counter() - stage) * 1000, 3)
+                    context, explanation = None, None
+                    if intent not in ("error", "unknown"):
+                        stage = time.perf_counter()
+                        context, explanation = await build_context_async(intent, entities)
+                        timings["retrieve"] = round((time.perf_counter() - stage) * 1000, 3)
+                    status = context_status(intent, context)
+                    answer = entities.get("message") if status == "error" else None
+                    tokens = {"context": estimate_tokens(context), "prompt": 0}
+                    if status == "answerable":
+                        tokens["prompt"] = prompt_tokens(context, query)
+                        stage = time.perf_counter()
+                        answer = await get_llm_response_async(context, query)
+                        timings["llm"] = round((time.perf_counter() - stage) * 1000, 3)
+                        status = "answered"
+                    # Follow-ups are only worth preparing after a real answer. Parsing them runs
+                    # in the CPU pool and their LLM calls on the prefetcher's threads
+                    follow_ups = []
+                    if status == "answered" and not is_error_answer(answer):
+                        follow_ups = await run_cpu(prefetch_follow_ups, intent, entities)
+            except asyncio.CancelledError:
+                self.stats["cancelled"] += 1
+                metrics.inc("requests", status="cancelled")
+                raise
+            except Exception:
+                self.stats["failed"] += 1
+                metrics.inc("requests", status="failed")
+                raise
+            finally:
+                self.stats["active"] -= 1
+        self.stats["completed"] += 1
+        metrics.inc("requests", status=status)
+        metrics.observe("request", time.perf_counter() - start)
+        timings["total"] = round((time.perf_counter() - start) * 1000, 3)
+        result = {"query": query, "intent": intent, "entities": entities, "status": status,
+                  "context": context, "explanation": explanation, "answer": answer, "timings_ms": timings,
+                  "tokens": tokens, "follow_ups": follow_ups}
+        if profile:
+            result["profiles"] = [{"stage": p["label"], "mode": p["mode"], "report": p["report"]} for p in profiles]
+        return result
+
+    def submit(self, query, request_id=None, profile=None):
+        """Schedules answer(query) as a task; returns (request_id, task). Must be called on the loop."""
+        request_id = request_id or f"req-{next(self._ids)}"
+        task = asyncio.get_running_loop().create_task(self.answer(query, profile))
+        self._tasks[request_id] = task
+        task.add_done_callback(lambda _, rid=request_id: self._tasks.pop(rid, None))
+        return request_id, task
+
+    def cancel(self, request_id):
+        """Cancels a submitted request (e.g. the user navigated away); True if it was still running."""
+        task = self._tasks.get(request_id)
+        return bool(task) and task.cancel()
+
+    async def answer_many(self, queries):
+        """Answers queries concurrently (bounded by max_concurrency); results in input order."""
+        return await asyncio.gather(*(self.answer(query) for query in queries))
+
+    def get_stats(self):
+        return {**self.stats, "pending": len(self._tasks), "max_concurrency": self.max_concurrency}
+
+
+async def _demo(queries):
+    service = QueryService()
+    start = time.perf_counter()
+    results = await service.answer_many(queries)
+    for result in results:
+        print(json.dumps({k: result[k] for k in ("query", "intent", "status", "answer", "timings_ms", "tokens")}, default=str))
+    print(f"{len(results)} queries in {time.perf_counter() - start:.2f}s; stats: {service.get_stats()}")
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(_demo(sys.argv[1:] or ["Tell me about FundC Infrastructure", "Find high risk funds"]))
@@ -0,0 +1,169 @@
+# batch_pipeline.py
+# Answers many questions in one run (e.g. nightly jobs asking the same question
+# templates for every fund, AMC and factor). Instead of running
+# parse_intent -> build_context -> get_llm_response once per query:
+#   1. identical queries are parsed once, all in one batched pass (parse_intents)
+#   2. contexts are built once per distinct intent/entities (build_contexts)
+#   3. each distinct (question, context) prompt is sent to the LLM once, with
+#      calls running concurrently under a rate limit
+# Results are written as JSONL, one line per input query, with per-stage timings.
+#
+# Usage:
+#   python batch_pipeline.py queries.txt -o results.jsonl --concurrency 8 --rate 60
+# Input: .txt (one query per line), .jsonl ({"id": ..., "query": ...}) or .csv (query[,id] columns)
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from answer_cache import normalize_query
+from context_assembler import estimate_tokens
+from context_builder import build_contexts, context_status, retrieval_key
+from intent_parser import parse_intents
+from llm_client import RateLimiter
+from llm_handler import get_llm_response, prompt_tokens
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RATE_PER_MINUTE = 60
+
+def load_queries(path):
+    """Reads queries from a .txt, .jsonl or .csv file; returns [{"id": ..., "query": ...}]."""
+    ext = os.path.splitext(path)[1].lower()
+    items = []
+    with open(path, newline="", encoding="utf-8") as f:
+        if ext == ".jsonl":
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    items.append({"id": row.get("id"), "query": row["query"]})
+        elif ext == ".csv":
+            for row in csv.DictReader(f):
+                items.append({"id": row.get("id"), "query": row["query"]})
+        else:
+            items = [{"id": None, "query": line.strip()} for line in f if line.strip()]
+    for n, item in enumerate(items):
+        if item["id"] is None:
+            item["id"] = n
+    return items
+
+
+def _status_for(intent, context):
+    """Record status; answerable queries are reported as 'answered'."""
+    status = context_status(intent, context)
+    return "answered" if status == "answerable" else status
+
+
+def run_batch(queries, output_path=None, max_concurrency=DEFAULT_CONCURRENCY,
+              rate_per_minute=DEFAULT_RATE_PER_MINUTE):
+    """
+    Answers a list of queries (strings or {"id", "query"} dicts).
+    Returns (records, summary); records are also written to output_path as JSONL if given.
+    """
+    items = [q if isinstance(q, dict) else {"id": n, "query": q} for n, q in enumerate(queries)]
+    texts = [item["query"] for item in items]
+    batch_start = time.perf_counter()
+
+    # --- Stage 1: parse each distinct query once ---
+    start = time.perf_counter()
+    unique_texts = list(dict.fromkeys(texts))
+    parsed = dict(zip(unique_texts, parse_intents(unique_texts)))
+    parse_seconds = time.perf_counter() - start
+
+    # --- Stage 2: build each distinct context once ---
+    start = time.perf_counter()
+    retrievable = [text for text in unique_texts if parsed[text][0] not in ("error", "unknown")]
+    contexts = dict(zip(retrievable, build_contexts([parsed[text] for text in retrievable])))
+    retrieve_seconds = time.perf_counter() - start
+    distinct_contexts = len({retrieval_key(*parsed[text]) for text in retrievable})
+
+    # --- Stage 3: one LLM call per distinct (question, context), concurrently ---
+    start = time.perf_counter()
+    prompts = {}  # (normalized query, context) -> query text sent
+    for text in retrievable:
+        context = contexts[text][0]
+        if _status_for(parsed[text][0], context) == "answered":
+            prompts.setdefault((normalize_query(text), context), text)
+    limiter = RateLimiter(rate_per_minute)
+
+    def _answer(prompt_key):
+        wait_seconds = limiter.acquire()
+        call_start = time.perf_counter()
+        answer = get_llm_response(prompt_key[1], prompts[prompt_key])
+        return answer, wait_seconds, time.perf_counter() - call_start
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+        futures = {key: pool.submit(_answer, key) for key in prompts}
+        answers = {key: future.result() for key, future in futures.items()}
+    llm_seconds = time.perf_counter() - start
+
+    # --- Assemble one record per input query ---
+    n = max(1, len(items))
+    records = []
+    answered_keys = set()
+    for item in items:
+        text = item["query"]
+        intent, entities = parsed[text]
+        context, explanation = contexts.get(text, (None, None))
+        status = _status_for(intent, context)
+        record = {"id": item["id"], "query": text, "intent": intent, "entities": entities,
+                  "status": status, "context": context, "explanation": explanation, "answer": None,
+                  # Parse/retrieve run batched, so their per-query time is the stage time averaged
+                  "timings_ms": {"parse": round(parse_seconds * 1000 / n, 3),
+                                 "retrieve": round(retrieve_seconds * 1000 / n, 3)},
+                  "tokens": {"context": estimate_tokens(context), "prompt": 0}}
+        if status == "error":
+            record["answer"] = entities.get("message")
+        elif status == "answered":
+            prompt_key = (normalize_query(text), context)
+            answer, wait_seconds, call_seconds = answers[prompt_key]
+            record["answer"] = answer
+            record["tokens"]["prompt"] = prompt_tokens(context, text)
+            # Duplicates reuse the first query's answer (no extra LLM call)
+            record["deduplicated"] = prompt_key in answered_keys
+            answered_keys.add(prompt_key)
+            if record["deduplicated"]:
+                wait_seconds = call_seconds = 0.0
+            record["timings_ms"]["llm_wait"] = round(wait_seconds * 1000, 3)
+            record["timings_ms"]["llm"] = round(call_seconds * 1000, 3)
+        records.append(record)
+
+    summary = {
+        "queries": len(items),
+        "distinct_queries": len(unique_texts),
+        "distinct_contexts": distinct_contexts,
+        "llm_calls": len(prompts),
+        # Estimated tokens actually sent (one prompt per distinct question + context)
+        "prompt_tokens": sum(prompt_tokens(context, text) for (_, context), text in prompts.items()),
+        "status_counts": {},
+        "stage_seconds": {"parse": round(parse_seconds, 4), "retrieve": round(retrieve_seconds, 4),
+                          "llm": round(llm_seconds, 4), "total": round(time.perf_counter() - batch_start, 4)},
+    }
+    for record in records:
+        summary["status_counts"][record["status"]] = summary["status_counts"].get(record["status"], 0) + 1
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    return records, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of queries in one batch.")
+    parser.add_argument("queries", help="query file (.txt, .jsonl or .csv)")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="JSONL output path")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("BATCH_CONCURRENCY", DEFAULT_CONCURRENCY)),
+                        help="maximum concurrent LLM calls")
+    parser.add_argument("--rate", type=float, default=float(os.getenv("BATCH_RATE_PER_MINUTE", DEFAULT_RATE_PER_MINUTE)),
+                        help="maximum LLM calls per minute (0 = unlimited)")
+    args = parser.parse_args()
+
+    _, summary = run_batch(load_queries(args.queries), args.output, args.concurrency, args.rate)
+    print(f"Wrote {summary['queries']} results to {args.output}")
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# bench_ann.py
+# Compares the IVF passage index (ann_index.py) with exact brute-force search:
+# recall@k and per-query latency for a range of nprobe settings.
+#
+# Usage:
+#   python bench_ann.py                       # synthetic clustered vectors (200k x 256)
+#   python bench_ann.py --n 500000 --nprobe 1,4,16,64
+#   python bench_ann.py --kb                  # passages of the real knowledge base
+import argparse
+import time
+
+import numpy as np
+from ann_index import IVFIndex, DEFAULT_NPROBE
+
+
+def synthetic_vectors(n, dim, clusters, seed=0):
+    """Unit vectors drawn around random topic centres (roughly how text embeddings cluster)."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def kb_vectors():
+    """Embeds the knowledge-base passages; queries are perturbed copies of passages."""
+    import data_loader
+    from ann_index import build_passages
+    from semantic_index import create_embedder
+    tables = data_loader.get_store().get_tables(["funds", "sectors", "factors", "fund_documents"])
+    passages = build_passages(tables)
+    return create_embedder().embed([p.text for p in passages])
+
+
+def timed_search(search, queries):
+    """Runs search one query at a time; returns (results, per-query latencies in ms)."""
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query[None, :])[1][0])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+def recall_at_k(approx, exact):
+    hits = sum(len(set(a[a >= 0].tolist()) & set(e.tolist())) for a, e in zip(approx, exact))
+    return hits / sum(len(e) for e in exact)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n", type=int, default=200_000, help="number of synthetic vectors")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=500, help="synthetic topic clusters")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists (default ~4*sqrt(n))")
+    parser.add_argument("--nprobe", default=f"1,4,{DEFAULT_NPROBE},16,32,64")
+    parser.add_argument("--kb", action="store_true", help="benchmark the real knowledge-base passages")
+    args = parser.parse_args()
+
+    vectors = kb_vectors() if args.kb else synthetic_vectors(args.n, args.dim, args.clusters)
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(0, len(vectors), args.queries)]
+    queries = queries + 0.3 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(queries.shape[1])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    start = time.perf_counter()
+    index = IVFIndex(vectors.shape[1], args.nlist)
+    index.add(vectors)
+    print(f"Built IVF index: {len(index)} vectors, dim {index.dim}, {index.nlist} lists "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    exact, exact_ms = timed_search(lambda q: index.exact_search(q, args.k), queries)
+    print(f"{'search':>12} {'recall@' + str(args.k):>10} {'p50 ms':>8} {'p95 ms':>8} {'speedup':>8}")
+    print(f"{'exact':>12} {1.0:>10.3f} {np.percentile(exact_ms, 50):>8.3f} {np.percentile(exact_ms, 95):>8.3f} {1.0:>8.1f}")
+    for nprobe in (int(x) for x in args.nprobe.split(",")):
+        if nprobe > index.nlist:
+            continue
+        approx, ms = timed_search(lambda q: index.search(q, args.k, nprobe), queries)
+        print(f"{'nprobe=' + str(nprobe):>12} {recall_at_k(approx, exact):>10.3f} {np.percentile(ms, 50):>8.3f} "
+              f"{np.percentile(ms, 95):>8.3f} {np.median(exact_ms) / np.median(ms):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# bench_kb.py
+# Benchmark harness for the knowledge-base pipeline at several scales.
+# For each fund count it generates a synthetic knowledge base (synthetic_kb.py)
+# and, in a fresh subprocess (so load time and memory are not skewed by earlier
+# scales), measures:
+#   - CSV load, snapshot build and snapshot load time
+#   - memory: DataFrame footprint and process RSS after loading / index builds
+#   - build time of each derived index (graph index, matcher, impact engine, semantic and
+#     passage indexes), so one-time builds stay out of the query latencies
+#   - parse_intent latency and each graph_query function's latency (p50/p95/p99)
+#   - end-to-end build_context + get_llm_response latency with the stub LLM
+# Results are written to bench_results/<timestamp>.json; --compare against an
+# earlier file prints the change per metric and flags regressions.
+#
+# Usage:
+#   python bench_kb.py --scales 1000,10000,50000
+#   python bench_kb.py --scales 1000,10000 --compare bench_results/baseline.json --threshold 0.2
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RESULTS_DIR = os.path.join(_SCRIPT_DIR, "bench_results")
+DEFAULT_DATA_ROOT = os.path.join(_SCRIPT_DIR, ".cache", "bench_data")
+DEFAULT_SCALES = "1000,10000,50000"
+DEFAULT_QUERIES = 300
+# Relative slow-down (0.2 = 20%) reported as a regression by --compare
+DEFAULT_THRESHOLD = 0.2
+
+
+def _rss_bytes():
+    """Current resident set size (Linux /proc), else peak RSS from getrusage."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _summary(samples_seconds):
+    """Latency summary in milliseconds."""
+    ordered = sorted(samples_seconds)
+    if not ordered:
+        return {}
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"n": len(ordered), "mean_ms": round(sum(ordered) / len(ordered) * 1000, 4),
+            "p50_ms": round(pick(0.5), 4), "p95_ms": round(pick(0.95), 4), "p99_ms": round(pick(0.99), 4)}
+
+
+def _time_calls(fn, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return _summary(samples)
+
+
+def run_scale(data_dir, n_queries, seed=0):
+    """Measures one knowledge base (runs inside the per-scale subprocess)."""
+    import data_loader
+    import kb_snapshot
+    import graph_query
+    from ann_index import get_passage_index
+    from context_blocks import get_context_blocks
+    from context_builder import build_context
+    from entity_matcher import get_entity_matcher
+    from factor_impact import get_impact_engine
+    from fuzzy_matcher import get_fuzzy_matcher
+    from intent_classifier import get_intent_classifier
+    from intent_parser import parse_intent
+    from kg_index import get_graph_index
+    from llm_client import StubBackend, set_backend
+    from llm_handler import get_llm_response
+    from semantic_index import get_semantic_index
+
+    rng = random.Random(seed)
+    result = {"rss_start_mb": round(_rss_bytes() / 2**20, 1)}
+
+    # --- Loading ---
+    store = data_loader.DataStore(data_dir, use_snapshot=False)
+    data_loader.set_store(store)
+    start = time.perf_counter()
+    tables = store.get_loaded_data()
+    result["load_csv_s"] = round(time.perf_counter() - start, 4)
+    result["rows"] = {name: len(df) for name, df in tables.items()}
+    result["frames_mb"] = round(sum(df.memory_usage(deep=True).sum() for df in tables.values()) / 2**20, 2)
+    result["rss_after_load_mb"] = round(_rss_bytes() / 2**20, 1)
+
+    if kb_snapshot.pa is not None:
+        snapshot_path = data_loader.snapshot_path_for(data_dir)
+        start = time.perf_counter()
+        kb_snapshot.write_snapshot(tables, data_loader.table_paths(data_dir), snapshot_path)
+        result["snapshot_build_s"] = round(time.perf_counter() - start, 4)
+        start = time.perf_counter()
+        kb_snapshot.load_snapshot(data_loader.table_paths(data_dir), snapshot_path)
+        result["snapshot_load_s"] = round(time.perf_counter() - start, 4)
+
+    # --- Derived indexes ---
+    result["index_build_s"] = {}
+    for name, build in [("graph_index", get_graph_index), ("entity_matcher", get_entity_matcher),
+                        ("fuzzy_matcher", get_fuzzy_matcher), ("intent_classifier", get_intent_classifier),
+                        ("impact_engine", get_impact_engine), ("semantic_index", get_semantic_index),
+                        ("passage_index", get_passage_index), ("context_blocks", get_context_blocks)]:
+        start = time.perf_counter()
+        build()
+        result["index_build_s"][name] = round(time.perf_counter() - start, 4)
+    result["rss_after_indexes_mb"] = round(_rss_bytes() / 2**20, 1)
+
+    # --- Sample entities and queries ---
+    funds, amcs = tables["funds"], tables["amcs"]
+    sectors, factors = tables["sectors"], tables["factors"]
+    sample = lambda values: [values[rng.randrange(len(values))] for _ in range(n_queries)]
+    fund_keys, fund_names = funds["internal_key"].tolist(), funds["name"].tolist()
+    amc_ids, sector_ids, factor_ids = amcs["amc_id"].tolist(), sectors["sector_id"].tolist(), factors["factor_id"].tolist()
+    templates = [
+        lambda: f"Tell me about {rng.choice(fund_names)}",
+        lambda: f"Which funds are affected by {rng.choice(factor_ids)}?",
+        lambda: f"What funds does {rng.choice(amc_ids)} manage?",
+        lambda: f"Show funds investing in the {rng.choice(sector_ids)} sector",
+        lambda: f"Tell me about {rng.choice(factor_ids)}",
+        lambda: f"Find {rng.choice(['high', 'medium', 'low'])} risk funds",
+        lambda: "which funds get hurt when supply chains break down",  # semantic fallback
+    ]
+    queries = [templates[i % len(templates)]() for i in range(n_queries)]
+
+    result["parse_intent"] = _time_calls(parse_intent, [(q,) for q in queries])
+
+    # --- Each graph_query function ---
+    result["graph_query"] = {
+        "get_fund_details": _time_calls(graph_query.get_fund_details, [(k,) for k in sample(fund_keys)]),
+        "get_amc_details": _time_calls(graph_query.get_amc_details, [(a,) for a in sample(amc_ids)]),
+        "get_sector_details": _time_calls(graph_query.get_sector_details, [(s,) for s in sample(sector_ids)]),
+        "get_factor_details": _time_calls(graph_query.get_factor_details, [(f,) for f in sample(factor_ids)]),
+        "find_funds_by_amc": _time_calls(graph_query.find_funds_by_amc, [(a,) for a in sample(amc_ids)]),
+        "find_funds_by_sector": _time_calls(graph_query.find_funds_by_sector, [(s,) for s in sample(sector_ids)]),
+        "find_funds_related_to_factor": _time_calls(graph_query.find_funds_related_to_factor, [(f,) for f in sample(factor_ids)]),
+        "rank_funds_by_factor": _time_calls(graph_query.rank_funds_by_factor, [(f,) for f in sample(factor_ids)]),
+        "find_funds_by_risk": _time_calls(graph_query.find_funds_by_risk, [(r,) for r in sample(["High", "Medium", "Low"])]),
+        # Compound query: risk + sector + factor intersected by the query planner
+        "find_funds_by_constraints": _time_calls(graph_query.find_funds_by_constraints, [
+            ([("risk", r), ("sector", s), ("factor", f)],)
+            for r, s, f in zip(sample(["High", "Medium", "Low"]), sample(sector_ids), sample(factor_ids))]),
+    }
+
+    # --- End to end with the stub LLM (no network, answer cache disabled by the parent) ---
+    set_backend(StubBackend())
+
+    def _end_to_end(query):
+        intent, entities = parse_intent(query)
+        if intent not in ("error", "unknown"):
+            context, _ = build_context(intent, entities)
+            get_llm_response(context, query)
+    result["end_to_end"] = _time_calls(_end_to_end, [(q,) for q in queries])
+    result["rss_end_mb"] = round(_rss_bytes() / 2**20, 1)
+    return result
+
+
+def _dataset_dir(data_root, n_funds, seed):
+    return os.path.join(data_root, f"funds_{n_funds}_seed_{seed}")
+
+
+def _ensure_dataset(data_root, n_funds, seed):
+    """Generates the synthetic CSVs for a scale once (reused by later runs)."""
+    from synthetic_kb import generate_knowledge_base, write_knowledge_base
+    out_dir = _dataset_dir(data_root, n_funds, seed)
+    if not os.path.exists(os.path.join(out_dir, "funds.csv")):
+        start = time.perf_counter()
+        write_knowledge_base(generate_knowledge_base(n_funds, seed=seed), out_dir)
+        print(f"Generated {n_funds}-fund knowledge base in {time.perf_counter() - start:.1f}s -> {out_dir}")
+    return out_dir
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_SCRIPT_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _flatten(prefix, value, out):
+    """Numeric leaves as {"scale.section.metric": value} for comparisons."""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            _flatten(f"{prefix}.{key}" if prefix else str(key), child, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+
+# Metrics worth comparing between runs (all are "lower is better")
+_COMPARED_SUFFIXES = ("_s", "_mb", "p50_ms", "p95_ms", "p99_ms")
+
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Prints per-metric changes; returns the list of regressed metric names."""
+    old = _flatten("", baseline["scales"], {})
+    new = _flatten("", current["scales"], {})
+    regressions = []
+    print(f"\n{'metric':<60} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(old) & set(new)):
+        if not name.endswith(_COMPARED_SUFFIXES) or name.endswith("rss_start_mb"):
+            continue
+        before, after = old[name], new[name]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<60} {before:>12.4f} {after:>12.4f} {change:>+8.1%}{flag}")
+    print(f"\n{len(regressions)} regression(s) above {threshold:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading, parsing and graph queries at several scales.")
+    parser.add_argument("--scales", default=DEFAULT_SCALES, help="comma-separated fund counts")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES, help="queries/lookups timed per function")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-root", default=DEFAULT_DATA_ROOT, help="where generated datasets are kept")
+    parser.add_argument("--out", default=None, help="results file (default bench_results/<timestamp>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit 1 if --compare finds regressions")
+    parser.add_argument("--run-scale", default=None, help=argparse.SUPPRESS)  # internal: measure one dataset
+    args = parser.parse_args()
+
+    if args.run_scale:
+        print(json.dumps(run_scale(args.run_scale, args.queries, args.seed)))
+        return 0
+
+    env = dict(os.environ, LLM_BACKEND="stub", ANSWER_CACHE_DISABLED="1", KB_SNAPSHOT_AUTOBUILD="0",
+               METRICS_DISABLED="1", SEMANTIC_MODEL="")
+    results = {"meta": {"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_commit": _git_commit(),
+                        "python": platform.python_version(), "platform": platform.platform(),
+                        "queries": args.queries, "seed": args.seed},
+               "scales": {}}
+    for n_funds in (int(s) for s in args.scales.split(",")):
+        data_dir = _ensure_dataset(args.data_root, n_funds, args.seed)
+        print(f"Benchmarking {n_funds} funds...")
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-scale", data_dir,
+                               "--queries", str(args.queries), "--seed", str(args.seed)],
+                              capture_output=True, text=True, env=env)
+        lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+        if proc.returncode != 0 or not lines:
+            print(f"Error: benchmark for {n_funds} funds failed:\n{proc.stderr[-2000:]}")
+            continue
+        scale = json.loads(lines[-1])
+        results["scales"][str(n_funds)] = scale
+        print(f"  load {scale['load_csv_s']}s, frames {scale['frames_mb']} MB, RSS {scale['rss_after_indexes_mb']} MB, "
+              f"parse_intent p50 {scale['parse_intent']['p50_ms']} ms, end-to-end p95 {scale['end_to_end']['p95_ms']} ms")
+
+    out_path = args.out or os.path.join(DEFAULT_RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {out_path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), results, args.threshold)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
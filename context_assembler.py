@@ -0,0 +1,68 @@
+# context_assembler.py
+# Token-budgeted context assembly.
+# Retrieval results are turned into scored facts (one line each); the assembler
+# keeps required lines (headers), then the highest-scoring facts that still fit
+# the token budget, and joins the kept lines once. The prompt size - and with it
+# LLM latency and cost - stays bounded however many funds a query returns, and the
+# most relevant funds survive instead of whichever came first.
+import math
+import os
+from collections import namedtuple
+
+# Rough characters per token for English text with Gemini-style tokenizers
+CHARS_PER_TOKEN = 4.0
+# Token budget for one context (CONTEXT_TOKEN_BUDGET overrides)
+DEFAULT_TOKEN_BUDGET = 500
+
+# One line of context: score ranks optional facts, required facts are always kept
+Fact = namedtuple("Fact", ["text", "score", "required"])
+# Result of packing: the context text, its estimated tokens, and how many facts made it in
+AssembledContext = namedtuple("AssembledContext", ["text", "tokens", "included", "total", "budget"])
+
+
+def estimate_tokens(text):
+    """Estimated token count of text (~4 characters per token, at least one per word)."""
+    if not text:
+        return 0
+    return max(math.ceil(len(text) / CHARS_PER_TOKEN), len(text.split()))
+
+
+def token_budget():
+    """The configured context budget in tokens."""
+    return int(os.getenv("CONTEXT_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+
+
+def fact(text, score=0.0, required=False):
+    return Fact(text, score, required)
+
+
+def assemble(facts, budget=None, overflow=None, hidden=0):
+    """
+    Packs facts into `budget` tokens (default token_budget()).
+    Required facts are always kept; optional ones are taken by descending score
+    (ties keep input order), skipping any that no longer fit. Kept facts are
+    joined once, in input order.
+    overflow: optional function(n_dropped) -> closing line added when optional facts
+    were dropped (e.g. "...and 12 more."); room for it is reserved up front.
+    hidden: facts left out before packing (e.g. beyond a result window); they count
+    as dropped, so the overflow line is added even when every given fact fits.
+    """
+    budget = token_budget() if budget is None else budget
+    costs = [estimate_tokens(f.text) + 1 for f in facts]  # +1 for the newline
+    optional = [i for i, f in enumerate(facts) if not f.required]
+    may_overflow = overflow and (optional or hidden)
+    reserve = estimate_tokens(overflow(len(optional) + hidden)) + 1 if may_overflow else 0
+
+    keep = {i for i, f in enumerate(facts) if f.required}
+    used = sum(costs[i] for i in keep)
+    for i in sorted(optional, key=lambda i: -facts[i].score):
+        if used + costs[i] + reserve <= budget:
+            keep.add(i)
+            used += costs[i]
+
+    lines = [facts[i].text for i in range(len(facts)) if i in keep]
+    dropped = len(facts) - len(keep) + hidden
+    if overflow and dropped:
+        lines.append(overflow(dropped))
+    text = "\n".join(lines) + "\n" if lines else ""
+    return AssembledContext(text, estimate_tokens(text), len(keep), len(facts), budget)
@@ -0,0 +1,287 @@
+# context_blocks.py
+# Materialized context blocks.
+# Entity-detail contexts (fund, AMC, sector, factor) and the frequent list
+# contexts (funds by AMC, sector and risk level) only change when the CSVs do,
+# so they are rendered once per knowledge-base version and served with a single
+# dictionary lookup instead of re-querying and re-formatting on every request.
+# Blocks live in a compact key -> string store (one UTF-8 buffer with offsets),
+# persisted to .cache/context_blocks.npz. Each block keeps a hash of the inputs
+# it was rendered from (the entity's fields and links, and the token budget):
+# after a hot reload or a restart only blocks whose inputs changed are rendered
+# again, the rest are copied from the previous version or the saved file.
+#
+# Build step (optional, otherwise done on first use):  python context_blocks.py
+import functools
+import hashlib
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import context_builder
+import data_loader
+import graph_query
+import metrics
+from context_assembler import token_budget
+from kg_index import get_graph_index
+
+# Intent -> entity field naming the block; other intents are always built live
+MATERIALIZED_INTENTS = {
+    "get_fund_details": "fund_internal_key",
+    "get_amc_details": "amc_id",
+    "get_sector_details": "sector_id",
+    "get_factor_details": "factor_id",
+    "find_funds_by_amc": "amc_id",
+    "find_funds_by_sector": "sector_id",
+    "find_funds_by_risk": "risk_level",
+}
+# Bumped whenever the rendered text changes, so saved blocks are rendered again
+BLOCKS_FORMAT_VERSION = 2
+BLOCKS_FILE = "context_blocks.npz"
+
+
+def context_blocks_enabled():
+    return os.getenv("CONTEXT_BLOCKS", "1") != "0"
+
+
+def block_key(intent, value):
+    return f"{intent}:{value}"
+
+
+def _signature(inputs):
+    """Stable 64-bit hash of a block's inputs (unlike hash(), the same in every process)."""
+    data = inputs if isinstance(inputs, bytes) else repr(inputs).encode("utf-8")
+    return np.uint64(int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little"))
+
+
+def _string_hashes(strings):
+    """uint64 hash per string (pandas' stable value hashing)."""
+    return pd.util.hash_pandas_object(pd.Series(strings, dtype=object), index=False).to_numpy()
+
+
+def _link_hashes(adjacency, target_hashes):
+    """
+    Per source code (+1 zero slot for NO_CODE): an order-sensitive hash of its neighbor
+    list, summing each target's hash times an odd weight for its rank in the list.
+    """
+    counts = np.diff(adjacency.indptr)
+    ranks = np.arange(len(adjacency.indices)) - np.repeat(adjacency.indptr[:-1], counts)
+    weighted = target_hashes[adjacency.indices] * (ranks.astype(np.uint64) * np.uint64(2) + np.uint64(1))
+    sums = np.zeros(len(weighted) + 1, dtype=np.uint64)
+    np.cumsum(weighted, dtype=np.uint64, out=sums[1:])
+    hashes = np.zeros(len(counts) + 1, dtype=np.uint64)
+    hashes[:-1] = sums[adjacency.indptr[1:]] - sums[adjacency.indptr[:-1]]
+    return hashes
+
+
+def _fund_row_hashes(store, index):
+    """uint64 per fund row: hash of the row's own fields."""
+    funds = store.table("funds")
+    if funds.empty:
+        return np.zeros(index.n_funds, dtype=np.uint64)
+    return pd.util.hash_pandas_object(funds, index=False).to_numpy()
+
+
+def _fund_signatures(row_hashes, index):
+    """Per fund row: signature of everything its details block shows (fields, secondary sectors, related factors)."""
+    sectors = _link_hashes(index.fund_sectors, _string_hashes(index.sectors.strings))
+    factors = _link_hashes(index.fund_factors, _string_hashes(index.factors.strings))
+    counts = np.zeros(len(index.funds) + 1, dtype=np.int64)
+    counts[:-1] = np.diff(index.fund_sectors.indptr) * (1 << 32) + np.diff(index.fund_factors.indptr)
+    combined = pd.DataFrame({"row": row_hashes, "sectors": sectors[index.fund_code],
+                             "factors": factors[index.fund_code], "counts": counts[index.fund_code]})
+    return pd.util.hash_pandas_object(combined, index=False).to_numpy()
+
+
+class ContextBlocks:
+    """
+    Read-only key -> context string store: the blocks are concatenated into one UTF-8
+    buffer with int64 offsets, and a dict maps each key to its slot.
+    """
+
+    def __init__(self, keys, signatures, blob, offsets, budget):
+        self.keys = list(keys)
+        self.slots = {key: slot for slot, key in enumerate(self.keys)}
+        self.signatures = np.asarray(signatures, dtype=np.uint64)
+        self.blob = blob
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.budget = budget
+        self.stats = {"blocks": len(self.keys)}
+
+    @classmethod
+    def from_blocks(cls, blocks, budget):
+        """Packs a list of (key, signature, UTF-8 text)."""
+        offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+        np.cumsum([len(data) for _, _, data in blocks], out=offsets[1:])
+        return cls([key for key, _, _ in blocks], [sig for _, sig, _ in blocks],
+                   b"".join(data for _, _, data in blocks), offsets, budget)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _data(self, slot):
+        return self.blob[self.offsets[slot]:self.offsets[slot + 1]]
+
+    def get(self, key):
+        """The block stored under key, or None."""
+        slot = self.slots.get(key)
+        return None if slot is None else self._data(slot).decode("utf-8")
+
+    def reusable(self, key, signature):
+        """The stored block (UTF-8) for key if it was rendered from the same inputs, else None."""
+        slot = self.slots.get(key)
+        if slot is None or self.signatures[slot] != signature:
+            return None
+        return self._data(slot)
+
+    def lookup(self, intent, entities):
+        """The context for a materialized intent, or None (not materialized, unknown key, other budget)."""
+        field = MATERIALIZED_INTENTS.get(intent)
+        if field is None or self.budget != token_budget():
+            return None
+        value = entities.get(field)
+        return None if value is None else self.get(block_key(intent, value))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, format_version=np.array(BLOCKS_FORMAT_VERSION), budget=np.array(self.budget),
+                 keys=np.array(self.keys, dtype=str), signatures=self.signatures, offsets=self.offsets,
+                 blob=np.frombuffer(self.blob, dtype=np.uint8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads saved blocks, or returns None if the file is missing, unreadable or of another format."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                if int(saved["format_version"]) != BLOCKS_FORMAT_VERSION:
+                    return None
+                return cls(saved["keys"].tolist(), saved["signatures"], saved["blob"].tobytes(),
+                           saved["offsets"], int(saved["budget"]))
+        except Exception as e:
+            print(f"Warning: ignoring unreadable context blocks ({e}).")
+            return None
+
+
+def _render_fund(index, pos):
+    # Undecorated formatter: materializing thousands of blocks should not flood context_format
+    return context_builder.format_fund_details.__wrapped__(graph_query.fund_details_at(index, pos))
+
+
+def _render_list(index, intent, value, positions, window_size):
+    window = index.funds_at(positions[:window_size])
+    query_context = context_builder.LIST_CONTEXTS[intent].format(value)
+    return context_builder.format_fund_window(window, len(positions), query_context)
+
+
+def _block_sources(store, index):
+    """
+    Yields (key, signature, render) for every block: the signature identifies the
+    inputs the block is rendered from, render() returns its text formatted exactly
+    as build_context does. Inputs are only gathered for blocks that get rendered.
+    """
+    row_hashes = _fund_row_hashes(store, index)
+    fund_signatures = _fund_signatures(row_hashes, index)
+    for key, pos in index.fund_position_by_key.items():
+        yield block_key("get_fund_details", key), fund_signatures[pos], functools.partial(_render_fund, index, pos)
+
+    for amc_id, amc in index.amc_records.items():
+        yield (block_key("get_amc_details", amc_id), _signature(amc),
+               functools.partial(context_builder.format_amc_details, amc_id, amc))
+    for sector_id, sector in index.sector_records.items():
+        yield (block_key("get_sector_details", sector_id), _signature(sector),
+               functools.partial(context_builder.format_sector_details, sector_id, sector))
+    for factor_id in index.factor_records:
+        factor = graph_query.factor_details_for(index, factor_id)
+        yield (block_key("get_factor_details", factor_id), _signature(factor),
+               functools.partial(context_builder.format_factor_details, factor_id, factor))
+
+    # Lists: only the window of funds a list context can show is part of its inputs
+    window_size = context_builder.fund_window_size()
+    lists = [("find_funds_by_amc", value, graph_query.amc_fund_positions(index, value))
+             for value in index.amcs.strings]
+    lists += [("find_funds_by_sector", value, graph_query.sector_fund_positions(index, value))
+              for value in index.sectors.strings]
+    # Risk levels are keyed as the intent parser reports them ("High")
+    lists += [("find_funds_by_risk", str(value).capitalize(), graph_query.risk_fund_positions(index, value))
+              for value in index.risks.strings]
+    for intent, value, positions in lists:
+        key = block_key(intent, value)
+        window_hashes = row_hashes[positions[:window_size]]
+        signature = _signature(key.encode("utf-8") + np.uint64(len(positions)).tobytes() + window_hashes.tobytes())
+        yield key, signature, functools.partial(_render_list, index, intent, value, positions, window_size)
+
+
+def materialize(store, previous=None):
+    """
+    Renders every context block of a store's knowledge base. Blocks of `previous`
+    (ContextBlocks rendered with the same token budget) whose inputs are unchanged
+    are copied instead of rendered.
+    """
+    start = time.perf_counter()
+    budget = token_budget()
+    if previous is not None and previous.budget != budget:
+        previous = None
+    blocks = []
+    reused = 0
+    for key, signature, render in _block_sources(store, get_graph_index(store)):
+        data = previous.reusable(key, signature) if previous is not None else None
+        if data is None:
+            # Stored as build_context returns it (stripped)
+            data = render().strip().encode("utf-8")
+        else:
+            reused += 1
+        blocks.append((key, signature, data))
+    materialized = ContextBlocks.from_blocks(blocks, budget)
+    seconds = time.perf_counter() - start
+    metrics.observe("context_blocks_build", seconds)
+    materialized.stats.update(rendered=len(blocks) - reused, reused=reused, build_ms=round(seconds * 1000, 1))
+    return materialized
+
+
+def blocks_path_for(store):
+    return os.path.join(data_loader.cache_dir_for(store.data_dir), BLOCKS_FILE)
+
+
+def get_context_blocks(store=None):
+    """Returns the materialized blocks of the current (or given) store, building them on first use."""
+    def _build(store):
+        persist_path = blocks_path_for(store) if store.use_snapshot else None
+        # Reuse what the previous store version (hot reload) or the last run rendered
+        previous = store.previous_derived("context_blocks")
+        if previous is None and persist_path:
+            previous = ContextBlocks.load(persist_path)
+        blocks = materialize(store, previous)
+        if persist_path and (previous is None or blocks.stats["rendered"] or len(previous) != len(blocks)):
+            try:
+                blocks.save(persist_path)
+            except Exception as e:
+                print(f"Warning: could not persist context blocks: {e}")
+        return blocks
+    return (store or data_loader.get_store()).derived("context_blocks", _build)
+
+
+def lookup(intent, entities):
+    """
+    The materialized context for (intent, entities), or None when it has to be built
+    live (intent not materialized, unknown entity, disabled with CONTEXT_BLOCKS=0).
+    """
+    if intent not in MATERIALIZED_INTENTS or not context_blocks_enabled():
+        return None
+    try:
+        text = get_context_blocks().lookup(intent, entities)
+    except Exception as e:
+        # The request is then answered by the live query path
+        print(f"Warning: context blocks unavailable: {e}")
+        return None
+    metrics.inc("context_block_lookups", result="miss" if text is None else "hit")
+    return text
+
+
+if __name__ == "__main__":
+    blocks = get_context_blocks()
+    print(f"Context blocks: {blocks.stats}")
@@ -1,38 +1,99 @@
 # context_builder.py
+import context_blocks
+import data_loader
 import graph_query
-# Import necessary DFs for explanation logic
-from data_loader import sectors_df # You might need others depending on explanation detail
+# Sector records for explanation logic come from the shared graph index
+from kg_index import get_graph_index
+from ann_index import get_passage_index
+from metrics import timed_function
+from query_planner import Constraint, describe_constraints, describe_plan
+from context_assembler import assemble, fact, token_budget
 
-# --- Formatting Helper Functions (Keep As Is) ---
-def format_fund_details(fund):
-    """Formats details of a single fund nicely."""
+# Hops followed when ranking funds by factor exposure (2 = include correlated sectors)
+FACTOR_EXPOSURE_HOPS = 2
+# Share of the token budget for the indirectly exposed funds listed after the direct ones
+INDIRECT_TIER_BUDGET_SHARE = 0.25
+# Number of passages (descriptions / document chunks) shown for semantic_search queries
+SEMANTIC_TOP_K = 5
+# Context strings that mean nothing useful was retrieved (nothing worth sending to the LLM)
+NO_CONTEXT_MARKERS = ("No specific information found", "Could not retrieve context")
+# Lower bound on the tokens of one fund line, used to pre-select list candidates
+MIN_FUND_LINE_TOKENS = 12
+# "Found N fund(s) ...:" header wording of the plain list intents
+LIST_CONTEXTS = {
+    "find_funds_by_amc": "managed by {}",
+    "find_funds_by_sector": "investing in the {} sector",
+    "find_funds_by_risk": "with '{}' risk level",
+}
+
+# --- Formatting Helper Functions ---
+# Each helper turns results into scored facts and packs them into the token budget
+# (context_assembler); budget=None uses CONTEXT_TOKEN_BUDGET.
+@timed_function("context_format")
+def format_fund_details(fund, budget=None):
+    """Formats details of a single fund, most important fields first when the budget is tight."""
     if not fund: return "Fund details not found."
-    context = f"Fund Name: {fund.get('name')} (ID: {fund.get('fund_id')})\n" # Use fund_id
-    context += f"Managed by: {fund.get('amc_id')}\n" # Use amc_id
-    context += f"Risk Level: {fund.get('risk')}\n"
-    context += f"Primary Sector: {fund.get('primary_sector')}\n"
+    facts = [
+        fact(f"Fund Name: {fund.get('name')} (ID: {fund.get('fund_id')})", required=True), # Use fund_id
+        fact(f"Managed by: {fund.get('amc_id')}", 0.9), # Use amc_id
+        fact(f"Risk Level: {fund.get('risk')}", 0.9),
+        fact(f"Primary Sector: {fund.get('primary_sector')}", 0.8),
+    ]
     # Ensure secondary_sectors and related_factors are retrieved if needed by graph_query.get_fund_details
     if fund.get('secondary_sectors'):
-         context += f"Other Sectors: {', '.join(fund.get('secondary_sectors'))}\n"
+        facts.append(fact(f"Other Sectors: {', '.join(fund.get('secondary_sectors'))}", 0.6))
     if fund.get('related_factors'):
-        context += f"Directly Related Factors: {', '.join(fund.get('related_factors'))}\n"
-    context += f"Description: {fund.get('description')}\n"
-    return context
+        facts.append(fact(f"Directly Related Factors: {', '.join(fund.get('related_factors'))}", 0.6))
+    facts.append(fact(f"Description: {fund.get('description')}", 0.7))
+    return assemble(facts, budget).text
+
+def fund_relevance(fund, rank, n_funds):
+    """
+    Relevance of one fund in a result list: its exposure score when the query ranked
+    by factor exposure, otherwise the query's own order (e.g. primary-sector holdings
+    before secondary ones) mapped to (0, 1].
+    """
+    if 'exposure_score' in fund:
+        return float(fund['exposure_score'])
+    return 1.0 - rank / max(1, n_funds)
+
+def fund_window_size(budget=None):
+    """Most fund lines a list context can hold (at least MIN_FUND_LINE_TOKENS each)."""
+    return max(1, (token_budget() if budget is None else budget) // MIN_FUND_LINE_TOKENS)
 
-def format_list_of_funds(funds_list, query_context=""):
-    """Formats a list of funds concisely."""
-    if not funds_list:
+@timed_function("context_format")
+def format_list_of_funds(funds_list, query_context="", budget=None):
+    """Formats a list of funds concisely, keeping the most relevant ones that fit the token budget."""
+    # graph_query returns lists best first (exposure-ranked or primary holdings first), and
+    # at most fund_window_size() lines can fit, so only that window is formatted
+    return format_fund_window(funds_list[:fund_window_size(budget)], len(funds_list), query_context, budget)
+
+def format_fund_window(window, n_funds, query_context="", budget=None):
+    """Formats the first funds (window) of a best-first list of n_funds funds."""
+    if not n_funds:
         return "No funds found matching the criteria.\n"
 
-    context = f"Found {len(funds_list)} fund(s) {query_context}:\n"
-    display_limit = 5
-    limited_list = funds_list[:display_limit]
+    candidates = range(len(window))
+    facts = [fact(f"Found {n_funds} fund(s) {query_context}:", required=True)]
+    for rank in candidates:
+        fund = window[rank]
+        # Ranked results (e.g. factor exposure) also show their score
+        score_str = f", Exposure Score: {fund['exposure_score']}" if 'exposure_score' in fund else ""
+        facts.append(fact(f"- {fund.get('name')} (Risk: {fund.get('risk')}, Primary Sector: {fund.get('primary_sector')}, AMC: {fund.get('amc_id')}{score_str})", # Use amc_id
+                          fund_relevance(fund, rank, n_funds)))
+    # Funds beyond the window were never formatted but still count towards "...and N more."
+    return assemble(facts, budget, overflow=lambda dropped: f"...and {dropped} more.",
+                    hidden=n_funds - len(candidates)).text
+
+def format_amc_details(amc_key, amc):
+    return f"AMC Details for {amc_key}:\n- Name: {amc.get('name')}\n- Established: {amc.get('established')}\n- AUM Group: {amc.get('AUM_group')}\n"
 
-    for fund in limited_list:
-        context += f"- {fund.get('name')} (Risk: {fund.get('risk')}, Primary Sector: {fund.get('primary_sector')}, AMC: {fund.get('amc_id')})\n" # Use amc_id
-    if len(funds_list) > display_limit:
-        context += f"...and {len(funds_list) - display_limit} more.\n"
-    return context
+def format_sector_details(sector_name, sector):
+    return f"Sector Details for {sector_name}:\n- Description: {sector.get('description')}\n- Sensitivity Notes: {sector.get('sensitivity_notes')}\n"
+
+def format_factor_details(factor_name, factor):
+    affected_sectors_str = ', '.join(factor.get('typically_affected_sectors', [])) or 'N/A'
+    return f"Factor Details for {factor_name}:\n- Description: {factor.get('description')}\n- Typical Impact Direction: {factor.get('impact_direction')}\n- Typically Affected Sectors: {affected_sectors_str}\n"
 
 # --- Main build_context Function ---
 def build_context(intent, entities):
@@ -41,11 +102,80 @@ def build_context(intent, entities):
     and potentially generates an explanation.
     ALWAYS returns a tuple: (context_string, explanation_string_or_None)
     """
+    # Every lookup below sees the same knowledge-base version, even during a hot reload
+    with data_loader.pinned_store():
+        context, explanation = _build_context_for_intent(intent, entities)
+
+    # *** Final Return - ALWAYS return a tuple of 2 items ***
+    return _finalize(context, explanation)
+
+
+def _finalize(context, explanation):
+    """Strips the context/explanation, returning the (context, explanation) tuple."""
+    final_context = context.strip() if isinstance(context, str) else "Error: Invalid context generated."
+    final_explanation = explanation.strip() if isinstance(explanation, str) else None
+
+    return (final_context, final_explanation) # Return as a tuple
+
+
+def context_status(intent, context):
+    """Classifies a parsed + retrieved query: 'error', 'unknown_intent', 'no_context' or 'answerable'."""
+    if intent == "error":
+        return "error"
+    if intent == "unknown":
+        return "unknown_intent"
+    if not context or any(marker in context for marker in NO_CONTEXT_MARKERS):
+        return "no_context"
+    return "answerable"
+
+
+def retrieval_key(intent, entities):
+    """Hashable key of everything the context depends on (the semantic and fuzzy match scores do not affect it)."""
+    return (intent, tuple(sorted((k, v) for k, v in entities.items() if k not in ('semantic_score', 'fuzzy_score'))))
+
+
+def build_contexts(requests):
+    """
+    Batch version of build_context for a list of (intent, entities) pairs.
+    Identical requests are built once, semantic_search passage lookups run as one
+    batched ANN search, and the whole batch sees one knowledge-base version.
+    Returns a list of (context, explanation) tuples in request order.
+    """
+    built = {}
+    with data_loader.pinned_store():
+        unique = {}
+        for intent, entities in requests:
+            unique.setdefault(retrieval_key(intent, entities), (intent, entities))
+        semantic_keys = [key for key, (intent, _) in unique.items() if intent == "semantic_search"]
+        passage_hits = {}
+        if semantic_keys:
+            try:
+                queries = [unique[key][1].get("semantic_query", "") for key in semantic_keys]
+                passage_hits = dict(zip(semantic_keys, get_passage_index().search_batch(queries, top_k=SEMANTIC_TOP_K)))
+            except Exception as e:
+                # Each request then reports the error through the normal per-intent path
+                print(f"Error during batched passage search: {e}")
+        for key, (intent, entities) in unique.items():
+            built[key] = _finalize(*_build_context_for_intent(intent, entities, passage_hits.get(key)))
+    return [built[retrieval_key(intent, entities)] for intent, entities in requests]
+
+
+@timed_function("build_context")
+def _build_context_for_intent(intent, entities, passage_hits=None):
+    """
+    Runs the graph queries for one intent; returns (context, explanation) before cleanup.
+    passage_hits optionally supplies precomputed passage search results (semantic_search).
+    """
     context = "No specific information found in the knowledge base for this query." # Default context
     explanation = None # Initialize explanation string - MUST always be returned
     results = None # Store raw results if needed
 
     try:
+        # Entity details and plain fund lists are precomputed per knowledge-base version
+        block = context_blocks.lookup(intent, entities)
+        if block is not None:
+            return block, None
+
         # --- Logic for each intent ---
         if intent == "get_fund_details":
             fund = graph_query.get_fund_details(entities.get("fund_internal_key"))
@@ -56,8 +186,19 @@ def build_context(intent, entities):
 
         elif intent == "find_funds_by_factor":
             factor_id = entities.get("factor_id")
-            results = graph_query.find_funds_related_to_factor(factor_id)
-            context = format_list_of_funds(results, f"potentially affected by '{factor_id}'")
+            # Ranked by weighted exposure so the most exposed funds are listed first
+            # Funds only linked through correlated sectors hold nothing the factor affects,
+            # so they get their own labelled list instead of appearing as affected
+            # (both tiers come from one traversal; there are none below two hops)
+            results, indirect = graph_query.rank_funds_by_factor_tiers(factor_id, max_hops=FACTOR_EXPOSURE_HOPS)
+            budget = token_budget()
+            indirect_budget = int(budget * INDIRECT_TIER_BUDGET_SHARE) if indirect else 0
+            context = format_list_of_funds(results, f"potentially affected by '{factor_id}' (most exposed first)",
+                                           budget - indirect_budget)
+            if indirect:
+                context += format_list_of_funds(
+                    indirect, f"only indirectly exposed to '{factor_id}' (no direct link and no holdings in the sectors it affects; "
+                              f"linked only through sectors often held alongside those)", indirect_budget)
 
             # --- Add Explanation Logic ---
             if results and factor_id: # Check if results were found
@@ -66,10 +207,12 @@ def build_context(intent, entities):
                     affected_sector_ids = factor_info.get('typically_affected_sectors', []) if factor_info else []
 
                     affected_sector_names = []
-                    if not sectors_df.empty and affected_sector_ids:
-                         affected_sector_names = sectors_df[sectors_df['sector_id'].isin(affected_sector_ids)]['name'].tolist()
+                    if affected_sector_ids:
+                         # Keep sectors.csv order, as the old isin() filter did
+                         wanted = set(affected_sector_ids)
+                         affected_sector_names = [sector.get('name') for sector_id, sector in get_graph_index().sector_records.items() if sector_id in wanted]
 
-                    example_fund = results[0] # Use first fund as example
+                    example_fund = results[0] # Use the most exposed fund as example
                     fund_name = example_fund.get('name')
                     fund_primary_sector = example_fund.get('primary_sector')
 
@@ -84,44 +227,63 @@ def build_context(intent, entities):
             else:
                  explanation = None # Ensure explanation is None if no results found
 
+        elif intent == "find_funds_compound":
+            # Several constraints at once: set algebra over fund bitsets (query_planner)
+            constraints = [Constraint(*c) for c in entities.get("constraints", ())]
+            results, steps = graph_query.find_funds_by_constraints(constraints, max_hops=FACTOR_EXPOSURE_HOPS)
+            ranked = " (most exposed first)" if any(c.kind == "factor" for c in constraints) else ""
+            context = format_list_of_funds(results, describe_constraints(constraints) + ranked)
+            explanation = f"Query plan (most selective constraint first):\n{describe_plan(steps)}" if steps else None
+
         elif intent == "find_funds_by_amc":
             amc = entities.get("amc_id")
             results = graph_query.find_funds_by_amc(amc)
-            context = format_list_of_funds(results, f"managed by {amc}")
+            context = format_list_of_funds(results, LIST_CONTEXTS[intent].format(amc))
             explanation = None # No specific explanation logic here yet
 
         elif intent == "find_funds_by_sector":
             sector = entities.get("sector_id")
             results = graph_query.find_funds_by_sector(sector)
-            context = format_list_of_funds(results, f"investing in the {sector} sector")
+            context = format_list_of_funds(results, LIST_CONTEXTS[intent].format(sector))
             explanation = None # No specific explanation logic here yet
 
         elif intent == "find_funds_by_risk":
              risk = entities.get("risk_level")
              results = graph_query.find_funds_by_risk(risk)
-             context = format_list_of_funds(results, f"with '{risk}' risk level")
+             context = format_list_of_funds(results, LIST_CONTEXTS[intent].format(risk))
              explanation = None # No specific explanation logic here yet
 
         elif intent == "get_amc_details":
              amc_key = entities.get("amc_id")
              amc = graph_query.get_amc_details(amc_key)
-             if amc: context = f"AMC Details for {amc_key}:\n- Name: {amc.get('name')}\n- Established: {amc.get('established')}\n- AUM Group: {amc.get('AUM_group')}\n"
+             if amc: context = format_amc_details(amc_key, amc)
              explanation = None # No specific explanation logic here yet
 
         elif intent == "get_sector_details":
              sector_name = entities.get("sector_id")
              sector = graph_query.get_sector_details(sector_name)
-             if sector: context = f"Sector Details for {sector_name}:\n- Description: {sector.get('description')}\n- Sensitivity Notes: {sector.get('sensitivity_notes')}\n"
+             if sector: context = format_sector_details(sector_name, sector)
              explanation = None # No specific explanation logic here yet
 
         elif intent == "get_factor_details":
              factor_name = entities.get("factor_id")
              factor = graph_query.get_factor_details(factor_name)
-             if factor:
-                 affected_sectors_str = ', '.join(factor.get('typically_affected_sectors', [])) or 'N/A'
-                 context = f"Factor Details for {factor_name}:\n- Description: {factor.get('description')}\n- Typical Impact Direction: {factor.get('impact_direction')}\n- Typically Affected Sectors: {affected_sectors_str}\n"
+             if factor: context = format_factor_details(factor_name, factor)
              explanation = None # No specific explanation logic here yet
 
+        elif intent == "semantic_search":
+             # No exact entity matched: use the closest passages (ANN search) as context
+             hits = passage_hits
+             if hits is None:
+                 hits = get_passage_index().search(entities.get("semantic_query", ""), top_k=SEMANTIC_TOP_K)
+             if hits:
+                 # Most similar passages first; long passages that do not fit the budget are skipped
+                 facts = [fact(f"Closest matches in the knowledge base for '{entities.get('semantic_query')}':", required=True)]
+                 facts += [fact(f"- {hit.entity_type.capitalize()}: {hit.name} (similarity {hit.score:.2f}) - {hit.text}", hit.score)
+                           for hit in hits]
+                 context = assemble(facts).text
+             explanation = None
+
         # Handle unknown or error intents passed from parser
         elif intent == "unknown" or intent == "error":
              context = "Could not process the query due to unknown intent or data issues."
@@ -137,8 +299,4 @@ def build_context(intent, entities):
         context = f"An error occurred while retrieving information: {e}"
         explanation = None # Ensure explanation is None on error
 
-    # *** Final Return - ALWAYS return a tuple of 2 items ***
-    final_context = context.strip() if isinstance(context, str) else "Error: Invalid context generated."
-    final_explanation = explanation.strip() if isinstance(explanation, str) else None
-
-    return (final_context, final_explanation) # Return as a tuple
\ No newline at end of file
+    return context, explanation
@@ -1,58 +1,451 @@
 # data_loader.py
+# Lazily loaded knowledge base. Importing this module does no I/O: tables are
+# read on first access through a process-wide DataStore, and indexes derived
+# from them (graph index, entity matcher, ...) are cached on the same store.
+# refresh_if_changed()/start_watcher() hot-reload edited CSVs by building a new
+# store version and swapping it in atomically.
+# A store can also be attached to a knowledge base another process published
+# into a memory-mapped file (shared_kb); it then follows that file's version counter.
 import pandas as pd
 import os
+import hashlib
+import threading
+import time
+import contextlib
+import contextvars
+import kb_snapshot
 
 # Get the directory where this script is located
 _SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
-def load_data():
-    """Loads all data from CSV files into Pandas DataFrames."""
+# Knowledge-base table name -> CSV file (relative to the data directory)
+TABLE_FILES = {
+    "funds": "funds.csv",
+    "fund_secondary_sectors": "fund_secondary_sectors.csv",
+    "fund_related_factors": "fund_related_factors.csv",
+    "amcs": "amcs.csv",
+    "sectors": "sectors.csv",
+    "factors": "factors.csv",
+    "factor_affected_sectors": "factor_affected_sectors.csv",
+}
+
+# Tables that may be absent: a missing file loads as an empty table. They are
+# not part of the snapshot or get_loaded_data(); request them by name.
+OPTIONAL_TABLE_FILES = {
+    "fund_documents": "fund_documents.csv",  # fund_id, title, text (factsheets, commentary)
+}
+
+# Declared column dtypes (skips type inference). Repeated ID/label columns are
+# dictionary-encoded as categoricals; they still compare equal to plain strings.
+TABLE_DTYPES = {
+    "funds": {"fund_id": "object", "internal_key": "object", "name": "object", "amc_id": "category",
+              "risk": "category", "primary_sector": "category", "description": "object"},
+    "fund_secondary_sectors": {"fund_id": "category", "sector_id": "category"},
+    "fund_related_factors": {"fund_id": "category", "factor_id": "category"},
+    "amcs": {"amc_id": "object", "name": "object", "aum_group": "category"},
+    "sectors": {"sector_id": "object", "name": "object", "description": "object", "sensitivity_notes": "object"},
+    "factors": {"factor_id": "object", "name": "object", "description": "object", "impact_direction": "object"},
+    "factor_affected_sectors": {"factor_id": "category", "sector_id": "category"},
+    "fund_documents": {"fund_id": "object", "title": "object", "text": "object"},
+}
+
+# Legacy module attributes (data_loader.funds_df, ...) -> table name
+_LEGACY_FRAMES = {
+    "funds_df": "funds",
+    "amcs_df": "amcs",
+    "sectors_df": "sectors",
+    "factors_df": "factors",
+    "fund_secondary_sectors_df": "fund_secondary_sectors",
+    "fund_related_factors_df": "fund_related_factors",
+    "factor_affected_sectors_df": "factor_affected_sectors",
+}
+
+
+def default_data_dir():
+    """Directory holding the CSVs (MF_RAG_DATA_DIR overrides the repo directory)."""
+    return os.getenv("MF_RAG_DATA_DIR") or _SCRIPT_DIR
+
+def table_paths(data_dir=None, include_optional=False):
+    """Returns {table_name: absolute CSV path} (optional tables only if asked for)."""
+    data_dir = data_dir or default_data_dir()
+    files = {**TABLE_FILES, **OPTIONAL_TABLE_FILES} if include_optional else TABLE_FILES
+    return {table: os.path.join(data_dir, filename) for table, filename in files.items()}
+
+def cache_dir_for(data_dir=None):
+    """Directory for build artifacts (snapshot, vectors, ...) of a data directory."""
+    return os.path.join(data_dir or default_data_dir(), ".cache")
+
+def snapshot_path_for(data_dir=None):
+    """The snapshot for the repo data lives in .cache/; other data dirs keep their own."""
+    data_dir = data_dir or default_data_dir()
+    if os.path.abspath(data_dir) == _SCRIPT_DIR:
+        return kb_snapshot.DEFAULT_SNAPSHOT_PATH
+    return os.path.join(cache_dir_for(data_dir), "kb_snapshot.arrow")
+
+def read_csv_table(table, data_dir=None):
+    """Parses one CSV with its declared dtypes. Raises on a missing (non-optional) file."""
+    path = table_paths(data_dir, include_optional=True)[table]
+    if table in OPTIONAL_TABLE_FILES and not os.path.exists(path):
+        return pd.DataFrame(columns=list(TABLE_DTYPES.get(table, {})))
+    return pd.read_csv(path, dtype=TABLE_DTYPES.get(table))
+
+def load_csv_tables(data_dir=None):
+    """Parses every CSV with its declared dtypes. Raises on missing files."""
+    return {table: read_csv_table(table, data_dir) for table in TABLE_FILES}
+
+def _file_signature(path):
+    """(size, mtime_ns) of a file, or None if it is missing."""
     try:
-        funds_df = pd.read_csv(os.path.join(_SCRIPT_DIR,"funds.csv"))
-        fund_secondary_sectors_df = pd.read_csv(os.path.join(_SCRIPT_DIR,"fund_secondary_sectors.csv"))
-        fund_related_factors_df = pd.read_csv(os.path.join(_SCRIPT_DIR,"fund_related_factors.csv"))
-        amcs_df = pd.read_csv(os.path.join(_SCRIPT_DIR,"amcs.csv"))
-        sectors_df = pd.read_csv(os.path.join(_SCRIPT_DIR,"sectors.csv"))
-        factors_df = pd.read_csv(os.path.join(_SCRIPT_DIR,"factors.csv"))
-        factor_affected_sectors_df = pd.read_csv(os.path.join(_SCRIPT_DIR,"factor_affected_sectors.csv"))
-
-        # Optional: Convert IDs to string if they might be mixed types or for easier merging
-        # funds_df['fund_id'] = funds_df['fund_id'].astype(str)
-        # amcs_df['amc_id'] = amcs_df['amc_id'].astype(str)
-        # ... etc.
-
-        print("Data loaded successfully from CSV files.")
-
-        return {
-            "funds": funds_df,
-            "fund_secondary_sectors": fund_secondary_sectors_df,
-            "fund_related_factors": fund_related_factors_df,
-            "amcs": amcs_df,
-            "sectors": sectors_df,
-            "factors": factors_df,
-            "factor_affected_sectors": factor_affected_sectors_df
-        }
-    except FileNotFoundError as e:
-        print(f"Error loading data: {e}. Make sure CSV files exist.")
-        # Handle error appropriately - maybe exit or return None
-        return None
-    except Exception as e:
-        print(f"An unexpected error occurred during data loading: {e}")
+        st = os.stat(path)
+    except OSError:
         return None
+    return (st.st_size, st.st_mtime_ns)
+
+def data_fingerprint(data_dir=None):
+    """
+    Returns a short hash of the CSV files' names, sizes and modification times.
+    Changes whenever any knowledge-base file is edited, so caches can invalidate.
+    """
+    h = hashlib.sha256()
+    for table, path in sorted(table_paths(data_dir).items()):
+        try:
+            st = os.stat(path)
+            h.update(f"{table}:{st.st_size}:{st.st_mtime_ns};".encode())
+        except OSError:
+            h.update(f"{table}:missing;".encode())
+    return h.hexdigest()[:16]
+
+
+class DataStore:
+    """
+    Thread-safe, lazily loaded set of knowledge-base tables.
+    Each table is read (from the snapshot if fresh, else its CSV) the first time
+    it is requested; derived indexes are built once per store via derived().
+    """
+
+    def __init__(self, data_dir=None, frames=None, use_snapshot=True):
+        self.data_dir = data_dir or default_data_dir()
+        self.use_snapshot = use_snapshot and frames is None
+        self._tables = dict(frames or {})
+        # Injected fixtures are complete: missing tables are treated as empty
+        self._fixture = frames is not None
+        self._derived = {}      # name -> (value, tables it depends on)
+        self._previous = {}     # name -> value from the version this store was refreshed from
+        self._signatures = {}   # table -> CSV (size, mtime_ns) when it was read
+        self._lock = threading.RLock()
+        self.load_stats = {}  # table -> {"source": ..., "seconds": ...}
+        self._snapshot_written = False
+        self.version = 1
+        self.shared = None      # shared_kb.SharedKB this store is attached to (None = private copy)
+        self._fingerprint = None  # data_fingerprint() of this version, computed on first use
+
+    @classmethod
+    def from_frames(cls, frames):
+        """Builds a store over in-memory DataFrames (e.g. small test fixtures)."""
+        return cls(frames=frames)
+
+    @classmethod
+    def attached(cls, shared, tables, derived, signatures):
+        """
+        Builds a store over tables and derived structures (name -> (value, depends_on))
+        that another process published (see shared_kb.attach). signatures are the
+        tables' CSV (size, mtime_ns) when they were published; the store's version is
+        the published version.
+        """
+        store = cls(shared.data_dir, use_snapshot=False)
+        store._tables.update(tables)
+        for name, (value, deps) in derived.items():
+            store._derived[name] = (value, frozenset(deps))
+        store._signatures.update(signatures)
+        store.load_stats = {name: {"source": "shared memory", "seconds": 0.0} for name in tables}
+        store.version = shared.version
+        store.shared = shared
+        return store
+
+    def fingerprint(self):
+        """
+        data_fingerprint() of the CSVs, computed once per store version: a reload
+        builds a new store, which derives it again. Caches compare it on every lookup.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = data_fingerprint(self.data_dir)
+        return self._fingerprint
+
+    def _load_table(self, name):
+        start = time.perf_counter()
+        # Signature taken before reading, so an edit made during the read is seen next poll
+        self._signatures[name] = _file_signature(table_paths(self.data_dir, include_optional=True)[name])
+        df, source = None, "CSV file"
+        if self.use_snapshot and name in TABLE_FILES:
+            paths = table_paths(self.data_dir)
+            loaded = kb_snapshot.load_snapshot({name: paths[name]}, snapshot_path_for(self.data_dir))
+            if loaded is not None:
+                df, source = loaded[name], "snapshot"
+        if df is None:
+            df = read_csv_table(name, self.data_dir)
+        self.load_stats[name] = {"source": source, "seconds": time.perf_counter() - start}
+        return df
+
+    def table(self, name):
+        """Returns one table, loading it on first access. Raises if it cannot be loaded."""
+        df = self._tables.get(name)
+        if df is not None:
+            return df
+        if name not in TABLE_FILES and name not in OPTIONAL_TABLE_FILES:
+            raise KeyError(f"Unknown knowledge-base table '{name}'")
+        with self._lock:
+            if name not in self._tables:
+                if self._fixture:
+                    self._tables[name] = pd.DataFrame()
+                else:
+                    self._tables[name] = self._load_table(name)
+            return self._tables[name]
+
+    def get_tables(self, names=None):
+        """
+        Returns {table_name: DataFrame} for the requested tables (all by default),
+        or None if any of them fails to load (the error is printed).
+        """
+        names = list(names or TABLE_FILES)
+        missing = [name for name in names if name not in self._tables]
+        start = time.perf_counter()
+        try:
+            tables = {name: self.table(name) for name in names}
+        except FileNotFoundError as e:
+            print(f"Error loading data: {e}. Make sure CSV files exist.")
+            return None
+        except Exception as e:
+            print(f"An unexpected error occurred during data loading: {e}")
+            return None
+        if missing and not self._fixture:
+            sources = sorted({self.load_stats[n]["source"] for n in missing if n in self.load_stats})
+            print(f"Data loaded successfully from {' + '.join(sources)} in {(time.perf_counter() - start) * 1000:.1f} ms.")
+        self._maybe_rebuild_snapshot()
+        return tables
+
+    def get_loaded_data(self):
+        """All tables as the classic loaded_data dict, or None if loading failed."""
+        return self.get_tables()
+
+    def _maybe_rebuild_snapshot(self):
+        """Rewrites the snapshot once every table is loaded and any came from CSV."""
+        if (not self.use_snapshot or kb_snapshot.pa is None
+                or os.getenv("KB_SNAPSHOT_AUTOBUILD", "1") == "0"):
+            return
+        with self._lock:
+            if any(name not in self._tables for name in TABLE_FILES):
+                return
+            if self._snapshot_written or all(self.load_stats.get(name, {}).get("source") == "snapshot" for name in TABLE_FILES):
+                return
+            try:
+                kb_snapshot.write_snapshot({name: self._tables[name] for name in TABLE_FILES}, table_paths(self.data_dir), snapshot_path_for(self.data_dir))
+            except Exception as e:
+                print(f"Warning: could not write knowledge-base snapshot: {e}")
+            # One attempt per store, whether or not it succeeded
+            self._snapshot_written = True
+
+    def derived(self, name, factory, depends_on=None):
+        """
+        Returns a structure derived from the tables, building it with factory(store)
+        on first use. Built once per store and shared by every caller.
+        depends_on names the tables it is built from (None = all); on a refresh it
+        is carried over to the new store version unless one of those tables changed.
+        """
+        entry = self._derived.get(name)
+        if entry is not None:
+            return entry[0]
+        with self._lock:
+            if name not in self._derived:
+                deps = frozenset(depends_on) if depends_on is not None else frozenset(TABLE_FILES)
+                self._derived[name] = (factory(self), deps)
+                self._previous.pop(name, None)
+            return self._derived[name][0]
+
+    def previous_derived(self, name):
+        """
+        The value a derived structure had in the store version this one was refreshed
+        from, when it had to be rebuilt (None otherwise). Lets a factory update the
+        old structure incrementally instead of building it from scratch.
+        """
+        return self._previous.get(name)
+
+    def table_signatures(self):
+        """{table: CSV (size, mtime_ns) when it was read} for the loaded tables."""
+        return dict(self._signatures)
+
+    def changed_tables(self, settle_seconds=0.0):
+        """
+        Returns the loaded tables whose CSV changed on disk since it was read.
+        Files modified less than settle_seconds ago are skipped (may still be being written).
+        """
+        changed = []
+        now_ns = time.time_ns()
+        for name, old_signature in list(self._signatures.items()):
+            signature = _file_signature(table_paths(self.data_dir, include_optional=True)[name])
+            if signature == old_signature:
+                continue
+            if signature is not None and now_ns - signature[1] < settle_seconds * 1e9:
+                continue
+            changed.append(name)
+        return changed
+
+    def carry_over(self, new_store, changed):
+        """
+        Copies this version's derived structures that do not depend on the changed tables
+        to new_store; the others become its previous_derived() values. Structures
+        new_store already holds are kept.
+        """
+        changed = set(changed)
+        with self._lock:
+            for name, (value, deps) in self._derived.items():
+                if name in new_store._derived:
+                    continue
+                if not deps & changed:
+                    new_store._derived[name] = (value, deps)
+                else:
+                    new_store._previous[name] = value
+            # Structures not rebuilt in this version keep the value they were last built with
+            for name, value in self._previous.items():
+                if name not in new_store._derived:
+                    new_store._previous.setdefault(name, value)
+
+    def refreshed(self, changed):
+        """
+        Returns a new store version with the changed tables reloaded and every
+        derived structure that does not depend on them carried over unchanged.
+        The changed tables are loaded eagerly, so the new store is complete before
+        it is published. Raises if a changed table cannot be read.
+        """
+        changed = set(changed)
+        new_store = DataStore(self.data_dir, use_snapshot=self.use_snapshot)
+        new_store.version = self.version + 1
+        with self._lock:
+            for name, df in self._tables.items():
+                if name not in changed:
+                    new_store._tables[name] = df
+                    new_store._signatures[name] = self._signatures.get(name)
+                    if name in self.load_stats:
+                        new_store.load_stats[name] = self.load_stats[name]
+            self.carry_over(new_store, changed)
+        for name in changed:
+            new_store._tables[name] = new_store._load_table(name)
+        return new_store
+
+
+# --- Process-wide store ---
+_store = None
+_store_lock = threading.Lock()
+# Store pinned for the current request (see pinned_store)
+_pinned_store = contextvars.ContextVar("pinned_store", default=None)
+
+def get_store():
+    """Returns the shared DataStore, creating it (without loading anything) on first use."""
+    global _store
+    pinned = _pinned_store.get()
+    if pinned is not None:
+        return pinned
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = DataStore()
+    return _store
+
+def store_fingerprint():
+    """Fingerprint of the current store version (see DataStore.fingerprint)."""
+    return get_store().fingerprint()
+
+def set_store(store):
+    """Replaces the shared store (e.g. with DataStore.from_frames(...) in tests); None resets it."""
+    global _store
+    with _store_lock:
+        _store = store
+
+@contextlib.contextmanager
+def pinned_store():
+    """
+    Pins the current store version for the duration of a request, so every lookup
+    inside it sees one consistent snapshot even if a hot reload swaps in a new one.
+    """
+    if _pinned_store.get() is not None:
+        yield _pinned_store.get()
+        return
+    token = _pinned_store.set(get_store())
+    try:
+        yield _pinned_store.get()
+    finally:
+        _pinned_store.reset(token)
+
+def refresh_if_changed(settle_seconds=0.5):
+    """
+    Reloads tables whose CSV changed and atomically swaps in the new store version.
+    Only indexes depending on the changed tables are rebuilt (lazily, on next use).
+    Returns the list of reloaded table names (empty if nothing changed or the reload failed).
+    """
+    global _store
+    with _store_lock:
+        current = _store
+        if current is None:
+            return []
+        if current.shared is not None:
+            # Attached to a shared snapshot: switch when a newer version is published
+            try:
+                new_store, changed = current.shared.refreshed(current, settle_seconds)
+            except Exception as e:
+                print(f"Warning: switching to the new shared knowledge base failed: {e}")
+                return []
+            if new_store is None:
+                return []
+        else:
+            changed = current.changed_tables(settle_seconds)
+            if not changed:
+                return []
+            try:
+                new_store = current.refreshed(changed)
+            except Exception as e:
+                # Keep serving the previous version; the next poll retries
+                print(f"Warning: hot reload of {', '.join(changed)} failed: {e}")
+                return []
+        _store = new_store
+    print(f"Knowledge base reloaded (version {new_store.version}): {', '.join(sorted(changed)) or 'no table'} changed.")
+    return changed
+
+_watcher = None
+_watcher_stop = threading.Event()
+
+def start_watcher(interval=2.0):
+    """Starts a daemon thread polling the CSV files and hot-reloading changes (idempotent)."""
+    global _watcher
+    with _store_lock:
+        if _watcher is not None and _watcher.is_alive():
+            return _watcher
+        _watcher_stop.clear()
+
+        def _watch():
+            while not _watcher_stop.wait(interval):
+                try:
+                    refresh_if_changed()
+                except Exception as e:
+                    print(f"Warning: knowledge-base watcher error: {e}")
+
+        _watcher = threading.Thread(target=_watch, name="kb-watcher", daemon=True)
+        _watcher.start()
+        return _watcher
+
+def stop_watcher():
+    """Stops the hot-reload watcher thread, if running."""
+    _watcher_stop.set()
+
+def load_data():
+    """Loads all data into Pandas DataFrames (dict of tables, or None on failure)."""
+    return get_store().get_loaded_data()
 
-# Load data once when the module is imported
-loaded_data = load_data()
-
-# Make individual dataframes accessible if needed directly (optional)
-if loaded_data:
-    funds_df = loaded_data["funds"]
-    amcs_df = loaded_data["amcs"]
-    sectors_df = loaded_data["sectors"]
-    factors_df = loaded_data["factors"]
-    fund_secondary_sectors_df = loaded_data["fund_secondary_sectors"]
-    fund_related_factors_df = loaded_data["fund_related_factors"]
-    factor_affected_sectors_df = loaded_data["factor_affected_sectors"]
-else:
-    # Define empty DataFrames or handle error if loading failed
-    funds_df = pd.DataFrame()
-    # ... etc.
\ No newline at end of file
+def __getattr__(name):
+    """Keeps `data_loader.loaded_data` / `data_loader.funds_df` working, loading on first access."""
+    if name == "loaded_data":
+        return load_data()
+    if name in _LEGACY_FRAMES:
+        data = load_data()
+        return data[_LEGACY_FRAMES[name]] if data else pd.DataFrame()
+    if name == "load_stats":
+        return get_store().load_stats
+    raise AttributeError(f"module 'data_loader' has no attribute '{name}'")
@@ -0,0 +1,229 @@
+# entity_matcher.py
+# Compiled Aho-Corasick automaton over every entity name and ID in the
+# knowledge base. Built once at load time; a single pass over the query
+# finds every entity mention (with spans) instead of one scan per table.
+# The automaton can be flattened into CSR arrays (to_arrays) that shared_kb
+# publishes once for all worker processes; SharedEntityMatcher walks them in place.
+import bisect
+from collections import deque, namedtuple
+
+import numpy as np
+
+import data_loader
+from kb_codes import StringArray, prefixed, unprefixed
+
+# One entity mention in a query. 'row' is the entity's row position in its
+# source table, used to keep the original "first row wins" priority.
+EntityMatch = namedtuple("EntityMatch", ["start", "end", "entity_type", "entity_id", "row", "text"])
+
+# Which columns are matched for each entity type, and which column is reported as its ID
+# (funds report internal_key because that is what graph_query.get_fund_details expects)
+ENTITY_SOURCES = [
+    # (entity_type, table, id column, columns matched against the query)
+    ("factor", "factors", "factor_id", ["name"]),
+    ("fund", "funds", "internal_key", ["name"]),
+    ("amc", "amcs", "amc_id", ["name", "amc_id"]),
+    ("sector", "sectors", "sector_id", ["name", "sector_id"]),
+]
+
+
+class EntityMatcher:
+    """Case-insensitive multi-pattern substring matcher (Aho-Corasick)."""
+
+    def __init__(self, patterns):
+        """
+        patterns: iterable of (text, entity_type, entity_id, row).
+        The same text may map to several entities (e.g. a sector whose name equals its ID).
+        """
+        self.payloads = []      # pattern index -> list of (entity_type, entity_id, row)
+        self.lengths = []       # pattern index -> pattern length
+        self._goto = [{}]       # state -> {char: next state}
+        self._fail = [0]
+        self._out = [[]]        # state -> pattern indices ending here (incl. via fail links)
+        pattern_ids = {}
+
+        for text, entity_type, entity_id, row in patterns:
+            if not isinstance(text, str) or not text:
+                continue
+            text = text.lower()
+            idx = pattern_ids.get(text)
+            if idx is None:
+                idx = pattern_ids[text] = len(self.payloads)
+                self.payloads.append([])
+                self.lengths.append(len(text))
+                self._insert(text, idx)
+            payload = (entity_type, entity_id, row)
+            if payload not in self.payloads[idx]:
+                self.payloads[idx].append(payload)
+        self._build_fail_links()
+
+    def _insert(self, text, idx):
+        state = 0
+        for ch in text:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append(idx)
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find_all(self, text):
+        """Returns every entity mention in text as EntityMatch tuples, ordered by end then start."""
+        matches = []
+        lowered = text.lower()
+        # Spans index the lowercased text; report the original wording when lengths agree
+        source = text if len(lowered) == len(text) else lowered
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for pos, ch in enumerate(lowered):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for idx in out[state]:
+                start = pos + 1 - self.lengths[idx]
+                for entity_type, entity_id, row in self.payloads[idx]:
+                    matches.append(EntityMatch(start, pos + 1, entity_type, entity_id, row, source[start:pos + 1]))
+        return matches
+
+    def to_arrays(self):
+        """
+        The automaton as flat arrays: per-state sorted transitions (CSR over code points),
+        fail links, per-state output patterns (CSR) and per-pattern payloads (CSR).
+        """
+        edges = [sorted((ord(ch), nxt) for ch, nxt in goto.items()) for goto in self._goto]
+        payloads = [payload for pattern in self.payloads for payload in pattern]
+        types = sorted({entity_type for entity_type, _, _ in payloads})
+        type_codes = {entity_type: code for code, entity_type in enumerate(types)}
+        return {
+            "edge_indptr": _indptr(len(state) for state in edges),
+            "edge_chars": np.array([c for state in edges for c, _ in state], dtype=np.int32),
+            "edge_targets": np.array([nxt for state in edges for _, nxt in state], dtype=np.int32),
+            "fail": np.array(self._fail, dtype=np.int32),
+            "out_indptr": _indptr(len(out) for out in self._out),
+            "out_patterns": np.array([idx for out in self._out for idx in out], dtype=np.int32),
+            "lengths": np.array(self.lengths, dtype=np.int32),
+            "payload_indptr": _indptr(len(pattern) for pattern in self.payloads),
+            "payload_types": np.array([type_codes[t] for t, _, _ in payloads], dtype=np.int8),
+            "payload_rows": np.array([row for _, _, row in payloads], dtype=np.int32),
+            **prefixed("payload_ids", StringArray.from_strings([entity_id for _, entity_id, _ in payloads]).to_arrays()),
+            **prefixed("types", StringArray.from_strings(types).to_arrays()),
+        }
+
+    def best_by_type(self, text, matches=None):
+        """
+        Returns {entity_type: EntityMatch} keeping, per type, the match with the lowest row.
+        matches may pass an earlier find_all(text) result to avoid a second pass.
+        """
+        best = {}
+        for match in (self.find_all(text) if matches is None else matches):
+            current = best.get(match.entity_type)
+            if current is None or match.row < current.row:
+                best[match.entity_type] = match
+        return best
+
+
+class SharedEntityMatcher(EntityMatcher):
+    """
+    EntityMatcher over the flat read-only arrays of EntityMatcher.to_arrays() (as
+    published by shared_kb): same matches, nothing rebuilt or copied per process.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        # memoryviews: per-character lookups index these without numpy scalar overhead
+        views = {name: memoryview(array) for name, array in arrays.items() if "/" not in name}
+        self._edge_indptr = views["edge_indptr"]
+        self._edge_chars = views["edge_chars"]
+        self._edge_targets = views["edge_targets"]
+        self._fail = views["fail"]
+        self._out_indptr = views["out_indptr"]
+        self._out_patterns = views["out_patterns"]
+        self.lengths = views["lengths"]
+        self._payload_indptr = views["payload_indptr"]
+        self._payload_types = views["payload_types"]
+        self._payload_rows = views["payload_rows"]
+        self._payload_ids = StringArray.from_arrays(unprefixed("payload_ids", arrays))
+        self._types = list(StringArray.from_arrays(unprefixed("types", arrays)))
+
+    def find_all(self, text):
+        """Returns every entity mention in text as EntityMatch tuples, ordered by end then start."""
+        matches = []
+        lowered = text.lower()
+        source = text if len(lowered) == len(text) else lowered
+        indptr, chars, targets, fail = self._edge_indptr, self._edge_chars, self._edge_targets, self._fail
+        out_indptr, out_patterns, lengths = self._out_indptr, self._out_patterns, self.lengths
+        payload_indptr = self._payload_indptr
+        state = 0
+        for pos, ch in enumerate(lowered):
+            code = ord(ch)
+            while True:
+                lo, hi = indptr[state], indptr[state + 1]
+                # Most states have a single transition; binary search the others
+                edge = lo if hi - lo == 1 else bisect.bisect_left(chars, code, lo, hi)
+                if edge < hi and chars[edge] == code:
+                    state = targets[edge]
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            first, last = out_indptr[state], out_indptr[state + 1]
+            if first == last:
+                continue
+            for k in range(first, last):
+                idx = out_patterns[k]
+                start = pos + 1 - lengths[idx]
+                for p in range(payload_indptr[idx], payload_indptr[idx + 1]):
+                    matches.append(EntityMatch(start, pos + 1, self._types[self._payload_types[p]],
+                                               self._payload_ids[p], self._payload_rows[p], source[start:pos + 1]))
+        return matches
+
+
+def _indptr(counts):
+    """CSR offsets (int64, one longer than counts) from per-row counts."""
+    counts = np.fromiter(counts, dtype=np.int64)
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr
+
+
+def build_entity_matcher(data):
+    """Builds an EntityMatcher over the factor, fund, AMC and sector tables."""
+    patterns = []
+    for entity_type, table, id_col, match_cols in ENTITY_SOURCES:
+        df = (data or {}).get(table)
+        if df is None or df.empty:
+            continue
+        ids = df[id_col].tolist()
+        for col in match_cols:
+            for row, (text, entity_id) in enumerate(zip(df[col].tolist(), ids)):
+                patterns.append((text, entity_type, entity_id, row))
+    return EntityMatcher(patterns)
+
+
+def get_entity_matcher(store=None):
+    """
+    Returns the matcher for the current (or given) knowledge-base store, compiling it on first use.
+    Raises RuntimeError if the entity tables cannot be loaded.
+    """
+    def _build(store):
+        tables = store.get_tables([table for _, table, _, _ in ENTITY_SOURCES])
+        if tables is None:
+            raise RuntimeError("Entity tables could not be loaded")
+        return build_entity_matcher(tables)
+    return (store or data_loader.get_store()).derived(
+        "entity_matcher", _build, depends_on=[table for _, table, _, _ in ENTITY_SOURCES])
@@ -0,0 +1,218 @@
+# factor_impact.py
+# Weighted, multi-hop factor exposure scores for every fund at once.
+# The graph is held as incidence matrices (factor x sector, sector x sector,
+# sector x fund, factor x fund) and a batch of factors is pushed through them
+# with matrix products instead of per-factor isin() filtering.
+# Funds reached only through a correlated sector (hop 2) hold nothing the factor
+# affects, so they are scored as a separate "indirect" tier, never mixed in with
+# directly exposed funds.
+import numpy as np
+import data_loader
+from kg_index import get_graph_index
+
+# Default edge weights (used when a link table has no 'weight' column)
+FACTOR_SECTOR_WEIGHT = 1.0   # factor -> typically affected sector
+DIRECT_FACTOR_WEIGHT = 1.0   # fund -> directly related factor
+PRIMARY_SECTOR_WEIGHT = 1.0  # fund -> primary sector
+SECONDARY_SECTOR_WEIGHT = 0.5  # fund -> secondary sector
+# Second-order hops (factor -> sector -> correlated sector -> fund) are damped by this
+CORRELATION_DECAY = 0.5
+# Exposure tiers: "direct" funds are linked to the factor or hold a sector it affects,
+# "indirect" funds are only reached through sectors commonly held alongside those
+DIRECT_TIER = "direct"
+INDIRECT_TIER = "indirect"
+
+
+class SparseRows:
+    """Minimal CSR matrix: row i holds columns indices[indptr[i]:indptr[i+1]]."""
+
+    def __init__(self, rows, cols, weights, n_rows, n_cols):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        order = np.lexsort((cols, rows))
+        rows, cols, weights = rows[order], cols[order], weights[order]
+        # Sum duplicate (row, col) links into a single entry
+        if len(rows):
+            keep = np.ones(len(rows), dtype=bool)
+            keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+            group = np.cumsum(keep) - 1
+            weights = np.bincount(group, weights=weights)
+            rows, cols = rows[keep], cols[keep]
+        self.shape = (n_rows, n_cols)
+        self.indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=self.indptr[1:])
+        self.indices = cols
+        self.data = weights
+
+    def row(self, i):
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def to_dense(self):
+        dense = np.zeros(self.shape, dtype=np.float64)
+        for i in range(self.shape[0]):
+            cols, weights = self.row(i)
+            dense[i, cols] = weights
+        return dense
+
+    def co_occurrence(self):
+        """
+        Returns the dense (n_rows x n_rows) count of columns each pair of rows shares,
+        i.e. B @ B.T for the binary pattern B, without materializing B.
+        """
+        n_rows = self.shape[0]
+        counts = np.zeros((n_rows, n_rows), dtype=np.float64)
+        rows = np.repeat(np.arange(n_rows), np.diff(self.indptr))
+        # Entries grouped by column; rows sharing a column sit next to each other
+        order = np.lexsort((rows, self.indices))
+        rows, cols = rows[order], self.indices[order]
+        np.add.at(counts, (rows, rows), 1.0)
+        for offset in range(1, len(cols)):
+            same = cols[offset:] == cols[:-offset]
+            if not same.any():
+                break
+            first, second = rows[:-offset][same], rows[offset:][same]
+            np.add.at(counts, (first, second), 1.0)
+            np.add.at(counts, (second, first), 1.0)
+        return counts
+
+    def left_multiply(self, dense):
+        """Returns dense @ self for a dense (k x n_rows) matrix."""
+        out = np.zeros((dense.shape[0], self.shape[1]), dtype=np.float64)
+        # Only rows with a non-zero input column contribute
+        for i in np.flatnonzero(np.any(dense != 0, axis=0)):
+            cols, weights = self.row(i)
+            if len(cols):
+                out[:, cols] += dense[:, i:i + 1] * weights
+        return out
+
+
+def _link_weights(df, n_links, default):
+    """Returns the optional 'weight' column of a link table as an array, or a constant."""
+    if df is not None and 'weight' in df.columns:
+        return df['weight'].fillna(default).to_numpy(dtype=np.float64)
+    return np.full(n_links, default, dtype=np.float64)
+
+
+class FactorImpactEngine:
+    """Precomputed incidence matrices for scoring fund exposure to factors."""
+
+    def __init__(self, index, data=None):
+        data = data or {}
+        self.index = index
+        n_funds = index.n_funds
+
+        # --- Matrix rows/columns are the index's dense sector and factor codes ---
+        n_sectors, n_factors = len(index.sectors), len(index.factors)
+
+        # --- factor x sector ---
+        weights = _link_weights(data.get("factor_affected_sectors"), len(index.affected_factor), FACTOR_SECTOR_WEIGHT)
+        valid = (index.affected_factor >= 0) & (index.affected_sector >= 0)
+        self.factor_sector = SparseRows(index.affected_factor[valid], index.affected_sector[valid], weights[valid],
+                                        n_factors, n_sectors).to_dense()
+
+        # --- sector x fund (primary + secondary holdings) ---
+        primary = np.flatnonzero(index.fund_primary_sector >= 0)
+        links, positions = self._fund_positions(index.secondary_fund, index.secondary_sector)
+        weights = _link_weights(data.get("fund_secondary_sectors"), len(index.secondary_fund), SECONDARY_SECTOR_WEIGHT)
+        self.sector_fund = SparseRows(
+            np.concatenate([index.fund_primary_sector[primary], index.secondary_sector[links]]),
+            np.concatenate([primary, positions]),
+            np.concatenate([np.full(len(primary), PRIMARY_SECTOR_WEIGHT), weights[links]]),
+            n_sectors, n_funds)
+
+        # --- factor x fund (direct links) ---
+        links, positions = self._fund_positions(index.related_fund, index.related_factor)
+        weights = _link_weights(data.get("fund_related_factors"), len(index.related_fund), DIRECT_FACTOR_WEIGHT)
+        self.factor_fund = SparseRows(index.related_factor[links], positions, weights[links], n_factors, n_funds)
+
+        # --- sector x sector correlation ---
+        # The knowledge base has no explicit correlation table, so sectors are
+        # correlated by how often funds hold them together (cosine of the
+        # binary sector x fund holdings), with the diagonal removed. The counts
+        # come straight from the sparse holdings (sectors x sectors stays small).
+        co_held = self.sector_fund.co_occurrence()
+        norms = np.sqrt(np.diag(co_held))
+        norms[norms == 0] = 1.0
+        self.sector_correlation = (co_held / np.outer(norms, norms)).astype(np.float64)
+        np.fill_diagonal(self.sector_correlation, 0.0)
+
+    def _fund_positions(self, fund_codes, other_codes):
+        """
+        Joins a link table (fund code, other code) to fund row positions:
+        returns (link row, fund position) arrays, one entry per fund row of each link.
+        """
+        links = np.flatnonzero((fund_codes >= 0) & (other_codes >= 0))
+        items, positions = self.index.fund_positions.expand(fund_codes[links])
+        return links[items], positions
+
+    def exposure_scores(self, factor_ids, max_hops=2):
+        """
+        Returns a (len(factor_ids) x n_funds) array of weighted exposure scores.
+        Hop 1 covers direct links and factor -> sector -> fund paths; hop 2 adds
+        factor -> sector -> correlated sector -> fund paths damped by CORRELATION_DECAY.
+        Unknown factor IDs get an all-zero row.
+        """
+        direct, indirect = self.exposure_tiers(factor_ids, max_hops)
+        return direct + indirect
+
+    def exposure_tiers(self, factor_ids, max_hops=2):
+        """
+        Splits exposure_scores() into (direct, indirect) arrays of the same shape.
+        A fund with any hop-1 exposure keeps its whole score (hop-2 paths included)
+        in direct; a fund reached only through hop-2 paths is scored in indirect.
+        """
+        n_funds = self.index.n_funds
+        known = [self.index.factors.code(f) for f in factor_ids]
+        sector_weights = np.zeros((len(factor_ids), len(self.index.sectors)), dtype=np.float64)
+        direct = np.zeros((len(factor_ids), n_funds), dtype=np.float64)
+        for row, pos in enumerate(known):
+            if pos < 0:
+                continue
+            sector_weights[row] = self.factor_sector[pos]
+            fund_cols, weights = self.factor_fund.row(pos)
+            direct[row, fund_cols] = weights
+        direct = direct + self.sector_fund.left_multiply(sector_weights)
+        indirect = np.zeros_like(direct)
+        if max_hops >= 2 and sector_weights.size:
+            correlated = CORRELATION_DECAY * (sector_weights @ self.sector_correlation)
+            second_hop = self.sector_fund.left_multiply(correlated)
+            reached = direct > 0
+            direct = np.where(reached, direct + second_hop, 0.0)
+            indirect = np.where(reached, 0.0, second_hop)
+        return direct, indirect
+
+    def top_funds(self, factor_id, top_k=None, max_hops=2, tier=DIRECT_TIER):
+        """
+        Returns [(fund_position, score)] of one exposure tier with score > 0,
+        highest first (ties in CSV order).
+        """
+        return self.ranked_tiers(factor_id, top_k=top_k, max_hops=max_hops)[tier]
+
+    def ranked_tiers(self, factor_id, top_k=None, max_hops=2):
+        """
+        top_funds() of both tiers from a single traversal:
+        returns {DIRECT_TIER: [(fund_position, score)], INDIRECT_TIER: [...]}.
+        """
+        direct, indirect = self.exposure_tiers([factor_id], max_hops=max_hops)
+        return {DIRECT_TIER: _top(direct[0], top_k), INDIRECT_TIER: _top(indirect[0], top_k)}
+
+
+def _top(scores, top_k):
+    """[(position, score)] of the positive scores, highest first (ties in position order)."""
+    candidates = np.flatnonzero(scores > 0)
+    if top_k is not None and len(candidates) > top_k:
+        # Partial selection first, then an exact sort of the survivors
+        cutoff = np.partition(scores[candidates], len(candidates) - top_k)[len(candidates) - top_k]
+        candidates = candidates[scores[candidates] >= cutoff]
+    order = np.lexsort((candidates, -scores[candidates]))
+    ranked = candidates[order]
+    if top_k is not None:
+        ranked = ranked[:top_k]
+    return [(int(pos), float(scores[pos])) for pos in ranked]
+
+def get_impact_engine():
+    """Returns the engine for the current knowledge base, building it on first use."""
+    return data_loader.get_store().derived(
+        "impact_engine", lambda store: FactorImpactEngine(get_graph_index(store), store.get_loaded_data()))
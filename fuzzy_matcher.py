@@ -0,0 +1,353 @@
+# fuzzy_matcher.py
+# Typo-tolerant entity resolution for queries the exact matcher (entity_matcher)
+# misses: "Fund A growth", "alpha managment", "AMCX", "crude prices".
+# Every entity name and ID is normalized to its compact form (lowercase letters
+# and digits only, so spacing, case and punctuation do not matter) and indexed by
+# character trigrams in CSR posting lists, built once per knowledge base.
+# A query is split into word spans; each span only looks up the postings of its
+# rarest trigrams (prefix filtering: a candidate scoring above the threshold must
+# share at least one of them), and candidates are then scored exactly by trigram
+# overlap. Common trigrams shared by thousands of fund names are never scanned:
+# when the exact prefix would list too many aliases (long names made of common
+# words), a few rare trigrams far enough apart that one typo cannot change two of
+# them are looked up instead, and only aliases containing several are scored.
+# Longer spans are tried first; a sub-span of a confident match is not scored.
+# The index exports to flat arrays (to_arrays) that shared_kb publishes once for
+# every worker process.
+import re
+from collections import namedtuple
+
+import numpy as np
+
+import data_loader
+from entity_matcher import ENTITY_SOURCES
+from kb_codes import StringArray, prefixed, unprefixed
+
+# Candidates below this score are not reported (FuzzyMatcher.resolve min_score default)
+MIN_SCORE = 0.55
+# Longest query span (in words) compared against entity names
+MAX_SPAN_WORDS = 8
+# Most aliases scored per span (the exact prefix lookup is used while it lists no more)
+MAX_CANDIDATES = 300
+# Otherwise a span is seeded with this many rare trigrams (at most MAX_SEED_POSTINGS postings)
+# and only aliases containing MIN_SEED_HITS of them are scored
+SEED_GRAMS = 4
+MIN_SEED_HITS = 2
+MAX_SEED_POSTINGS = 20000
+# A best candidate within this score of a different entity is ambiguous (confidence halved)
+AMBIGUITY_MARGIN = 0.03
+# Spans may not start or end with these words (question words and intent verbs/plurals
+# that never begin or end an entity name)
+EDGE_STOPWORDS = frozenset("""
+a an and are about any by can details do does for from give how i in info information is it
+list me my of on or show tell than that the their these this to under what which who with
+funds amcs sectors factors affect affected affects impact impacted invest investing managed
+manage manages portfolio related sensitive
+""".split())
+# Spans made only of these (and stop) words are skipped: they are intent keywords, not names
+INTENT_WORDS = frozenset("fund amc sector factor risk risky high medium low".split())
+
+# One resolved mention: same fields as entity_matcher.EntityMatch plus the confidence score
+FuzzyMatch = namedtuple("FuzzyMatch", ["start", "end", "entity_type", "entity_id", "row", "text", "score"])
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def compact(text):
+    """Lowercase letters and digits only: 'Fund A-Growth' -> 'fundagrowth'."""
+    return _NON_ALNUM.sub("", text.lower())
+
+
+def trigrams(text):
+    """Character trigrams of a compact string, with ^/$ marking its start and end."""
+    padded = f"^{text}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _score(overlap, n_span, n_alias):
+    """Mean of Dice similarity and how much of the span the alias covers (partial names)."""
+    return 0.5 * (2.0 * overlap / (n_span + n_alias)) + 0.5 * (overlap / n_span)
+
+
+def _min_overlap(n_span, min_score):
+    """Fewest shared trigrams that can still reach min_score (best case: alias = shared grams)."""
+    for overlap in range(1, n_span + 1):
+        if _score(overlap, n_span, overlap) >= min_score:
+            return overlap
+    return n_span + 1
+
+
+class FuzzyMatcher:
+    """Trigram index over the compact form of every entity alias (names and IDs)."""
+
+    def __init__(self, aliases):
+        """aliases: iterable of (text, entity_type, entity_id, row)."""
+        self.alias_entities = []   # alias -> (entity_type, entity_id, row)
+        self.alias_texts = []      # alias -> original text
+        self.alias_sizes = []      # alias -> number of trigrams
+        self.gram_ids = {}         # trigram -> gram id
+        seen = set()
+        alias_grams = []
+        for text, entity_type, entity_id, row in aliases:
+            if not isinstance(text, str):
+                continue
+            key = compact(text)
+            if len(key) < 2 or (key, entity_type, entity_id) in seen:
+                continue
+            seen.add((key, entity_type, entity_id))
+            grams = sorted(self.gram_ids.setdefault(gram, len(self.gram_ids)) for gram in sorted(trigrams(key)))
+            alias_grams.append(grams)
+            self.alias_entities.append((entity_type, entity_id, row))
+            self.alias_texts.append(text)
+            self.alias_sizes.append(len(grams))
+
+        # CSR alias -> grams (for scoring) and gram -> aliases (posting lists)
+        sizes = np.asarray(self.alias_sizes, dtype=np.int64)
+        self.alias_indptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.alias_indptr[1:])
+        self.alias_grams = np.fromiter((g for grams in alias_grams for g in grams), dtype=np.int32,
+                                       count=int(self.alias_indptr[-1]))
+        owners = np.repeat(np.arange(len(sizes), dtype=np.int32), sizes)
+        order = np.argsort(self.alias_grams, kind="stable")
+        self.postings = owners[order]
+        self.posting_indptr = np.zeros(len(self.gram_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.alias_grams, minlength=len(self.gram_ids)), out=self.posting_indptr[1:])
+        self.gram_df = np.diff(self.posting_indptr).tolist()
+        self.sizes = sizes
+        self._size_ranges = {}
+
+    def __len__(self):
+        return len(self.alias_entities)
+
+    def to_arrays(self):
+        """CSR postings, alias grams and sizes plus the alias entities and texts as flat arrays."""
+        types = sorted({entity_type for entity_type, _, _ in self.alias_entities})
+        type_codes = {entity_type: code for code, entity_type in enumerate(types)}
+        grams = sorted(self.gram_ids, key=self.gram_ids.get)
+        return {
+            "alias_indptr": self.alias_indptr, "alias_grams": self.alias_grams,
+            "postings": self.postings, "posting_indptr": self.posting_indptr, "sizes": self.sizes,
+            "alias_types": np.array([type_codes[t] for t, _, _ in self.alias_entities], dtype=np.int8),
+            "alias_rows": np.array([row for _, _, row in self.alias_entities], dtype=np.int32),
+            **prefixed("alias_ids", StringArray.from_strings([entity_id for _, entity_id, _ in self.alias_entities]).to_arrays()),
+            **prefixed("alias_texts", StringArray.from_strings(self.alias_texts).to_arrays()),
+            **prefixed("grams", StringArray.from_strings(grams).to_arrays()),
+            **prefixed("types", StringArray.from_strings(types).to_arrays()),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Read-only matcher over to_arrays() output; only the trigram dictionary is rebuilt."""
+        matcher = cls.__new__(cls)
+        for name in ("alias_indptr", "alias_grams", "postings", "posting_indptr", "sizes"):
+            setattr(matcher, name, arrays[name])
+        matcher.alias_entities = _AliasEntities(arrays)
+        matcher.alias_texts = StringArray.from_arrays(unprefixed("alias_texts", arrays))
+        matcher.gram_ids = {gram: gram_id for gram_id, gram in enumerate(StringArray.from_arrays(unprefixed("grams", arrays)))}
+        matcher.gram_df = np.diff(matcher.posting_indptr).tolist()
+        matcher._size_ranges = {}
+        return matcher
+
+    def _span_candidates(self, key, min_score):
+        """[(score, alias)] for one compact span, best first (empty if too unspecific)."""
+        padded = f"^{key}$"
+        grams = {}
+        for pos in range(len(padded) - 2):
+            grams.setdefault(padded[pos:pos + 3], pos)
+        n_span = len(grams)
+        # Unknown trigrams (df 0) are the rarest of all and contribute no postings
+        ids = [(self.gram_ids.get(gram, -1), pos) for gram, pos in grams.items()]
+        gram_df = self.gram_df
+        dfs = sorted((gram_df[g] if g >= 0 else 0, g, pos) for g, pos in ids)
+        prefix = n_span - _min_overlap(n_span, min_score) + 1
+        if sum(df for df, _, _ in dfs[:prefix]) <= MAX_CANDIDATES:
+            # Exact: every alias that can reach min_score shares one of the prefix grams
+            candidates = self._merge([g for df, g, _ in dfs[:prefix] if df], 1)
+        else:
+            # Too many aliases share the prefix: seed with rare grams at least three
+            # positions apart (a typo changes at most three consecutive trigrams, so it
+            # removes one seed at most) and keep aliases that contain several seeds
+            seeds, seed_pos, total = [], [], 0
+            for df, g, pos in dfs:
+                if not df or any(abs(pos - p) < 3 for p in seed_pos):
+                    continue
+                total += df
+                if total > MAX_SEED_POSTINGS:
+                    break
+                seeds.append(g)
+                seed_pos.append(pos)
+                if len(seeds) == SEED_GRAMS:
+                    break
+            candidates = self._merge(seeds, min(MIN_SEED_HITS, len(seeds)))
+        if not len(candidates):
+            return []
+        # Length filter: drop aliases that could not reach min_score even if all their grams matched
+        lo, hi = self._size_range(n_span, min_score)
+        sizes = self.sizes[candidates]
+        fits = (sizes >= lo) & (sizes <= hi)
+        if not fits.all():
+            candidates, sizes = candidates[fits], sizes[fits]
+            if not len(candidates):
+                return []
+        if len(candidates) > MAX_CANDIDATES:
+            # Closest in size to the span first (for equal overlap they score best)
+            keep = np.sort(np.argsort(np.abs(sizes - n_span), kind="stable")[:MAX_CANDIDATES])
+            candidates, sizes = candidates[keep], sizes[keep]
+        starts = self.alias_indptr[candidates]
+
+        # Overlap of every candidate with the span, counted in one vectorized pass
+        known = np.zeros(len(self.gram_ids), dtype=bool)
+        known[[g for g, _ in ids if g >= 0]] = True
+        flat = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes - starts, sizes)
+        overlap = np.add.reduceat(known[self.alias_grams[flat]], np.cumsum(sizes) - sizes)
+        scores = 0.5 * (2.0 * overlap / (n_span + sizes)) + 0.5 * (overlap / n_span)
+        keep = np.flatnonzero(scores >= min_score)
+        order = keep[np.lexsort((candidates[keep], -scores[keep]))]
+        return list(zip(scores[order].tolist(), candidates[order].tolist()))
+
+    def _merge(self, gram_ids, min_hits):
+        """Sorted aliases found in at least min_hits of the posting lists of gram_ids."""
+        postings = [self.postings[self.posting_indptr[g]:self.posting_indptr[g + 1]] for g in gram_ids]
+        if not postings:
+            return np.zeros(0, dtype=np.int32)
+        if len(postings) == 1:
+            return postings[0]
+        # Posting lists are sorted and duplicate-free: count each alias's run after merging
+        merged = np.sort(np.concatenate(postings), kind="stable")
+        firsts = np.flatnonzero(np.concatenate(([True], merged[1:] != merged[:-1])))
+        if min_hits <= 1:
+            return merged[firsts]
+        hits = np.diff(np.append(firsts, len(merged)))
+        return merged[firsts[hits >= min_hits]]
+
+    def _size_range(self, n_span, min_score):
+        """Alias sizes (in trigrams) that can reach min_score against a span of n_span trigrams."""
+        key = (n_span, min_score)
+        if key not in self._size_ranges:
+            # The bound rises up to size == n_span and falls after it
+            lo = next((size for size in range(1, n_span + 1) if _score(size, n_span, size) >= min_score), None)
+            hi = n_span
+            while lo is not None and _score(n_span, n_span, hi + 1) >= min_score:
+                hi += 1
+            self._size_ranges[key] = (lo, hi) if lo is not None else (1, 0)
+        return self._size_ranges[key]
+
+    def _confidence(self, scored):
+        """Best candidate's score, halved when a different entity scores nearly as well."""
+        best_score, best = scored[0]
+        entity = self.alias_entities[best][:2]
+        for score, alias in scored[1:]:
+            if best_score - score > AMBIGUITY_MARGIN:
+                break
+            if self.alias_entities[alias][:2] != entity:
+                return best_score / 2
+        return best_score
+
+    def lookup(self, text, entity_type=None, limit=5, min_score=MIN_SCORE):
+        """
+        Candidates for a single name: a list of (score, entity_type, entity_id, alias text),
+        best first, one per entity.
+        """
+        key = compact(text)
+        if len(key) < 2:
+            return []
+        results, seen = [], set()
+        for score, alias in self._span_candidates(key, min_score):
+            etype, entity_id, _ = self.alias_entities[alias]
+            if (entity_type and etype != entity_type) or (etype, entity_id) in seen:
+                continue
+            seen.add((etype, entity_id))
+            results.append((round(score, 3), etype, entity_id, self.alias_texts[alias]))
+            if len(results) >= limit:
+                break
+        return results
+
+    def resolve(self, query_lower, min_score=MIN_SCORE):
+        """
+        Entity mentions in a query as FuzzyMatch tuples (non-overlapping, at most one
+        per entity). Score is the confidence in [0, 1]; mentions are ordered by confidence
+        times the length of the span they explain, so "delta automobile incme fund" is
+        one fund rather than the sector inside its name.
+        """
+        words = [(m.group(), m.start(), m.end()) for m in _WORD_PATTERN.finditer(query_lower)]
+        spans = []
+        for i in range(len(words)):
+            if words[i][0] in EDGE_STOPWORDS:
+                continue
+            for j in range(i, min(len(words), i + MAX_SPAN_WORDS)):
+                span_words = [w for w, _, _ in words[i:j + 1]]
+                if span_words[-1] in EDGE_STOPWORDS or all(w in INTENT_WORDS or w in EDGE_STOPWORDS for w in span_words):
+                    continue
+                key = "".join(span_words)
+                if len(key) >= 3:
+                    spans.append((key, words[i][1], words[j][2]))
+
+        # Longest spans first: a span can weigh at most its length (confidence 1), so once an
+        # overlapping span has matched with a higher weight it cannot win and is not scored
+        found = []
+        for key, start, end in sorted(spans, key=lambda span: -len(span[0])):
+            if any(weight >= len(key) and start < f_end and f_start < end for weight, _, f_start, f_end, _ in found):
+                continue
+            scored = self._span_candidates(key, min_score)
+            if not scored:
+                continue
+            confidence = self._confidence(scored)
+            if confidence >= min_score:
+                found.append((confidence * len(key), confidence, start, end, scored[0][1]))
+
+        # Greedy: best spans first, skipping overlaps and entities already taken
+        matches, taken = [], set()
+        for _, confidence, start, end, alias in sorted(found, key=lambda item: (-item[0], item[2])):
+            entity_type, entity_id, row = self.alias_entities[alias]
+            if (entity_type, entity_id) in taken or any(start < m.end and m.start < end for m in matches):
+                continue
+            taken.add((entity_type, entity_id))
+            matches.append(FuzzyMatch(start, end, entity_type, entity_id, row, query_lower[start:end],
+                                      round(confidence, 3)))
+        return matches
+
+
+class _AliasEntities:
+    """Read-only alias -> (entity_type, entity_id, row) sequence over FuzzyMatcher.to_arrays() output."""
+
+    def __init__(self, arrays):
+        self._types = list(StringArray.from_arrays(unprefixed("types", arrays)))
+        self._type_codes = memoryview(arrays["alias_types"])
+        self._rows = memoryview(arrays["alias_rows"])
+        self._ids = StringArray.from_arrays(unprefixed("alias_ids", arrays))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, alias):
+        return self._types[self._type_codes[alias]], self._ids[alias], self._rows[alias]
+
+
+def build_fuzzy_matcher(data):
+    """Builds a FuzzyMatcher over the same names and IDs the exact matcher uses."""
+    aliases = []
+    for entity_type, table, id_col, match_cols in ENTITY_SOURCES:
+        df = (data or {}).get(table)
+        if df is None or df.empty:
+            continue
+        ids = df[id_col].tolist()
+        for col in match_cols:
+            for row, (text, entity_id) in enumerate(zip(df[col].tolist(), ids)):
+                aliases.append((text, entity_type, entity_id, row))
+    return FuzzyMatcher(aliases)
+
+
+def get_fuzzy_matcher(store=None):
+    """
+    Returns the fuzzy matcher for the current (or given) knowledge-base store, building it on first use.
+    Raises RuntimeError if the entity tables cannot be loaded.
+    """
+    tables = [table for _, table, _, _ in ENTITY_SOURCES]
+
+    def _build(store):
+        loaded = store.get_tables(tables)
+        if loaded is None:
+            raise RuntimeError("Entity tables could not be loaded")
+        return build_fuzzy_matcher(loaded)
+    return (store or data_loader.get_store()).derived("fuzzy_matcher", _build, depends_on=tables)
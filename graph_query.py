@@ -1,115 +1,165 @@
 # graph_query.py
-# Import the loaded dataframes from data_loader
-from data_loader import (
-    funds_df, amcs_df, sectors_df, factors_df,
-    fund_secondary_sectors_df, fund_related_factors_df,
-    factor_affected_sectors_df, loaded_data # Also import loaded_data dict if needed
-)
-import pandas as pd
+# Query functions are thin wrappers over the precomputed KnowledgeGraphIndex,
+# so each lookup costs O(degree) instead of a scan over the DataFrames.
+# IDs are translated to integer codes once per call; filters and joins run on int32 arrays.
+import numpy as np
+
+from kb_codes import normalize_category
+from kg_index import get_graph_index
+from factor_impact import DIRECT_TIER, INDIRECT_TIER, get_impact_engine
+from query_planner import execute_constraints
+# Each query's latency is recorded as stage graph_query.<function>
+from metrics import timed_function
 
 # Helper function to convert DataFrame rows to dictionaries (for compatibility)
 def df_to_dict_list(df):
     return df.to_dict('records')
 
-# --- Rewritten Query Functions ---
+# --- Query Functions ---
 
+@timed_function("graph_query.get_fund_details")
 def get_fund_details(fund_internal_key):
     """Returns details for a specific fund given its original internal key."""
-    if funds_df.empty: return None
-    fund_series = funds_df[funds_df['internal_key'] == fund_internal_key]
-    if not fund_series.empty:
-        fund_dict = fund_series.iloc[0].to_dict()
-        # Add back related lists (optional, could be done in context_builder)
-        fund_id = fund_dict['fund_id']
-        sec_sectors = fund_secondary_sectors_df[fund_secondary_sectors_df['fund_id'] == fund_id]['sector_id'].tolist()
-        rel_factors = fund_related_factors_df[fund_related_factors_df['fund_id'] == fund_id]['factor_id'].tolist()
-        fund_dict['secondary_sectors'] = sec_sectors
-        fund_dict['related_factors'] = rel_factors
-        return fund_dict
-    return None
-
+    graph_index = get_graph_index()
+    pos = graph_index.fund_position_by_key.get(fund_internal_key)
+    if pos is None: return None
+    return fund_details_at(graph_index, pos)
+
+def fund_details_at(graph_index, pos):
+    """The fund row at a position with its secondary sectors and related factors added."""
+    fund_dict = graph_index.fund_record(pos)
+    # Add back related lists (optional, could be done in context_builder)
+    fund_code = graph_index.fund_code[pos]
+    fund_dict['secondary_sectors'] = graph_index.sectors.decode(graph_index.fund_sectors.neighbors(fund_code))
+    fund_dict['related_factors'] = graph_index.factors.decode(graph_index.fund_factors.neighbors(fund_code))
+    return fund_dict
+
+@timed_function("graph_query.get_amc_details")
 def get_amc_details(amc_id):
     """Returns details for a specific AMC ID."""
-    if amcs_df.empty: return None
-    amc_series = amcs_df[amcs_df['amc_id'] == amc_id]
-    return amc_series.iloc[0].to_dict() if not amc_series.empty else None
+    graph_index = get_graph_index()
+    amc = graph_index.amc_records.get(amc_id)
+    return dict(amc) if amc is not None else None
 
+@timed_function("graph_query.get_sector_details")
 def get_sector_details(sector_id):
     """Returns details for a specific Sector ID."""
-    if sectors_df.empty: return None
-    sector_series = sectors_df[sectors_df['sector_id'] == sector_id]
-    return sector_series.iloc[0].to_dict() if not sector_series.empty else None
+    graph_index = get_graph_index()
+    sector = graph_index.sector_records.get(sector_id)
+    return dict(sector) if sector is not None else None
 
+@timed_function("graph_query.get_factor_details")
 def get_factor_details(factor_id):
      """Returns details for a specific Factor ID."""
-     if factors_df.empty: return None
-     factor_series = factors_df[factors_df['factor_id'] == factor_id]
-     if not factor_series.empty:
-         factor_dict = factor_series.iloc[0].to_dict()
-         # Add back affected sectors
-         affected_sectors = factor_affected_sectors_df[factor_affected_sectors_df['factor_id'] == factor_id]['sector_id'].tolist()
-         factor_dict['typically_affected_sectors'] = affected_sectors
-         return factor_dict
-     return None
-
+     return factor_details_for(get_graph_index(), factor_id)
+
+def factor_details_for(graph_index, factor_id):
+     """The factor row with its typically affected sectors added (None if unknown)."""
+     factor = graph_index.factor_records.get(factor_id)
+     if factor is None: return None
+     factor_dict = dict(factor)
+     # Add back affected sectors
+     sector_codes = graph_index.factor_sectors.neighbors(graph_index.factors.code(factor_id))
+     factor_dict['typically_affected_sectors'] = graph_index.sectors.decode(sector_codes)
+     return factor_dict
+
+def amc_fund_positions(graph_index, amc_id):
+    """Row positions of the funds managed by an AMC, in CSV order."""
+    return graph_index.amc_funds.neighbors(graph_index.amcs.code(amc_id))
+
+def sector_fund_positions(graph_index, sector_id):
+    """Row positions of the funds holding a sector: primary holdings first, then secondary ones."""
+    sector_code = graph_index.sectors.code(sector_id)
+    # Funds where it's primary (CSV order), then funds where it's secondary
+    primary_positions = graph_index.primary_sector_funds.neighbors(sector_code)
+    secondary_positions = graph_index.positions_for_fund_codes(graph_index.sector_funds.neighbors(sector_code))
+    # Combine and remove duplicates (by fund code, first occurrence wins)
+    combined = np.concatenate([primary_positions, secondary_positions])
+    _, first = np.unique(graph_index.fund_code[combined], return_index=True)
+    return combined[np.sort(first)]
+
+def risk_fund_positions(graph_index, risk_level):
+    """Row positions of the funds with a risk level (case-insensitive), in CSV order."""
+    return graph_index.risk_funds.neighbors(graph_index.risks.code(normalize_category(risk_level)))
+
+@timed_function("graph_query.find_funds_by_amc")
 def find_funds_by_amc(amc_id):
     """Finds all funds managed by a specific AMC ID."""
-    if funds_df.empty: return []
-    result_df = funds_df[funds_df['amc_id'] == amc_id]
-    return df_to_dict_list(result_df)
+    graph_index = get_graph_index()
+    return graph_index.funds_at(amc_fund_positions(graph_index, amc_id))
 
+@timed_function("graph_query.find_funds_by_sector")
 def find_funds_by_sector(sector_id):
     """Finds all funds investing significantly in a specific sector ID."""
-    if funds_df.empty or fund_secondary_sectors_df.empty: return []
-    # Funds where it's primary
-    primary_funds_df = funds_df[funds_df['primary_sector'] == sector_id]
-    # Fund IDs where it's secondary
-    secondary_fund_ids = fund_secondary_sectors_df[fund_secondary_sectors_df['sector_id'] == sector_id]['fund_id'].unique()
-    secondary_funds_df = funds_df[funds_df['fund_id'].isin(secondary_fund_ids)]
-    # Combine and remove duplicates
-    combined_df = pd.concat([primary_funds_df, secondary_funds_df]).drop_duplicates(subset=['fund_id'])
-    return df_to_dict_list(combined_df)
+    graph_index = get_graph_index()
+    return graph_index.funds_at(sector_fund_positions(graph_index, sector_id))
 
+@timed_function("graph_query.find_funds_related_to_factor")
 def find_funds_related_to_factor(factor_id):
     """Finds funds related to a factor (directly or via sectors)."""
-    if not loaded_data: return [] # Check if data loading failed
-
-    # Use the pre-loaded DataFrames directly
-    _funds = loaded_data["funds"]
-    _fund_related = loaded_data["fund_related_factors"]
-    _factor_affected = loaded_data["factor_affected_sectors"]
-    _fund_secondary = loaded_data["fund_secondary_sectors"]
-
-    if _funds.empty: return []
-
-    related_fund_ids = set()
-
-    # 1. Direct link check
-    direct_link_ids = _fund_related[_fund_related['factor_id'] == factor_id]['fund_id'].unique()
-    related_fund_ids.update(direct_link_ids)
-
-    # 2. Indirect link via sector sensitivity check
-    affected_sectors_ids = _factor_affected[_factor_affected['factor_id'] == factor_id]['sector_id'].unique()
-
-    if len(affected_sectors_ids) > 0:
-        # Find funds where primary sector is affected
-        primary_sector_funds = _funds[_funds['primary_sector'].isin(affected_sectors_ids)]['fund_id'].unique()
-        related_fund_ids.update(primary_sector_funds)
-
-        # Find funds where a secondary sector is affected
-        secondary_link_fund_ids = _fund_secondary[_fund_secondary['sector_id'].isin(affected_sectors_ids)]['fund_id'].unique()
-        related_fund_ids.update(secondary_link_fund_ids)
-
-    # Retrieve full details for the unique fund IDs
-    if not related_fund_ids:
-        return []
-    final_funds_df = _funds[_funds['fund_id'].isin(list(related_fund_ids))]
-    return df_to_dict_list(final_funds_df)
-
-
+    graph_index = get_graph_index()
+    # Direct links plus funds holding a sector the factor affects
+    related = graph_index.factor_fund_codes(graph_index.factors.code(factor_id))
+
+    # Retrieve full details for the related fund codes (CSV order)
+    return graph_index.funds_at(graph_index.positions_for_fund_codes(np.flatnonzero(related)))
+
+@timed_function("graph_query.rank_funds_by_factor")
+def rank_funds_by_factor(factor_id, top_k=None, max_hops=2, tier=DIRECT_TIER):
+    """
+    Returns funds ranked by weighted exposure to a factor, most exposed first.
+    Each fund dict carries an 'exposure_score' and its 'exposure_tier'; max_hops=2
+    also follows factor -> sector -> correlated sector -> fund paths.
+    tier='direct' (default) lists funds linked to the factor or holding a sector it
+    affects; tier='indirect' lists the funds reached only through correlated sectors.
+    """
+    ranked = get_impact_engine().top_funds(factor_id, top_k=top_k, max_hops=max_hops, tier=tier)
+    return _exposed_funds(ranked, tier)
+
+
+@timed_function("graph_query.rank_funds_by_factor_tiers")
+def rank_funds_by_factor_tiers(factor_id, top_k=None, max_hops=2):
+    """
+    rank_funds_by_factor() for both tiers from one traversal of the graph:
+    returns (direct_funds, indirect_funds).
+    """
+    ranked = get_impact_engine().ranked_tiers(factor_id, top_k=top_k, max_hops=max_hops)
+    return _exposed_funds(ranked[DIRECT_TIER], DIRECT_TIER), _exposed_funds(ranked[INDIRECT_TIER], INDIRECT_TIER)
+
+
+def _exposed_funds(ranked, tier):
+    """Fund dicts for [(fund_position, score)], tagged with their score and tier."""
+    funds = get_graph_index().funds_at([pos for pos, _ in ranked])
+    for fund, (_, score) in zip(funds, ranked):
+        fund['exposure_score'] = round(score, 4)
+        fund['exposure_tier'] = tier
+    return funds
+
+
+@timed_function("graph_query.find_funds_by_risk")
 def find_funds_by_risk(risk_level):
     """Finds funds matching a specific risk level (case-insensitive)."""
-    if funds_df.empty: return []
-    # Ensure comparison is case-insensitive
-    result_df = funds_df[funds_df['risk'].str.lower() == risk_level.lower()]
-    return df_to_dict_list(result_df)
\ No newline at end of file
+    graph_index = get_graph_index()
+    return graph_index.funds_at(risk_fund_positions(graph_index, risk_level))
+
+
+@timed_function("graph_query.find_funds_by_constraints")
+def find_funds_by_constraints(constraints, max_hops=2):
+    """
+    Finds funds matching a compound query: constraints are (kind, value) pairs
+    (kinds: risk, sector, amc, factor); values of one kind are OR-ed, kinds are AND-ed.
+    With factor constraints the funds are ranked by summed exposure ('exposure_score'),
+    otherwise they come back in CSV order.
+    Returns (funds, plan_steps) where plan_steps are query_planner.PlanStep tuples.
+    """
+    graph_index = get_graph_index()
+    positions, steps = execute_constraints(constraints)
+    factor_ids = [value for kind, value in constraints if kind == "factor"]
+    if not factor_ids or not len(positions):
+        return graph_index.funds_at(positions), steps
+    scores = get_impact_engine().exposure_scores(factor_ids, max_hops=max_hops).sum(axis=0)[positions]
+    order = np.lexsort((positions, -scores))
+    funds = graph_index.funds_at(positions[order])
+    for fund, score in zip(funds, scores[order].tolist()):
+        fund['exposure_score'] = round(score, 4)
+    return funds, steps
@@ -0,0 +1,321 @@
+# intent_classifier.py
+# Learned intent classifier used by intent_parser before its keyword rules.
+# Entity mentions found by the matchers are replaced by their type ("which funds
+# are hurt by _factor_"), so the model learns how intents are phrased rather than
+# entity names and generalizes to entities it never saw. Features are hashed word
+# unigrams/bigrams and character trigrams (tolerant of typos in the intent words);
+# the model is a multinomial logistic regression over them, a (N_FEATURES x
+# intents) float32 weight matrix. Batched inference is one gather and sum.
+#
+# Trained from a labelled query file (query,intent), intent_queries.csv by default.
+# The model is saved to .cache/intent_model.npz and retrained automatically when
+# the labelled file changes.
+#
+#   python intent_classifier.py train [--data intent_queries.csv]
+#   python intent_classifier.py eval  [--data intent_queries.csv] [--folds 5]
+import argparse
+import functools
+import hashlib
+import itertools
+import os
+import re
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import data_loader
+
+LABELLED_QUERIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_queries.csv")
+MODEL_FILE = "intent_model.npz"
+MODEL_FORMAT_VERSION = 1
+# Hashed feature space (weights are N_FEATURES x intents float32)
+N_FEATURES = 1 << 16
+# Training: full-batch gradient descent with AdaGrad steps and L2 regularization
+EPOCHS = 300
+LEARNING_RATE = 1.0
+L2 = 1e-4
+
+_TOKEN_PATTERN = re.compile(r"_[a-z]+_|[a-z0-9]+")
+
+
+def intent_classifier_enabled():
+    return os.getenv("INTENT_CLASSIFIER", "1") != "0"
+
+
+def delexicalize(query_lower, matches):
+    """
+    Replaces entity mentions (objects with start, end and entity_type) by their type,
+    e.g. "funds hurt by crude oil price" -> "funds hurt by _factor_". Overlapping
+    mentions keep the longest one.
+    """
+    spans = []
+    for match in sorted(matches, key=lambda m: (m.start - m.end, m.start)):
+        if not any(match.start < end and start < match.end for start, end, _ in spans):
+            spans.append((match.start, match.end, match.entity_type))
+    parts, last = [], 0
+    for start, end, entity_type in sorted(spans):
+        parts.append(query_lower[last:start])
+        parts.append(f" _{entity_type}_ ")
+        last = end
+    parts.append(query_lower[last:])
+    return "".join(parts)
+
+
+def _hash(feature):
+    return zlib.crc32(feature.encode("utf-8")) % N_FEATURES
+
+
+_BIAS = _hash("bias")
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _token_features(token):
+    """Word and character-trigram feature ids of one token (queries reuse a small vocabulary)."""
+    ids = [_hash("w" + token)]
+    if token[0] != "_":
+        padded = f"#{token}#"
+        ids.extend(_hash("c" + padded[i:i + 3]) for i in range(len(padded) - 2))
+    return ids
+
+
+def features(text):
+    """Hashed feature ids of a delexicalized query (always includes the bias feature)."""
+    ids = [_BIAS]
+    previous = "<s>"
+    for token in _TOKEN_PATTERN.findall(text):
+        ids += _token_features(token)
+        ids.append(_hash("b" + previous + " " + token))
+        previous = token
+    ids.append(_hash("b" + previous + " </s>"))
+    return ids
+
+
+def _feature_matrix(texts):
+    """CSR-style (indices, indptr, scale): each row's features; scale makes each row unit length."""
+    rows = [features(text) for text in texts]
+    lengths = np.array([len(ids) for ids in rows])
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.array(rows[0] if len(rows) == 1 else list(itertools.chain.from_iterable(rows)), dtype=np.int64)
+    return indices, indptr, 1.0 / np.sqrt(lengths)
+
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class IntentClassifier:
+    """Hashed bag-of-n-grams softmax regression over delexicalized queries."""
+
+    def __init__(self, labels, weights):
+        self.labels = list(labels)
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+
+    @classmethod
+    def train(cls, texts, intents, epochs=EPOCHS, learning_rate=LEARNING_RATE, l2=L2):
+        """Fits the model on delexicalized texts and their intent labels."""
+        labels = sorted(set(intents))
+        label_ids = {label: i for i, label in enumerate(labels)}
+        y = np.array([label_ids[intent] for intent in intents])
+        indices, indptr, scale = _feature_matrix(texts)
+        rows = np.repeat(np.arange(len(texts)), np.diff(indptr))
+        values = scale[rows]
+        # Only features seen in training get (and need) weights updated
+        used, local = np.unique(indices, return_inverse=True)
+        weights = np.zeros((len(used), len(labels)), dtype=np.float64)
+        squared = np.full_like(weights, 1e-8)
+        targets = np.zeros((len(texts), len(labels)))
+        targets[np.arange(len(texts)), y] = 1.0
+        for _ in range(epochs):
+            logits = np.add.reduceat(weights[local] * values[:, None], indptr[:-1])
+            error = (_softmax(logits) - targets) / len(texts)
+            grad = np.stack([np.bincount(local, weights=error[rows, c] * values, minlength=len(used))
+                             for c in range(len(labels))], axis=1) + l2 * weights
+            squared += grad * grad
+            weights -= learning_rate * grad / np.sqrt(squared)
+        full = np.zeros((N_FEATURES, len(labels)), dtype=np.float32)
+        full[used] = weights
+        return cls(labels, full)
+
+    def predict(self, texts):
+        """[(intent, confidence)] for a batch of delexicalized texts."""
+        if not texts:
+            return []
+        indices, indptr, scale = _feature_matrix(texts)
+        logits = np.add.reduceat(self.weights[indices], indptr[:-1]) * scale[:, None]
+        best = logits.argmax(axis=1)
+        # Probability of the best intent: 1 / sum(exp(logit - best logit))
+        top = logits[np.arange(len(best)), best]
+        probability = 1.0 / np.exp(logits - top[:, None]).sum(axis=1)
+        return [(self.labels[i], p) for i, p in zip(best.tolist(), probability.tolist())]
+
+    def save(self, path, signature):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        # Only the rows of features seen in training are stored
+        used = np.flatnonzero(np.any(self.weights != 0, axis=1))
+        np.savez(tmp_path, format_version=np.array(MODEL_FORMAT_VERSION), n_features=np.array(N_FEATURES),
+                 signature=np.array(signature), labels=np.array(self.labels, dtype=str),
+                 used=used, weights=self.weights[used])
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, signature):
+        """Loads a saved model, or returns None if missing, unreadable or trained on other data."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                if (int(saved["format_version"]) != MODEL_FORMAT_VERSION or int(saved["n_features"]) != N_FEATURES
+                        or str(saved["signature"]) != signature):
+                    return None
+                weights = np.zeros((N_FEATURES, len(saved["labels"])), dtype=np.float32)
+                weights[saved["used"]] = saved["weights"]
+                return cls(saved["labels"].tolist(), weights)
+        except Exception as e:
+            print(f"Warning: ignoring unreadable intent model ({e}).")
+            return None
+
+
+def load_labelled_queries(path=LABELLED_QUERIES_FILE):
+    """(queries, intents) from a labelled CSV with query and intent columns."""
+    df = pd.read_csv(path, dtype=str).dropna(subset=["query", "intent"])
+    return df["query"].str.strip().tolist(), df["intent"].str.strip().tolist()
+
+
+def delexicalize_queries(queries):
+    """Delexicalizes raw queries with the exact entity matcher (fuzzy matches if none is exact)."""
+    from entity_matcher import get_entity_matcher
+    from fuzzy_matcher import get_fuzzy_matcher
+    entity_matcher = get_entity_matcher()
+    texts = []
+    for query in queries:
+        query_lower = query.lower()
+        matches = entity_matcher.find_all(query_lower) or get_fuzzy_matcher().resolve(query_lower)
+        texts.append(delexicalize(query_lower, matches))
+    return texts
+
+
+def _file_signature(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def train_from_file(path=LABELLED_QUERIES_FILE):
+    queries, intents = load_labelled_queries(path)
+    return IntentClassifier.train(delexicalize_queries(queries), intents)
+
+
+def get_intent_classifier():
+    """
+    Returns the intent classifier, loading the saved model or training it from the
+    labelled query file on first use. Raises if there is neither a model nor data.
+    """
+    def _build(store):
+        path = os.getenv("INTENT_TRAINING_FILE", LABELLED_QUERIES_FILE)
+        signature = _file_signature(path)
+        model_path = os.path.join(data_loader.cache_dir_for(store.data_dir), MODEL_FILE)
+        model = IntentClassifier.load(model_path, signature) if store.use_snapshot else None
+        if model is None:
+            model = train_from_file(path)
+            if store.use_snapshot:
+                try:
+                    model.save(model_path, signature)
+                except Exception as e:
+                    print(f"Warning: could not persist intent model: {e}")
+        return model
+    return data_loader.get_store().derived("intent_classifier", _build)
+
+
+# --- Command line: training and evaluation reports ---
+
+def _latency_us(classifier, texts, repeat=20):
+    """Mean microseconds per query for batched and for one-at-a-time prediction."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        classifier.predict(texts)
+    batched = (time.perf_counter() - start) / (repeat * len(texts)) * 1e6
+    start = time.perf_counter()
+    for text in texts:
+        classifier.predict([text])
+    single = (time.perf_counter() - start) / len(texts) * 1e6
+    return batched, single
+
+
+def _report(name, predicted, intents):
+    accuracy = np.mean([p == t for p, t in zip(predicted, intents)])
+    print(f"{name}: accuracy {accuracy:.3f} ({sum(p == t for p, t in zip(predicted, intents))}/{len(intents)})")
+    return accuracy
+
+
+def train_command(args):
+    queries, intents = load_labelled_queries(args.data)
+    texts = delexicalize_queries(queries)
+    start = time.perf_counter()
+    classifier = IntentClassifier.train(texts, intents)
+    print(f"Trained on {len(queries)} queries, {len(classifier.labels)} intents in {time.perf_counter() - start:.2f}s")
+    _report("Training set", [intent for intent, _ in classifier.predict(texts)], intents)
+    batched, single = _latency_us(classifier, texts)
+    print(f"Inference: {batched:.1f} us/query batched, {single:.1f} us/query one at a time")
+    path = os.path.join(data_loader.cache_dir_for(data_loader.get_store().data_dir), MODEL_FILE)
+    classifier.save(path, _file_signature(args.data))
+    print(f"Model saved to {path}")
+
+
+def eval_command(args):
+    """k-fold cross-validation: classifier alone, rules alone, and parse_intents with both."""
+    import intent_parser
+    queries, intents = load_labelled_queries(args.data)
+    texts = delexicalize_queries(queries)
+    folds = np.random.default_rng(args.seed).permutation(len(queries)) % args.folds
+    classified = [None] * len(queries)
+    combined = [None] * len(queries)
+    for fold in range(args.folds):
+        train = np.flatnonzero(folds != fold).tolist()
+        test = np.flatnonzero(folds == fold).tolist()
+        classifier = IntentClassifier.train([texts[i] for i in train], [intents[i] for i in train])
+        for i, (intent, _) in zip(test, classifier.predict([texts[i] for i in test])):
+            classified[i] = intent
+        for i, (intent, _) in zip(test, intent_parser.parse_intents([queries[i] for i in test], classifier=classifier)):
+            combined[i] = intent
+    os.environ["INTENT_CLASSIFIER"] = "0"
+    rules = [intent for intent, _ in intent_parser.parse_intents(queries)]
+
+    print(f"{len(queries)} labelled queries, {args.folds}-fold cross-validation")
+    _report("Classifier alone      ", classified, intents)
+    _report("Keyword rules         ", rules, intents)
+    _report("Classifier + fallback ", combined, intents)
+    print("\nPer intent (classifier + fallback):  precision  recall")
+    for label in sorted(set(intents)):
+        tp = sum(p == label and t == label for p, t in zip(combined, intents))
+        n_pred = sum(p == label for p in combined)
+        n_true = sum(t == label for t in intents)
+        print(f"  {label:24} {tp / n_pred if n_pred else 0:9.3f} {tp / n_true:7.3f}")
+    misrouted = [(q, p, t) for q, p, t in zip(queries, combined, intents) if p != t]
+    if misrouted:
+        print("\nMisrouted:")
+        for query, predicted, intent in misrouted:
+            print(f"  {query!r}: {predicted} (expected {intent})")
+    batched, single = _latency_us(IntentClassifier.train(texts, intents), texts)
+    print(f"\nInference: {batched:.1f} us/query batched, {single:.1f} us/query one at a time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the intent classifier.")
+    parser.add_argument("command", choices=["train", "eval"])
+    parser.add_argument("--data", default=LABELLED_QUERIES_FILE, help="labelled CSV (query,intent)")
+    parser.add_argument("--folds", type=int, default=5, help="cross-validation folds (eval)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.command == "train":
+        train_command(args)
+    else:
+        eval_command(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,248 @@
 # intent_parser.py
-# Import DataFrames from the new data loader module
-from data_loader import funds_df, amcs_df, sectors_df, factors_df # Import DFs
+import functools
+
+# Entity mentions come from the automaton compiled once in entity_matcher
+from entity_matcher import get_entity_matcher
+# Misspelled or partial names are resolved by the trigram index in fuzzy_matcher
+from fuzzy_matcher import get_fuzzy_matcher
+# The learned classifier picks the intent; the keyword rules below are its fallback
+from intent_classifier import delexicalize, get_intent_classifier, intent_classifier_enabled
+from semantic_index import get_semantic_index
+from query_planner import extract_constraints, is_compound
+import metrics
+
+# Semantic fallback thresholds (cosine similarity of the best description match)
+SEMANTIC_ENTITY_THRESHOLD = 0.2   # Confident enough to treat the hit as the query's entity
+SEMANTIC_SEARCH_THRESHOLD = 0.1   # Below this the query is left as 'unknown'
+# Fuzzy entity resolution threshold (trigram similarity, halved for ambiguous names)
+FUZZY_ENTITY_THRESHOLD = 0.55
+# Below this classifier probability the keyword rules decide the intent
+INTENT_CLASSIFIER_THRESHOLD = 0.4
+# Intent -> (entity type it needs, entities field); find_funds_by_risk needs a risk level instead
+INTENT_ENTITIES = {
+    "get_fund_details": ("fund", "fund_internal_key"),
+    "get_factor_details": ("factor", "factor_id"),
+    "find_funds_by_factor": ("factor", "factor_id"),
+    "get_amc_details": ("amc", "amc_id"),
+    "find_funds_by_amc": ("amc", "amc_id"),
+    "get_sector_details": ("sector", "sector_id"),
+    "find_funds_by_sector": ("sector", "sector_id"),
+}
+# Words suggesting the user wants a list of funds rather than entity details
+FUND_LIST_KEYWORDS = ["fund", "affect", "impact", "related", "sensitive", "hurt", "exposed", "benefit", "invest"]
 
 def parse_intent(query):
     """
-    Basic intent/entity recognition based on keywords, now using DataFrames.
+    Basic intent/entity recognition based on keywords and the compiled entity matcher.
     Returns: (intent_type, entities_dictionary)
     """
-    query_lower = query.lower()
+    return parse_intents([query])[0]
+
+
+@metrics.timed_function("intent_parse")
+def parse_intents(queries, classifier=None):
+    """
+    Batch version of parse_intent: the entity matcher is resolved once, the intent
+    classifier scores all queries in one call and every query that needs the
+    semantic fallback is embedded and searched in one call.
+    classifier overrides the trained IntentClassifier (used by its evaluation).
+    Returns a list of (intent_type, entities_dictionary), one per query.
+    """
+    # Check data is loaded before proceeding (the matcher is built on first use)
+    try:
+        entity_matcher = get_entity_matcher()
+    except Exception as e:
+        print(f"Warning: DataFrames not loaded in intent_parser ({e}). Cannot parse intent.")
+        return [("error", {"message": "Data not loaded"}) for _ in queries]
+
+    queries_lower = [query.lower() for query in queries]
+    # Single pass over each query finds every factor/fund/AMC/sector mention.
+    all_matches = [entity_matcher.find_all(query_lower) for query_lower in queries_lower]
+    predictions = _classify(queries_lower, all_matches, classifier)
+    # Within each type the earliest row in its CSV wins, as the old row loops did.
+    results = [_intent_from_matches(query_lower, matches, functools.partial(entity_matcher.best_by_type, query_lower, matches),
+                                    prediction)
+               for query_lower, matches, prediction in zip(queries_lower, all_matches, predictions)]
+
+    # Priority 6: No exact mention - resolve misspelled / partial entity names
+    pending = [i for i, (intent, _) in enumerate(results) if intent is None]
+    if pending:
+        try:
+            fuzzy_matcher = get_fuzzy_matcher()
+        except Exception as e:
+            print(f"Warning: fuzzy entity matching unavailable: {e}")
+            fuzzy_matcher = None
+        if fuzzy_matcher is not None:
+            resolved = [(i, fuzzy_matcher.resolve(queries_lower[i], min_score=FUZZY_ENTITY_THRESHOLD)) for i in pending]
+            resolved = [(i, matches) for i, matches in resolved if matches]
+            predictions = _classify([queries_lower[i] for i, _ in resolved], [m for _, m in resolved], classifier)
+            for (i, matches), prediction in zip(resolved, predictions):
+                results[i] = _fuzzy_intent(queries_lower[i], matches, prediction) or results[i]
+
+    # Priority 7: Still nothing - fall back to semantic search over descriptions
+    pending = [i for i, (intent, _) in enumerate(results) if intent is None]
+    if pending:
+        try:
+            hits = get_semantic_index().search_batch([queries[i] for i in pending], top_k=1)
+        except Exception as e:
+            print(f"Warning: semantic fallback unavailable: {e}")
+            hits = [[] for _ in pending]
+        for i, query_hits in zip(pending, hits):
+            entities = results[i][1]
+            semantic = _semantic_intent(queries[i], queries[i].lower(), entities, query_hits)
+            # Default fallback if no specific pattern is matched
+            results[i] = semantic or ("unknown", entities)
+    for intent, _ in results:
+        metrics.inc("intents", intent=intent)
+    return results
+
+
+def _classify(queries_lower, all_matches, classifier=None):
+    """
+    (intent, probability) per query from the intent classifier, with entity mentions
+    replaced by their type; None per query when the classifier is disabled or unavailable.
+    """
+    if classifier is None:
+        if not intent_classifier_enabled():
+            return [None] * len(queries_lower)
+        try:
+            classifier = get_intent_classifier()
+        except Exception as e:
+            print(f"Warning: intent classifier unavailable, using keyword rules: {e}")
+            return [None] * len(queries_lower)
+    return classifier.predict([delexicalize(query_lower, matches) for query_lower, matches in zip(queries_lower, all_matches)])
+
+
+def _fuzzy_intent(query_lower, all_matches, prediction=None):
+    """
+    Intent for fuzzily resolved mentions (as for exact ones); None if nothing matched.
+    The confidence of the leading mention is reported as entities['fuzzy_score'].
+    """
+    # resolve() lists the mention explaining most of the query first; keep the first one per type
+    best = {}
+    for match in all_matches:
+        best.setdefault(match.entity_type, match)
+    intent, entities = _intent_from_matches(query_lower, all_matches, lambda: best, prediction)
+    if intent is None:
+        return None
+    entities['fuzzy_score'] = all_matches[0].score
+    return intent, entities
+
+
+def _intent_from_matches(query_lower, all_matches, best_by_type, prediction=None):
+    """
+    Maps entity mentions to an intent. best_by_type() returns {entity_type: match}
+    (only called when the query is not compound); prediction is the classifier's
+    (intent, probability). Intent is None if nothing matched.
+    """
     entities = {}
 
-    # Check DataFrames are loaded before proceeding
-    if funds_df is None or amcs_df is None or sectors_df is None or factors_df is None:
-        print("Warning: DataFrames not loaded in intent_parser. Cannot parse intent.")
-        return "error", {"message": "Data not loaded"}
+    # Priority 0: several constraints in one fund-list query ("high risk funds in Energy
+    # managed by AMC_X") are answered together by the query planner
+    constraints = extract_constraints(query_lower, all_matches)
+    if is_compound(query_lower, all_matches, constraints):
+        entities['constraints'] = tuple(tuple(c) for c in constraints)
+        return "find_funds_compound", entities
+
+    matches = best_by_type()
+
+    # The classifier's intent wins when it is confident and its entity was found;
+    # otherwise the keyword rules below decide
+    if prediction is not None:
+        intent, probability = prediction
+        entity_type, field = INTENT_ENTITIES.get(intent, (None, None))
+        if (probability >= INTENT_CLASSIFIER_THRESHOLD and entity_type in matches
+                and not _inside_longer_mention(matches[entity_type], all_matches)):
+            entities[field] = matches[entity_type].entity_id
+            metrics.inc("intent_classifier", result="accepted")
+            return intent, entities
+        risk_level = _risk_level(query_lower) if intent == "find_funds_by_risk" else None
+        if probability >= INTENT_CLASSIFIER_THRESHOLD and risk_level:
+            entities['risk_level'] = risk_level
+            metrics.inc("intent_classifier", result="accepted")
+            return intent, entities
+        metrics.inc("intent_classifier", result="fallback")
 
     # Priority 1: Check for specific factor names
-    # Use the 'name' column from the DataFrame for matching
-    if not factors_df.empty:
-        for index, factor_row in factors_df.iterrows():
-            factor_name = factor_row['name'] # Get name for matching
-            factor_id = factor_row['factor_id'] # Get ID to store if matched
-            if factor_name.lower() in query_lower:
-                entities['factor_id'] = factor_id # Store the ID
-                # Check for relationship keywords
-                if "affect" in query_lower or "impact" in query_lower or "related" in query_lower or "sensitive" in query_lower:
-                     return "find_funds_by_factor", entities
-                else:
-                     return "get_factor_details", entities
+    if "factor" in matches:
+        entities['factor_id'] = matches["factor"].entity_id # Store the ID
+        # Check for relationship keywords
+        if "affect" in query_lower or "impact" in query_lower or "related" in query_lower or "sensitive" in query_lower:
+             return "find_funds_by_factor", entities
+        else:
+             return "get_factor_details", entities
 
     # Priority 2: Check for specific fund names
-    # Use the 'name' column for matching
-    if not funds_df.empty:
-         for index, fund_row in funds_df.iterrows():
-              fund_name = fund_row['name']
-              # Store the internal_key used by graph_query.get_fund_details
-              fund_internal_key = fund_row['internal_key']
-              if fund_name.lower() in query_lower:
-                   entities['fund_internal_key'] = fund_internal_key # Store the key needed by graph_query
-                   return "get_fund_details", entities
+    if "fund" in matches:
+        # Store the internal_key used by graph_query.get_fund_details
+        entities['fund_internal_key'] = matches["fund"].entity_id
+        return "get_fund_details", entities
 
     # Priority 3: Check for specific AMC names or IDs
-    # Use 'name' and 'amc_id' columns for matching
-    if not amcs_df.empty:
-        for index, amc_row in amcs_df.iterrows():
-            amc_name = amc_row['name']
-            amc_id = amc_row['amc_id']
-            # Check if either the name or ID appears in the query
-            if amc_name.lower() in query_lower or amc_id.lower() in query_lower:
-                entities['amc_id'] = amc_id # Store the ID
-                # Check if user asks about funds managed by this AMC
-                if "funds" in query_lower or "manage" in query_lower or "portfolio" in query_lower:
-                    return "find_funds_by_amc", entities
-                else:
-                    return "get_amc_details", entities
+    if "amc" in matches:
+        entities['amc_id'] = matches["amc"].entity_id # Store the ID
+        # Check if user asks about funds managed by this AMC
+        if "funds" in query_lower or "manage" in query_lower or "portfolio" in query_lower:
+            return "find_funds_by_amc", entities
+        else:
+            return "get_amc_details", entities
 
     # Priority 4: Check for specific Sector names or IDs
-    # Use 'name' and 'sector_id' columns for matching
-    if not sectors_df.empty:
-        for index, sector_row in sectors_df.iterrows():
-             sector_name = sector_row['name']
-             sector_id = sector_row['sector_id']
-             # Check if either the name or ID appears in the query
-             if sector_name.lower() in query_lower or sector_id.lower() in query_lower:
-                 entities['sector_id'] = sector_id # Store the ID
-                 # If query asks for funds investing in this sector
-                 if "funds" in query_lower or "invest" in query_lower:
-                     return "find_funds_by_sector", entities
-                 else:
-                     return "get_sector_details", entities
+    if "sector" in matches:
+        entities['sector_id'] = matches["sector"].entity_id # Store the ID
+        # If query asks for funds investing in this sector
+        if "funds" in query_lower or "invest" in query_lower:
+            return "find_funds_by_sector", entities
+        else:
+            return "get_sector_details", entities
 
     # Priority 5: Check for risk levels mentioned alongside 'fund'/'funds'
+    identified_risk = _risk_level(query_lower)
+
+    # Check if 'fund' or 'funds' is also mentioned
+    if identified_risk and ("fund" in query_lower or "funds" in query_lower):
+        entities['risk_level'] = identified_risk
+        return "find_funds_by_risk", entities
+
+    return None, entities
+
+
+def _inside_longer_mention(match, all_matches):
+    """True if match is part of a longer mention (the "Energy" in "FundD Energy Focus")."""
+    return any(other.start <= match.start and match.end <= other.end and other.end - other.start > match.end - match.start
+               for other in all_matches)
+
+
+def _risk_level(query_lower):
+    """The risk level mentioned in the query, as graph_query expects it ('High', ...), or None."""
     # This logic doesn't depend on iterating entities, so it remains similar
-    risk_keywords = ["risk", "risky", "safe", "level"]
     risk_levels = ["high", "medium", "low"] # Should match values in your funds.csv 'risk' column
-    identified_risk = None
     for level in risk_levels:
         if level in query_lower:
-            identified_risk = level
-            break
+            # Pass the matched risk level (e.g., 'High', 'Medium') as expected by graph_query
+            return level.capitalize()
+    return None
 
-    # Check if 'fund' or 'funds' is also mentioned
-    if identified_risk and ("fund" in query_lower or "funds" in query_lower):
-        # Pass the matched risk level (e.g., 'High', 'Medium') as expected by graph_query
-        entities['risk_level'] = identified_risk.capitalize()
-        return "find_funds_by_risk", entities
 
-    # Default fallback if no specific pattern is matched
-    return "unknown", entities
\ No newline at end of file
+def _semantic_intent(query, query_lower, entities, hits):
+    """Maps the closest description match (hits from the semantic index) to an intent, or None if nothing is close."""
+    if not hits or hits[0].score < SEMANTIC_SEARCH_THRESHOLD:
+        return None
+
+    top = hits[0]
+    entities['semantic_score'] = round(top.score, 3)
+    if top.score >= SEMANTIC_ENTITY_THRESHOLD:
+        wants_funds = any(keyword in query_lower for keyword in FUND_LIST_KEYWORDS)
+        if top.entity_type == "factor":
+            entities['factor_id'] = top.entity_id
+            return ("find_funds_by_factor" if wants_funds else "get_factor_details"), entities
+        if top.entity_type == "sector":
+            entities['sector_id'] = top.entity_id
+            return ("find_funds_by_sector" if wants_funds else "get_sector_details"), entities
+        if top.entity_type == "fund":
+            entities['fund_internal_key'] = top.entity_id
+            return "get_fund_details", entities
+
+    # Weaker match: let build_context assemble the closest descriptions
+    entities['semantic_query'] = query
+    return "semantic_search", entities
\ No newline at end of file
@@ -0,0 +1,241 @@
+# kb_codes.py
+# Dense integer codes for entity IDs.
+# Every ID (fund_id, amc_id, sector_id, factor_id) and categorical value (risk)
+# is interned once per knowledge base into a CodeBook (string <-> int32 code),
+# link tables become pairs of int32 code arrays, and adjacency lists are CSR
+# arrays, so filters and joins in graph_query compare integers, not strings.
+# Every structure can also be exported to flat arrays (to_arrays) and rebuilt
+# over them without copying (from_arrays), which is how shared_kb publishes it
+# to other worker processes through a memory-mapped file.
+import bisect
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+# Code used for missing / unknown values
+NO_CODE = -1
+
+
+class CodeBook:
+    """Bidirectional string <-> dense int32 code dictionary (codes are assigned in first-seen order)."""
+
+    def __init__(self, values=()):
+        self.strings = []   # code -> string
+        self.codes = {}     # string -> code
+        self._lookup = None  # pd.Index over strings for vectorized encoding
+        self.add(values)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def to_arrays(self):
+        """Flat arrays of the code book (strings in code order + sorted lookup keys)."""
+        return {**prefixed("strings", StringArray.from_strings(self.strings).to_arrays()),
+                **prefixed("lookup", StringIndex.from_mapping(self.codes).to_arrays())}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Read-only code book over to_arrays() output (strings are decoded on access)."""
+        book = cls.__new__(cls)
+        book.strings = StringArray.from_arrays(unprefixed("strings", arrays))
+        book.codes = StringIndex.from_arrays(unprefixed("lookup", arrays))
+        book._lookup = None
+        return book
+
+    def add(self, values):
+        """Interns new (non-missing) values; existing ones keep their code."""
+        for value in pd.unique(pd.Series(list(values), dtype=object).dropna()):
+            if value not in self.codes:
+                self.codes[value] = len(self.strings)
+                self.strings.append(value)
+                self._lookup = None
+
+    def code(self, value):
+        """Code of one value, or NO_CODE if it was never interned."""
+        return self.codes.get(value, NO_CODE)
+
+    def encode(self, values):
+        """int32 codes for a sequence/Series of values (NO_CODE for missing or unknown)."""
+        if self._lookup is None:
+            self._lookup = pd.Index(self.strings, dtype=object)
+        return self._lookup.get_indexer(pd.Index(list(values), dtype=object)).astype(np.int32)
+
+    def decode(self, codes):
+        """Strings for an iterable of codes."""
+        strings = self.strings
+        return [strings[c] for c in np.asarray(codes, dtype=np.int64).tolist()]
+
+
+class Adjacency:
+    """
+    CSR adjacency from int32 (source code, target) pairs: neighbors(code) is the
+    slice of targets for that source, in the original pair order.
+    Pairs with a missing source or target are dropped.
+    """
+
+    def __init__(self, sources, targets, n_sources):
+        sources = np.asarray(sources, dtype=np.int32)
+        targets = np.asarray(targets, dtype=np.int32)
+        valid = (sources >= 0) & (targets >= 0)
+        sources, targets = sources[valid], targets[valid]
+        order = np.argsort(sources, kind="stable")
+        self.indices = targets[order]
+        self.indptr = np.zeros(n_sources + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n_sources), out=self.indptr[1:])
+
+    def to_arrays(self):
+        return {"indptr": self.indptr, "indices": self.indices}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Adjacency over existing indptr/indices arrays (not copied)."""
+        adjacency = cls.__new__(cls)
+        adjacency.indptr = arrays["indptr"]
+        adjacency.indices = arrays["indices"]
+        return adjacency
+
+    def neighbors(self, code):
+        """Targets of one source code (empty for NO_CODE)."""
+        if code < 0 or code + 1 >= len(self.indptr):
+            return self.indices[:0]
+        return self.indices[self.indptr[code]:self.indptr[code + 1]]
+
+    def expand(self, codes):
+        """
+        For an array of valid source codes returns (item, target) arrays: one entry
+        per neighbor of codes[item], so links can be joined without a Python loop.
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        starts = self.indptr[codes]
+        counts = self.indptr[codes + 1] - starts
+        items = np.repeat(np.arange(len(codes)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return items, self.indices[np.repeat(starts, counts) + offsets]
+
+
+def normalize_category(value):
+    """Pre-normalized form of a categorical value such as risk (lowercase), None if missing."""
+    return value.lower() if isinstance(value, str) else None
+
+
+class StringArray:
+    """
+    Read-only list of strings stored as UTF-8 bytes plus int64 offsets (the Arrow
+    layout), so it can live in a shared memory map; items are decoded on access.
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+        # memoryviews index faster than numpy scalars in the per-item path
+        self._offsets = memoryview(offsets)
+        self._data = memoryview(data)
+
+    @classmethod
+    def from_strings(cls, strings):
+        """Raises TypeError if a value is not a string."""
+        encoded = [value.encode("utf-8") for value in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def to_arrays(self):
+        return {"offsets": self.offsets, "data": self.data}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["offsets"], arrays["data"])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        offsets = self._offsets
+        if i < 0:
+            i += len(offsets) - 1
+        if not 0 <= i < len(offsets) - 1:
+            raise IndexError("StringArray index out of range")
+        return str(self._data[offsets[i]:offsets[i + 1]], "utf-8")
+
+    def __iter__(self):
+        data = bytes(self._data)
+        bounds = self.offsets.tolist()
+        return (data[start:end].decode("utf-8") for start, end in zip(bounds, bounds[1:]))
+
+
+class StringIndex:
+    """
+    Read-only string -> int mapping (dict-like get/in/[]) stored as flat arrays, so
+    it can live in a shared memory map: keys are kept sorted by a 64-bit hash and
+    found by binary search over the hashes, then compared.
+    """
+
+    def __init__(self, hashes, keys, values):
+        self.hashes = hashes    # int64, sorted
+        self.keys = keys        # StringArray, aligned with hashes
+        self.values = values    # int64, aligned with hashes
+        self._hashes = memoryview(hashes)
+        self._values = memoryview(values)
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """Raises TypeError if a key is not a string."""
+        items = sorted((_string_hash(key), key, value) for key, value in mapping.items())
+        return cls(np.array([h for h, _, _ in items], dtype=np.int64),
+                   StringArray.from_strings([key for _, key, _ in items]),
+                   np.array([value for _, _, value in items], dtype=np.int64))
+
+    def to_arrays(self):
+        return {"hashes": self.hashes, **prefixed("keys", self.keys.to_arrays()), "values": self.values}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["hashes"], StringArray.from_arrays(unprefixed("keys", arrays)), arrays["values"])
+
+    def __len__(self):
+        return len(self._values)
+
+    def _position(self, key):
+        if not isinstance(key, str):
+            return -1
+        h = _string_hash(key)
+        hashes = self._hashes
+        pos = bisect.bisect_left(hashes, h)
+        while pos < len(hashes) and hashes[pos] == h:
+            if self.keys[pos] == key:
+                return pos
+            pos += 1
+        return -1
+
+    def get(self, key, default=None):
+        pos = self._position(key)
+        return self._values[pos] if pos >= 0 else default
+
+    def __contains__(self, key):
+        return self._position(key) >= 0
+
+    def __getitem__(self, key):
+        pos = self._position(key)
+        if pos < 0:
+            raise KeyError(key)
+        return self._values[pos]
+
+    def items(self):
+        return zip(self.keys, self.values.tolist())
+
+
+def _string_hash(value):
+    """Stable (process-independent) 63-bit hash of a string."""
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little") >> 1
+
+
+def prefixed(prefix, arrays):
+    """Namespaces a to_arrays() dict: {'indptr': a} -> {'prefix/indptr': a}."""
+    return {f"{prefix}/{name}": array for name, array in arrays.items()}
+
+
+def unprefixed(prefix, arrays):
+    """The arrays under one prefix, with the prefix stripped (inverse of prefixed)."""
+    start = len(prefix) + 1
+    return {name[start:]: array for name, array in arrays.items() if name.startswith(prefix + "/")}
@@ -0,0 +1,147 @@
+# kb_snapshot.py
+# Compiles the knowledge-base CSVs into one binary Arrow IPC snapshot that
+# data_loader memory-maps at startup instead of re-parsing every CSV.
+# Each table is one IPC stream inside the snapshot file; a small JSON manifest
+# next to it records stream offsets and the source files' size/mtime/hash so a
+# stale snapshot is detected and the loader falls back to CSV.
+#
+# Build step:  python kb_snapshot.py
+import hashlib
+import json
+import os
+import time
+
+try:
+    import pyarrow as pa
+except ImportError:  # Optional dependency: without it data_loader just reads CSVs
+    pa = None
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SNAPSHOT_PATH = os.path.join(_SCRIPT_DIR, ".cache", "kb_snapshot.arrow")
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+def _manifest_path(snapshot_path):
+    return os.path.splitext(snapshot_path)[0] + ".json"
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _source_info(path):
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "sha256": _file_sha256(path)}
+
+
+def write_snapshot(tables, source_paths, snapshot_path=DEFAULT_SNAPSHOT_PATH):
+    """
+    Writes {table_name: DataFrame} into a single snapshot file plus manifest.
+    Categorical columns are stored as Arrow dictionary arrays.
+    source_paths maps table_name -> CSV path, used later for staleness checks.
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow is required to build a knowledge-base snapshot")
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    manifest = {"format_version": SNAPSHOT_FORMAT_VERSION, "created_at": time.time(), "tables": {}}
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for name, df in tables.items():
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            data = sink.getvalue()
+            offset = f.tell()
+            f.write(data)
+            manifest["tables"][name] = {"offset": offset, "length": data.size, "rows": len(df),
+                                        "source": _source_info(source_paths[name])}
+        manifest["snapshot_size"] = f.tell()
+    # Replace both files atomically so readers never see a half-written snapshot
+    os.replace(tmp_path, snapshot_path)
+    manifest_tmp = _manifest_path(snapshot_path) + ".tmp"
+    with open(manifest_tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_tmp, _manifest_path(snapshot_path))
+    return manifest
+
+
+def _source_is_fresh(source, path):
+    """Cheap size/mtime check first; on an mtime change fall back to comparing hashes."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_size != source.get("size"):
+        return False
+    if st.st_mtime_ns == source.get("mtime_ns"):
+        return True
+    return _file_sha256(path) == source.get("sha256")
+
+
+def read_manifest(snapshot_path=DEFAULT_SNAPSHOT_PATH):
+    """Returns the snapshot manifest dict, or None if missing/unreadable."""
+    try:
+        with open(_manifest_path(snapshot_path)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def snapshot_is_fresh(source_paths, snapshot_path=DEFAULT_SNAPSHOT_PATH, manifest=None):
+    """True when the snapshot exists and was built from the current source files."""
+    manifest = manifest or read_manifest(snapshot_path)
+    if manifest is None or pa is None:
+        return False
+    try:
+        if os.path.getsize(snapshot_path) != manifest.get("snapshot_size"):
+            return False
+    except OSError:
+        return False
+    for name, path in source_paths.items():
+        entry = manifest["tables"].get(name)
+        if entry is None or not _source_is_fresh(entry["source"], path):
+            return False
+    return True
+
+
+def load_snapshot(source_paths, snapshot_path=DEFAULT_SNAPSHOT_PATH, tables=None):
+    """
+    Memory-maps the snapshot and returns {table_name: DataFrame}, or None if the
+    snapshot is missing, stale or unreadable (the caller then reads the CSVs).
+    tables optionally restricts which tables are materialized.
+    """
+    manifest = read_manifest(snapshot_path)
+    if not snapshot_is_fresh(source_paths, snapshot_path, manifest):
+        return None
+    try:
+        # Zero-copy view of the whole file; each table is a slice holding one IPC stream
+        buffer = pa.memory_map(snapshot_path, "r").read_buffer()
+        result = {}
+        for name in (tables or source_paths):
+            entry = manifest["tables"][name]
+            reader = pa.ipc.open_stream(buffer.slice(entry["offset"], entry["length"]))
+            result[name] = reader.read_all().to_pandas()
+        return result
+    except Exception as e:
+        print(f"Warning: could not read knowledge-base snapshot ({e}); falling back to CSV.")
+        return None
+
+
+if __name__ == "__main__":
+    import data_loader
+    start = time.perf_counter()
+    csv_tables = data_loader.load_csv_tables()
+    snapshot_path = data_loader.snapshot_path_for()
+    written = write_snapshot(csv_tables, data_loader.table_paths(), snapshot_path)
+    print(f"Snapshot written to {snapshot_path} "
+          f"({written['snapshot_size'] / 1024:.1f} KiB, {len(written['tables'])} tables) "
+          f"in {time.perf_counter() - start:.3f}s")
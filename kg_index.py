@@ -0,0 +1,197 @@
+# kg_index.py
+# Precomputed lookup structures over the loaded DataFrames.
+# Built once per knowledge base (cached on the data_loader store) so graph_query
+# functions become hash-map / adjacency-list lookups (O(degree)) instead of full
+# DataFrame scans.
+# IDs are interned into dense int32 codes (kb_codes.CodeBook): fund columns and
+# link tables are int32 arrays and adjacency lists are CSR arrays, so filters and
+# joins run on integers; row dicts are only copied for the funds a query returns.
+# The code books, code columns and adjacency lists export to flat arrays, so
+# shared_kb can publish them once for every worker process (from_arrays).
+import numpy as np
+
+import data_loader
+from kb_codes import NO_CODE, Adjacency, CodeBook, StringIndex, normalize_category, prefixed, unprefixed
+
+# Attributes exported by KnowledgeGraphIndex.to_arrays(), by kind
+CODEBOOKS = ["funds", "amcs", "sectors", "factors", "risks"]
+CODE_COLUMNS = ["fund_code", "fund_amc", "fund_primary_sector", "fund_risk",
+                "secondary_fund", "secondary_sector", "related_fund", "related_factor",
+                "affected_factor", "affected_sector"]
+ADJACENCIES = ["fund_positions", "amc_funds", "primary_sector_funds", "risk_funds",
+               "fund_sectors", "sector_funds", "fund_factors", "factor_funds", "factor_sectors"]
+
+
+def _records(df):
+    """Converts a DataFrame to a list of row dicts (empty list if missing)."""
+    if df is None or df.empty:
+        return []
+    return df.to_dict('records')
+
+
+def _column(df, name):
+    """A DataFrame column as a list (empty if the table or column is missing)."""
+    if df is None or df.empty or name not in df.columns:
+        return []
+    return df[name].tolist()
+
+
+class KnowledgeGraphIndex:
+    """
+    Integer-coded fund columns, link arrays and adjacency lists over the knowledge base.
+    Fund adjacency lists hold fund row positions, kept in CSV order so results
+    come back in the same order the DataFrame scans gave.
+    """
+
+    def __init__(self, data):
+        data = data or {}
+        funds = data.get("funds")
+        fss = data.get("fund_secondary_sectors")
+        frf = data.get("fund_related_factors")
+        fas = data.get("factor_affected_sectors")
+        self._entity_records(data)
+
+        # --- Code books: entity-table order first, then IDs only seen in links ---
+        fund_ids = _column(funds, 'fund_id')
+        self.funds = CodeBook(fund_ids)
+        self.funds.add(_column(fss, 'fund_id'))
+        self.funds.add(_column(frf, 'fund_id'))
+        self.amcs = CodeBook(self.amc_records)
+        self.amcs.add(_column(funds, 'amc_id'))
+        self.sectors = CodeBook(self.sector_records)
+        self.sectors.add(_column(funds, 'primary_sector'))
+        self.sectors.add(_column(fss, 'sector_id'))
+        self.sectors.add(_column(fas, 'sector_id'))
+        self.factors = CodeBook(self.factor_records)
+        self.factors.add(_column(frf, 'factor_id'))
+        self.factors.add(_column(fas, 'factor_id'))
+        risks = [normalize_category(risk) for risk in _column(funds, 'risk')]
+        self.risks = CodeBook(risks)
+
+        # --- Fund rows (dicts converted once, copied per result) and int32 code columns ---
+        self.fund_records = _records(funds)
+        self.n_funds = len(self.fund_records)
+        self.fund_code = self.funds.encode(fund_ids)
+        self.fund_amc = self.amcs.encode(_column(funds, 'amc_id'))
+        self.fund_primary_sector = self.sectors.encode(_column(funds, 'primary_sector'))
+        self.fund_risk = self.risks.encode(risks)
+        self.fund_position_by_key = {}   # internal_key -> first row position
+        for pos, key in enumerate(_column(funds, 'internal_key')):
+            self.fund_position_by_key.setdefault(key, pos)
+
+        positions = np.arange(self.n_funds, dtype=np.int32)
+        self.fund_positions = Adjacency(self.fund_code, positions, len(self.funds))
+        self.amc_funds = Adjacency(self.fund_amc, positions, len(self.amcs))
+        self.primary_sector_funds = Adjacency(self.fund_primary_sector, positions, len(self.sectors))
+        self.risk_funds = Adjacency(self.fund_risk, positions, len(self.risks))
+
+        # --- Link tables as int32 code arrays (row order kept) ---
+        self.secondary_fund = self.funds.encode(_column(fss, 'fund_id'))
+        self.secondary_sector = self.sectors.encode(_column(fss, 'sector_id'))
+        self.related_fund = self.funds.encode(_column(frf, 'fund_id'))
+        self.related_factor = self.factors.encode(_column(frf, 'factor_id'))
+        self.affected_factor = self.factors.encode(_column(fas, 'factor_id'))
+        self.affected_sector = self.sectors.encode(_column(fas, 'sector_id'))
+
+        self.fund_sectors = Adjacency(self.secondary_fund, self.secondary_sector, len(self.funds))
+        self.sector_funds = Adjacency(self.secondary_sector, self.secondary_fund, len(self.sectors))
+        self.fund_factors = Adjacency(self.related_fund, self.related_factor, len(self.funds))
+        self.factor_funds = Adjacency(self.related_factor, self.related_fund, len(self.factors))
+        self.factor_sectors = Adjacency(self.affected_factor, self.affected_sector, len(self.factors))
+
+    def _entity_records(self, data):
+        """AMC, sector and factor rows by ID (small tables; first row wins, as iloc[0] did)."""
+        self.amc_records = {}
+        for amc in _records(data.get("amcs")):
+            self.amc_records.setdefault(amc.get('amc_id'), amc)
+        self.sector_records = {}
+        for sector in _records(data.get("sectors")):
+            self.sector_records.setdefault(sector.get('sector_id'), sector)
+        self.factor_records = {}
+        for factor in _records(data.get("factors")):
+            self.factor_records.setdefault(factor.get('factor_id'), factor)
+
+    def to_arrays(self):
+        """Code books, code columns, adjacency lists and the internal_key lookup as flat arrays."""
+        arrays = {name: getattr(self, name) for name in CODE_COLUMNS}
+        for name in CODEBOOKS + ADJACENCIES:
+            arrays.update(prefixed(name, getattr(self, name).to_arrays()))
+        # Rows without an internal_key can never be looked up by one
+        by_key = {key: pos for key, pos in self.fund_position_by_key.items() if isinstance(key, str)}
+        arrays.update(prefixed("fund_position_by_key", StringIndex.from_mapping(by_key).to_arrays()))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, data, arrays, fund_records):
+        """
+        Index over to_arrays() output without rebuilding or copying it. Only the small
+        AMC/sector/factor record dicts are built from data; fund_records is any
+        sequence of fund row dicts (shared_kb passes a view over the shared funds table).
+        """
+        index = cls.__new__(cls)
+        index._entity_records(data or {})
+        for name in CODE_COLUMNS:
+            setattr(index, name, arrays[name])
+        for name in CODEBOOKS:
+            setattr(index, name, CodeBook.from_arrays(unprefixed(name, arrays)))
+        for name in ADJACENCIES:
+            setattr(index, name, Adjacency.from_arrays(unprefixed(name, arrays)))
+        index.fund_position_by_key = StringIndex.from_arrays(unprefixed("fund_position_by_key", arrays))
+        index.fund_records = fund_records
+        index.n_funds = len(fund_records)
+        return index
+
+    # --- Helpers ---
+    def positions_for_fund_id(self, fund_id):
+        """Row positions of a fund ID (empty if unknown)."""
+        return self.fund_positions.neighbors(self.funds.code(fund_id))
+
+    def positions_for_fund_codes(self, fund_codes):
+        """Sorted row positions of all funds whose code is in fund_codes."""
+        selected = np.zeros(len(self.funds) + 1, dtype=bool)
+        selected[np.asarray(fund_codes, dtype=np.int64)] = True
+        selected[NO_CODE] = False
+        return np.flatnonzero(selected[self.fund_code])
+
+    def sector_fund_codes(self, sector_code):
+        """Boolean mask over fund codes (+1 NO_CODE slot): funds holding the sector as primary or secondary."""
+        related = np.zeros(len(self.funds) + 1, dtype=bool)
+        related[self.fund_code[self.primary_sector_funds.neighbors(sector_code)]] = True
+        related[self.sector_funds.neighbors(sector_code)] = True
+        related[NO_CODE] = False
+        return related
+
+    def factor_fund_codes(self, factor_code):
+        """Boolean mask over fund codes (+1 NO_CODE slot): funds linked to the factor directly or via an affected sector."""
+        # One extra slot absorbs NO_CODE (-1) entries from rows with a missing fund ID
+        related = np.zeros(len(self.funds) + 1, dtype=bool)
+        # 1. Direct link check
+        related[self.factor_funds.neighbors(factor_code)] = True
+        # 2. Indirect link via sector sensitivity check
+        affected = np.zeros(len(self.sectors) + 1, dtype=bool)
+        affected[self.factor_sectors.neighbors(factor_code)] = True
+        # Funds where primary sector is affected (a missing sector hits the always-False last slot)
+        related[self.fund_code[affected[self.fund_primary_sector]]] = True
+        # Funds where a secondary sector is affected
+        related[self.secondary_fund[affected[self.secondary_sector]]] = True
+        related[NO_CODE] = False
+        return related
+
+    def fund_record(self, pos):
+        """A copy of the fund row at a position."""
+        return dict(self.fund_records[pos])
+
+    def funds_at(self, positions):
+        """Returns copies of the fund records at the given row positions."""
+        records = self.fund_records
+        positions = np.asarray(positions, dtype=np.int64)
+        # Record views over a shared table convert all rows in one call
+        if hasattr(records, "take"):
+            return records.take(positions)
+        return [dict(records[pos]) for pos in positions.tolist()]
+
+
+def get_graph_index(store=None):
+    """Returns the index for the current (or given) knowledge-base store, building it on first use."""
+    return (store or data_loader.get_store()).derived(
+        "graph_index", lambda store: KnowledgeGraphIndex(store.get_loaded_data()))
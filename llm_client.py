@@ -0,0 +1,324 @@
+# llm_client.py
+# Long-lived LLM backends shared by every request in the process.
+# The Gemini model object (and the connection it holds) is created once and
+# reused, calls get a timeout and retry-with-backoff on quota/transient errors,
+# and a stub backend can be swapped in for tests and benchmarks.
+# With PROMPT_CACHE=provider (see prompt_cache.py) backends carry the fixed
+# instructions as their system instruction and accept a `cached` handle naming
+# provider cached content that already holds the prompt's prefix.
+import asyncio
+import os
+import random
+import threading
+import time
+
+# Retry/timeout defaults (overridable from the environment)
+DEFAULT_TIMEOUT_SECONDS = 60.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+# Substrings of error messages worth retrying (quota / transient server errors)
+RETRYABLE_ERRORS = ("resource has been exhausted", "quota exceeded", "429",
+                    "503", "service unavailable", "deadline exceeded", "temporarily unavailable")
+
+
+def is_retryable_error(e):
+    """Returns True for quota and transient errors that deserve another attempt."""
+    error_str = str(e).lower()
+    return any(marker in error_str for marker in RETRYABLE_ERRORS)
+
+
+class LLMBackend:
+    """
+    Interface for text-generation backends.
+    generate() returns a response object exposing .text (and optionally .parts /
+    .prompt_feedback, like Gemini responses); llm_handler extracts the answer.
+    """
+    name = "base"
+    model_name = None
+    requires_api_key = False
+    system_instruction = None
+
+    def generate(self, prompt, cached=None):
+        raise NotImplementedError
+
+    def generate_stream(self, prompt, cached=None):
+        """Yields the answer text in chunks; backends without streaming yield it whole."""
+        response = self.generate(prompt, cached)
+        yield response.text
+
+    async def generate_async(self, prompt, cached=None):
+        """Awaitable generate(); backends without a native async API run it in a thread."""
+        return await asyncio.to_thread(self.generate, prompt, cached)
+
+    def cache_provider(self):
+        """Provider for prompt prefix caching (prompt_cache.py), or None if unsupported."""
+        return None
+
+
+class GeminiBackend(LLMBackend):
+    """Wraps one genai.GenerativeModel that is reused for every call."""
+    name = "gemini"
+    requires_api_key = True
+
+    def __init__(self, model_name, generation_config=None, safety_settings=None,
+                 timeout=DEFAULT_TIMEOUT_SECONDS, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_seconds=DEFAULT_BACKOFF_SECONDS, system_instruction=None):
+        import google.generativeai as genai
+        self._genai = genai
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.safety_settings = safety_settings
+        self.system_instruction = system_instruction
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        # The model owns the API client; keeping it alive keeps its connection pooled
+        self._model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+            system_instruction=system_instruction
+        )
+        # Cached-content name -> model bound to it (cached content is fixed per model object)
+        self._cached_models = {}
+        self._cached_models_lock = threading.Lock()
+
+    def _model_for(self, cached):
+        if cached is None:
+            return self._model
+        model = self._cached_models.get(cached.name)
+        if model is None:
+            with self._cached_models_lock:
+                model = self._cached_models.get(cached.name)
+                if model is None:
+                    model = self._genai.GenerativeModel.from_cached_content(
+                        cached, generation_config=self.generation_config, safety_settings=self.safety_settings)
+                    self._cached_models[cached.name] = model
+        return model
+
+    def forget_cached(self, cached):
+        """Drops the model bound to deleted cached content."""
+        with self._cached_models_lock:
+            self._cached_models.pop(cached.name, None)
+
+    def cache_provider(self):
+        from prompt_cache import GeminiCacheProvider
+        return GeminiCacheProvider(self)
+
+    def _request_options(self):
+        return {"timeout": self.timeout} if self.timeout else None
+
+    def _retry_delay(self, e, attempt, what):
+        """Backoff before retry `attempt` after error e, or None when e is not worth retrying."""
+        if attempt >= self.max_retries or not is_retryable_error(e):
+            return None
+        # Exponential backoff with jitter before retrying
+        delay = self.backoff_seconds * (2 ** attempt) * (1 + random.random() * 0.25)
+        print(f"{what} failed ({e}); retrying in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries})")
+        return delay
+
+    def _with_retries(self, fn, what="LLM call"):
+        """Calls fn() until it succeeds, retrying quota/transient errors with backoff."""
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, what)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def _with_retries_async(self, fn, what="LLM call"):
+        """_with_retries() for a coroutine function; the backoff does not hold a thread."""
+        attempt = 0
+        while True:
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, what)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def generate(self, prompt, cached=None):
+        return self._with_retries(
+            lambda: self._model_for(cached).generate_content(prompt, request_options=self._request_options()))
+
+    async def generate_async(self, prompt, cached=None):
+        """Native async call (no thread held while waiting); same retry policy as generate()."""
+        return await self._with_retries_async(
+            lambda: self._model_for(cached).generate_content_async(prompt, request_options=self._request_options()))
+
+    def generate_stream(self, prompt, cached=None):
+        """Yields text chunks from Gemini's streaming API (retries only before the first chunk)."""
+        def start():
+            response = self._model_for(cached).generate_content(prompt, stream=True, request_options=self._request_options())
+            chunks = iter(response)
+            return chunks, next(chunks, None)
+        chunks, first = self._with_retries(start, what="LLM stream")
+        if first is None:
+            return
+        yield first.text
+        for chunk in chunks:
+            yield chunk.text
+
+
+class StubResponse:
+    """Minimal stand-in for a Gemini response object."""
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+        self.prompt_feedback = None
+
+
+class StubBackend(LLMBackend):
+    """
+    Deterministic offline backend for tests and benchmarks (no network).
+    With a cached prefix the simulated latency shrinks with the share of the
+    prompt served from the cache (CACHED_LATENCY_SHARE of its full cost).
+    """
+    name = "stub"
+    model_name = "stub"
+    # Latency of cached prompt characters relative to uncached ones
+    CACHED_LATENCY_SHARE = 0.25
+
+    def __init__(self, latency_seconds=0.0, answer_fn=None, system_instruction=None):
+        self.latency_seconds = latency_seconds
+        self.answer_fn = answer_fn
+        self.system_instruction = system_instruction
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _full_prompt(self, prompt, cached):
+        """The prompt as the model sees it: cached content or system instruction, then the prompt."""
+        if cached is not None:
+            return cached.text + prompt
+        return (self.system_instruction or "") + prompt
+
+    def _latency(self, prompt, full_prompt, cached):
+        if not self.latency_seconds or cached is None:
+            return self.latency_seconds
+        cached_share = 1 - len(prompt) / max(1, len(full_prompt))
+        return self.latency_seconds * (1 - cached_share * (1 - self.CACHED_LATENCY_SHARE))
+
+    def generate(self, prompt, cached=None):
+        full_prompt = self._full_prompt(prompt, cached)
+        if self.latency_seconds:
+            time.sleep(self._latency(prompt, full_prompt, cached))
+        return StubResponse(self._answer_text(full_prompt))
+
+    async def generate_async(self, prompt, cached=None):
+        full_prompt = self._full_prompt(prompt, cached)
+        if self.latency_seconds:
+            await asyncio.sleep(self._latency(prompt, full_prompt, cached))
+        return StubResponse(self._answer_text(full_prompt))
+
+    def cache_provider(self):
+        from prompt_cache import StubCacheProvider
+        return StubCacheProvider()
+
+    def _answer_text(self, prompt):
+        with self._lock:
+            self.calls += 1
+        if self.answer_fn:
+            return self.answer_fn(prompt)
+        # Echo the first context line so answers still depend on retrieval
+        context = prompt.split("---", 2)[1].strip() if prompt.count("---") >= 2 else prompt
+        first_line = context.splitlines()[0] if context else ""
+        return f"[stub answer] {first_line}"
+
+    def generate_stream(self, prompt, cached=None):
+        """Yields the stub answer word by word, spreading the latency over the chunks."""
+        full_prompt = self._full_prompt(prompt, cached)
+        words = self._answer_text(full_prompt).split(" ")
+        latency = self._latency(prompt, full_prompt, cached)
+        for i, word in enumerate(words):
+            if latency:
+                time.sleep(latency / len(words))
+            yield word if i == 0 else " " + word
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing calls evenly at rate_per_minute (token bucket of
+    size burst). acquire() blocks until the caller may make its call.
+    """
+
+    def __init__(self, rate_per_minute, burst=1):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute else 0.0
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed; returns the seconds spent waiting."""
+        if not self.interval:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) / self.interval)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) * self.interval
+            time.sleep(delay)
+            waited += delay
+
+
+# --- Process-wide backend holder ---
+# One backend per system instruction (with and without PROMPT_CACHE the model differs)
+_backends = {}
+# Backend installed with set_backend(), served to every caller
+_override = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(model_name, generation_config=None, safety_settings=None, system_instruction=None):
+    """Creates the backend selected by LLM_BACKEND ('gemini' by default, or 'stub')."""
+    kind = os.getenv("LLM_BACKEND", "gemini").lower()
+    if kind == "stub":
+        return StubBackend(latency_seconds=float(os.getenv("STUB_LLM_LATENCY", "0")),
+                           system_instruction=system_instruction)
+    return GeminiBackend(
+        model_name,
+        generation_config=generation_config,
+        safety_settings=safety_settings,
+        timeout=float(os.getenv("LLM_TIMEOUT", DEFAULT_TIMEOUT_SECONDS)),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+        backoff_seconds=float(os.getenv("LLM_RETRY_BACKOFF", DEFAULT_BACKOFF_SECONDS)),
+        system_instruction=system_instruction,
+    )
+
+
+def get_backend(model_name, generation_config=None, safety_settings=None, system_instruction=None):
+    """
+    Returns the shared backend for system_instruction, creating it on first use
+    (thread-safe). Creation errors propagate and nothing is cached, so the next call retries.
+    """
+    if _override is not None:
+        return _override
+    backend = _backends.get(system_instruction)
+    if backend is None:
+        with _backend_lock:
+            backend = _backends.get(system_instruction)
+            if backend is None:
+                backend = _backends[system_instruction] = create_backend(
+                    model_name, generation_config, safety_settings, system_instruction)
+    return backend
+
+
+def set_backend(backend):
+    """Serves `backend` to every caller (e.g. a StubBackend in tests); None resets to created backends."""
+    global _override
+    with _backend_lock:
+        _override = backend
+        _backends.clear()
@@ -1,7 +1,13 @@
 # llm_handler.py
 import os
+import time
 import google.generativeai as genai
 from dotenv import load_dotenv
+from answer_cache import get_answer_cache, make_cache_key
+from llm_client import get_backend
+from context_assembler import estimate_tokens
+from prompt_cache import get_prompt_cache, prompt_cache_enabled
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,7 +20,12 @@ if not api_key:
     # For now, the configure call below will likely fail, which is caught.
 else:
      try:
-        genai.configure(api_key=api_key)
+        # Optional transport override ("grpc" or "rest"); the default keeps a pooled gRPC channel
+        transport = os.getenv("GEMINI_TRANSPORT")
+        if transport:
+            genai.configure(api_key=api_key, transport=transport)
+        else:
+            genai.configure(api_key=api_key)
 
         
      except Exception as e:
@@ -40,91 +51,309 @@ generation_config = {
   "max_output_tokens": 250, # Limit output length
 }
 
+# Select the Gemini model
+# !!! IMPORTANT: Keep this as 'gemini-1.0-pro' for now. !!!
+# !!! After running the debug code, change this line !!!
+# !!! to use a valid model name printed in your terminal. !!!
+# Example: model_name="models/gemini-1.5-flash-latest"
+target_model_name = "models/gemini-1.5-pro-latest"
 
-def get_llm_response(context, query):
-    """Sends context and query to Google Gemini Pro and gets response."""
+# Fixed instruction block, built once; only context and question vary per call.
+# With PROMPT_CACHE=provider it is the model's system instruction instead (see prompt_cache.py)
+SYSTEM_INSTRUCTION = (
+    "You are a helpful financial assistant. Your task is to answer the user's question based *only* on the provided 'Context'. "
+    "Do not use any external knowledge or information you might have. If the context does not contain the information needed "
+    "to answer the question, state clearly that the information is not available in the provided knowledge base. "
+    "Keep your answer concise and directly address the user's question."
+)
+CONTEXT_HEADER = "\n\nContext:\n---\n"
+PROMPT_PREFIX = SYSTEM_INSTRUCTION + CONTEXT_HEADER
+
+
+def _context_block(context):
+    return "".join((CONTEXT_HEADER, context, "\n---\n\n"))
+
+
+def _question_block(query):
+    return "".join(("User Question: ", query, "\n\nAnswer:"))
+
+
+def _join_prompt(context, query):
+    return "".join((PROMPT_PREFIX, context, "\n---\n\nUser Question: ", query, "\n\nAnswer:"))
+
+
+@metrics.timed_function("prompt_build")
+def build_prompt(context, query):
+    """Builds the full prompt with a single join; its estimated tokens are added to the prompt_tokens counter."""
+    prompt = _join_prompt(context, query)
+    metrics.inc("prompt_tokens", estimate_tokens(prompt))
+    return prompt
+
+
+@metrics.timed_function("prompt_build")
+def build_request(backend, context, query):
+    """
+    Builds what is sent to the backend: returns (prompt, cached, prompt_cache).
+    Backends without the system instruction get the full prompt. Otherwise the prompt
+    starts at the context block, or - when the prompt cache holds that block - is just
+    the question and `cached` names the provider cached content to prepend.
+    prompt_tokens counts the input tokens not served from a cache.
+    """
+    if backend.system_instruction != SYSTEM_INSTRUCTION:
+        prompt = _join_prompt(context, query)
+        metrics.inc("prompt_tokens", estimate_tokens(prompt))
+        return prompt, None, None
+    prompt_cache = get_prompt_cache(backend, SYSTEM_INSTRUCTION)
+    context_block = _context_block(context)
+    cached = prompt_cache.lookup(context_block) if prompt_cache else None
+    if cached is not None:
+        prompt = _question_block(query)
+        metrics.inc("prompt_tokens", estimate_tokens(prompt))
+    else:
+        prompt = context_block + _question_block(query)
+        metrics.inc("prompt_tokens", estimate_tokens(SYSTEM_INSTRUCTION) + estimate_tokens(prompt))
+    return prompt, cached, prompt_cache
 
-    # Double-check if the API key was successfully loaded and configured
-    if not api_key:
-         return "Error: Google API key not configured. Please check your .env file and ensure the key is set."
 
-    # Select the Gemini model
-    # !!! IMPORTANT: Keep this as 'gemini-1.0-pro' for now. !!!
-    # !!! After running the debug code, change this line !!!
-    # !!! to use a valid model name printed in your terminal. !!!
-    # Example: model_name="models/gemini-1.5-flash-latest"
-    target_model_name = "models/gemini-1.5-pro-latest"
- # <-- Keep this for the debug run
+def _record_call(prompt_cache, cached, seconds):
+    """Reports one LLM call's latency to the prompt cache (cached vs. uncached split)."""
+    if prompt_cache is not None:
+        prompt_cache.record_latency(cached is not None, seconds)
 
+
+def prompt_tokens(context, query):
+    """Estimated tokens of the prompt sent for (context, query), for per-request reports."""
+    return estimate_tokens(_join_prompt(context, query))
+
+
+def _resolve_backend():
+    """Returns (backend, error_message); error_message is None when the backend can be called."""
+    # Shared backend (one long-lived model/client per process, see llm_client)
     try:
-        model = genai.GenerativeModel(
-            model_name=target_model_name, # Use the variable defined above
-            generation_config=generation_config,
-            safety_settings=safety_settings
-            )
+        # Cached prefixes hold the instruction, so with caching on it is a system instruction
+        system_instruction = SYSTEM_INSTRUCTION if prompt_cache_enabled() else None
+        backend = get_backend(target_model_name, generation_config, safety_settings, system_instruction)
     except Exception as e:
          print(f"Error creating Gemini model instance for '{target_model_name}': {e}")
          # Check if the error message specifically mentions the model name is invalid
          if "model not found" in str(e).lower() or "is not found" in str(e).lower():
-              return f"Error: The specified model '{target_model_name}' could not be found or accessed. Please check the model name and ensure it's available (see terminal output from model listing)."
-         return f"Error: Could not initialize the Gemini model: {e}"
+              return None, f"Error: The specified model '{target_model_name}' could not be found or accessed. Please check the model name and ensure it's available (see terminal output from model listing)."
+         return None, f"Error: Could not initialize the Gemini model: {e}"
+
+    # Double-check if the API key was successfully loaded and configured
+    if backend.requires_api_key and not api_key:
+         return backend, "Error: Google API key not configured. Please check your .env file and ensure the key is set."
+    return backend, None
+
+
+def _prepare_request(context, query):
+    """
+    Resolves the shared backend and the answer-cache key for one request.
+    Returns (backend, cache, cache_key, early_answer); early_answer is an error
+    message or a cached answer when no LLM call is needed, otherwise None.
+    """
+    backend, error = _resolve_backend()
+    if error is not None:
+        return backend, None, None, error
+
+    # Serve identical (model, config, query, context) requests from the answer cache
+    cache = get_answer_cache()
+    cache_key = make_cache_key(backend.model_name, generation_config, query, context) if cache else None
+    if cache:
+        cached_answer = cache.get(cache_key)
+        metrics.inc("answer_cache_lookups", result="miss" if cached_answer is None else "hit")
+        if cached_answer is not None:
+            return backend, cache, cache_key, cached_answer
+
+    return backend, cache, cache_key, None
+
+
+def is_error_answer(answer):
+    """True if a get_llm_response* result is one of the error messages above, not an answer."""
+    return not answer or answer.lstrip().startswith("Error:")
+
+
+def _describe_api_error(e):
+    """Maps an exception from the LLM call to a user-friendly error message."""
+    # Check specific exception types if needed (e.g., google.api_core.exceptions.ResourceExhausted)
+    error_str = str(e).lower()
+    if "api key not valid" in error_str or "permission denied" in error_str:
+         return "Error: The provided Google API key is not valid or lacks permissions. Please check your .env file and Google Cloud project settings."
+    if "resource has been exhausted" in error_str or "quota exceeded" in error_str:
+         return "Error: Google API quota exceeded (e.g., requests per minute). Please wait and try again or check your usage limits."
+    if "is not found for api version" in error_str or "not supported for generatecontent" in error_str:
+         # This error *should* be caught earlier during model instantiation, but added as a fallback
+         return f"Error: Model '{target_model_name}' is likely not supported or found via the current API connection. Check the model listing output in the terminal. Details: {e}"
 
+    return f"Error: An unexpected error occurred while communicating with the Google Gemini API: {e}"
 
-    # Construct the prompt for Gemini
-    prompt = f"""You are a helpful financial assistant. Your task is to answer the user's question based *only* on the provided 'Context'. Do not use any external knowledge or information you might have. If the context does not contain the information needed to answer the question, state clearly that the information is not available in the provided knowledge base. Keep your answer concise and directly address the user's question.
 
-Context:
----
-{context}
----
+def get_llm_response(context, query):
+    """Sends context and query to Google Gemini Pro and gets response."""
 
-User Question: {query}
+    backend, cache, cache_key, early_answer = _prepare_request(context, query)
+    if early_answer is not None:
+        return early_answer
 
-Answer:"""
+    prompt, cached, prompt_cache = build_request(backend, context, query)
 
     try:
-        # Generate content using the model
-        response = model.generate_content(prompt)
-
-        # Extract the text from the response
-        # Add checks for response structure and potential safety blocks
-        if hasattr(response, 'text'):
-             answer = response.text
-        elif response.parts:
-             # If .text isn't available but parts are, try concatenating them
-             answer = "".join(part.text for part in response.parts)
-        else:
-             # Handle cases where the response might be blocked due to safety settings
-             # or is otherwise empty. Check response.prompt_feedback for details.
-             feedback = getattr(response, 'prompt_feedback', None)
-             block_reason = getattr(feedback, 'block_reason', None) if feedback else None
-             if block_reason:
-                  safety_ratings_str = "\n".join([f"- {rating.category}: {rating.probability}" for rating in getattr(feedback, 'safety_ratings', [])]) if getattr(feedback, 'safety_ratings', []) else "N/A"
-                  return f"Error: The response was blocked due to safety settings. Reason: {block_reason}\nSafety Ratings:\n{safety_ratings_str}"
-             else:
-                  # Check if the response object itself has helpful error info
-                  try:
-                      # Sometimes error details might be within the object representation
-                      print(f"Debug: Received unusual response object: {response}")
-                  except Exception:
-                      pass # Avoid errors during printing the response object itself
-                  return "Error: Received an empty or unexpected response structure from the LLM."
-
-
-        return answer.strip()
+        # Generate content using the shared backend (retries quota errors with backoff)
+        start = time.perf_counter()
+        with metrics.timed("llm_request"):
+            response = backend.generate(prompt, cached)
+        _record_call(prompt_cache, cached, time.perf_counter() - start)
+        return _finish_response(response, cache, cache_key)
 
     except Exception as e:
         # Catch potential errors during API call (e.g., network issues, invalid requests)
         print(f"Error calling Google Gemini API: {e}")
+        metrics.inc("llm_errors")
         # Provide a user-friendly error message
-        # Check specific exception types if needed (e.g., google.api_core.exceptions.ResourceExhausted)
-        error_str = str(e).lower()
-        if "api key not valid" in error_str or "permission denied" in error_str:
-             return "Error: The provided Google API key is not valid or lacks permissions. Please check your .env file and Google Cloud project settings."
-        if "resource has been exhausted" in error_str or "quota exceeded" in error_str:
-             return "Error: Google API quota exceeded (e.g., requests per minute). Please wait and try again or check your usage limits."
-        if "is not found for api version" in error_str or "not supported for generatecontent" in error_str:
-             # This error *should* be caught earlier during model instantiation, but added as a fallback
-             return f"Error: Model '{target_model_name}' is likely not supported or found via the current API connection. Check the model listing output in the terminal. Details: {e}"
-
-        return f"Error: An unexpected error occurred while communicating with the Google Gemini API: {e}"
\ No newline at end of file
+        return _describe_api_error(e)
+
+
+async def get_llm_response_async(context, query):
+    """
+    Coroutine version of get_llm_response: the LLM call is awaited (it does not
+    hold a thread), so one process can wait on many slow calls at once.
+    Cancelling the task cancels the in-flight request.
+    """
+    backend, cache, cache_key, early_answer = _prepare_request(context, query)
+    if early_answer is not None:
+        return early_answer
+
+    try:
+        prompt, cached, prompt_cache = build_request(backend, context, query)
+        start = time.perf_counter()
+        with metrics.timed("llm_request"):
+            response = await backend.generate_async(prompt, cached)
+        _record_call(prompt_cache, cached, time.perf_counter() - start)
+        return _finish_response(response, cache, cache_key)
+    except Exception as e:
+        print(f"Error calling Google Gemini API: {e}")
+        metrics.inc("llm_errors")
+        return _describe_api_error(e)
+
+
+def prefetch_llm_response(context, query, allow_call=None):
+    """
+    Generates the answer for (context, query) into the answer cache without returning it;
+    the entry is flagged as prefetched. allow_call() is asked right before the LLM call
+    (the prefetch quota) and can veto it. Nothing is counted as an answer-cache lookup.
+    Returns 'generated', 'cached' (already there), 'over_quota', 'no_cache' or 'failed'.
+    """
+    cache = get_answer_cache()
+    if not cache:
+        return "no_cache"
+    backend, error = _resolve_backend()
+    if error is not None:
+        return "failed"
+    cache_key = make_cache_key(backend.model_name, generation_config, query, context)
+    if cache.contains(cache_key):
+        return "cached"
+    if allow_call is not None and not allow_call():
+        return "over_quota"
+
+    try:
+        prompt, cached, prompt_cache = build_request(backend, context, query)
+        start = time.perf_counter()
+        with metrics.timed("llm_prefetch"):
+            response = backend.generate(prompt, cached)
+        _record_call(prompt_cache, cached, time.perf_counter() - start)
+        _finish_response(response, cache, cache_key, prefetched=True)
+    except Exception as e:
+        print(f"Warning: prefetching an answer failed: {e}")
+        return "failed"
+    # Blocked or empty responses are not cached
+    return "generated" if cache.contains(cache_key) else "failed"
+
+
+@metrics.timed_function("response_parse")
+def _finish_response(response, cache, cache_key, prefetched=False):
+    """Extracts the answer text from an LLM response (caching it) or returns an error message."""
+    # Extract the text from the response
+    # Add checks for response structure and potential safety blocks
+    if hasattr(response, 'text'):
+         answer = response.text
+    elif response.parts:
+         # If .text isn't available but parts are, try concatenating them
+         answer = "".join(part.text for part in response.parts)
+    else:
+         # Handle cases where the response might be blocked due to safety settings
+         # or is otherwise empty. Check response.prompt_feedback for details.
+         feedback = getattr(response, 'prompt_feedback', None)
+         block_reason = getattr(feedback, 'block_reason', None) if feedback else None
+         if block_reason:
+              safety_ratings_str = "\n".join([f"- {rating.category}: {rating.probability}" for rating in getattr(feedback, 'safety_ratings', [])]) if getattr(feedback, 'safety_ratings', []) else "N/A"
+              return f"Error: The response was blocked due to safety settings. Reason: {block_reason}\nSafety Ratings:\n{safety_ratings_str}"
+         else:
+              # Check if the response object itself has helpful error info
+              try:
+                  # Sometimes error details might be within the object representation
+                  print(f"Debug: Received unusual response object: {response}")
+              except Exception:
+                  pass # Avoid errors during printing the response object itself
+              return "Error: Received an empty or unexpected response structure from the LLM."
+
+    answer = answer.strip()
+    # Only successful answers are cached; error strings are returned above
+    if cache:
+        cache.put(cache_key, answer, prefetched)
+    return answer
+
+
+def stream_llm_response(context, query):
+    """
+    Streaming variant of get_llm_response: yields the answer as text chunks.
+    Cached answers and error messages are yielded as a single chunk; the full
+    answer is stored in the answer cache once the stream completes.
+    """
+    backend, cache, cache_key, early_answer = _prepare_request(context, query)
+    if early_answer is not None:
+        yield early_answer
+        return
+
+    chunks = []
+    prompt, cached, prompt_cache = build_request(backend, context, query)
+    start = time.perf_counter()
+    try:
+        for chunk in backend.generate_stream(prompt, cached):
+            if chunk:
+                if not chunks:
+                    metrics.observe("llm_first_token", time.perf_counter() - start)
+                chunks.append(chunk)
+                yield chunk
+        metrics.observe("llm_request", time.perf_counter() - start)
+        _record_call(prompt_cache, cached, time.perf_counter() - start)
+    except Exception as e:
+        print(f"Error streaming from Google Gemini API: {e}")
+        metrics.inc("llm_errors")
+        # Blocked responses raise here too (chunk.text has no parts to read)
+        yield ("\n\n" if chunks else "") + _describe_api_error(e)
+        return
+
+    answer = "".join(chunks).strip()
+    if not answer:
+        yield "Error: Received an empty or unexpected response structure from the LLM."
+        return
+    if cache:
+        cache.put(cache_key, answer)
+
+
+class StreamTimer:
+    """Wraps a chunk iterator and records time-to-first-token and total time (seconds)."""
+
+    def __init__(self):
+        self.time_to_first_token = None
+        self.total_time = None
+        self.chunks = 0
+
+    def wrap(self, chunks):
+        start = time.perf_counter()
+        for chunk in chunks:
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - start
+            self.chunks += 1
+            yield chunk
+        self.total_time = time.perf_counter() - start
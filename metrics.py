@@ -0,0 +1,319 @@
+# metrics.py
+# In-process tracing/metrics: per-stage latency histograms (p50/p95/p99),
+# counters, a Prometheus text exposition (served by api_server at /metrics,
+# shown in the Streamlit debug panel) and opt-in per-request profiling.
+#
+# Stages are timed with `with metrics.timed("stage"):` or the @metrics.timed_function
+# decorator. Set METRICS_DISABLED=1 to turn recording off.
+# Profiling: METRICS_PROFILE=cprofile|sample profiles every request (or pass
+# mode= to profile_request); the last few reports are kept in memory.
+import cProfile
+import contextlib
+import contextvars
+import functools
+import inspect
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+# Histogram bucket upper bounds in seconds (Prometheus "le" labels)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Recent samples kept per stage for exact quantiles
+QUANTILE_WINDOW = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "mf_rag"
+# Profiles kept in memory (most recent last)
+MAX_PROFILES = 20
+# Interval between stack samples in "sample" profiling mode
+SAMPLE_INTERVAL_SECONDS = 0.005
+# Set inside muted(): nothing is recorded for the current context
+_muted = contextvars.ContextVar("metrics_muted", default=False)
+
+
+class LatencyHistogram:
+    """Cumulative bucket counts plus a sliding window of recent samples for quantiles."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window=QUANTILE_WINDOW):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # last slot = +Inf
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+                return
+        self.bucket_counts[-1] += 1
+
+    def quantiles(self, qs=QUANTILES):
+        """{q: seconds} over the recent window (nearest-rank)."""
+        if not self.recent:
+            return {q: None for q in qs}
+        ordered = sorted(self.recent)
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs}
+
+
+class MetricsRegistry:
+    """Thread-safe store of stage histograms and labelled counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}   # stage -> LatencyHistogram
+        self._counters = Counter()  # (name, sorted label items) -> value
+        self.started_at = time.time()
+        self.enabled = os.getenv("METRICS_DISABLED", "0") != "1"
+
+    def observe(self, stage, seconds):
+        if not self.enabled or _muted.get():
+            return
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled or _muted.get():
+            return
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """Plain-dict view: {"stages": {stage: {count, mean_ms, p50_ms, ...}}, "counters": [...]}."""
+        with self._lock:
+            stages = {}
+            for stage, h in sorted(self._histograms.items()):
+                q = h.quantiles()
+                stages[stage] = {"count": h.count, "mean_ms": round(h.total / h.count * 1000, 3) if h.count else None,
+                                 **{f"p{int(k * 100)}_ms": round(v * 1000, 3) if v is not None else None for k, v in q.items()}}
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self._counters.items())]
+        return {"stages": stages, "counters": counters}
+
+    def prometheus_text(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            name = f"{METRIC_PREFIX}_stage_latency_seconds"
+            lines += [f"# HELP {name} Latency of each pipeline stage.", f"# TYPE {name} histogram"]
+            for stage, h in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, n in zip(list(h.buckets) + ["+Inf"], h.bucket_counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.total:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+            qname = f"{METRIC_PREFIX}_stage_latency_recent_seconds"
+            lines += [f"# HELP {qname} Quantiles of the last {QUANTILE_WINDOW} samples per stage.", f"# TYPE {qname} gauge"]
+            for stage, h in sorted(self._histograms.items()):
+                for q, value in h.quantiles().items():
+                    if value is not None:
+                        lines.append(f'{qname}{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+            by_name = {}
+            for (counter, labels), value in sorted(self._counters.items()):
+                by_name.setdefault(counter, []).append((labels, value))
+            for counter, series in by_name.items():
+                full = f"{METRIC_PREFIX}_{counter}_total"
+                lines.append(f"# TYPE {full} counter")
+                for labels, value in series:
+                    label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                    lines.append(f"{full}{{{label_str}}} {value}" if label_str else f"{full} {value}")
+        uptime = f"{METRIC_PREFIX}_uptime_seconds"
+        lines += [f"# TYPE {uptime} gauge", f"{uptime} {time.time() - self.started_at:.1f}"]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# --- Process-wide registry and helpers ---
+registry = MetricsRegistry()
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Records the wall time of the with-block under `stage` (also when it raises)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(stage, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def muted():
+    """Drops the stages and counters recorded in the with-block (background work that is not a request)."""
+    token = _muted.set(True)
+    try:
+        yield
+    finally:
+        _muted.reset(token)
+
+
+def timed_function(stage):
+    """Decorator form of timed() (works for plain and async functions)."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(stage, seconds):
+    registry.observe(stage, seconds)
+
+
+def inc(name, amount=1, **labels):
+    registry.inc(name, amount, **labels)
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+def prometheus_text():
+    return registry.prometheus_text()
+
+
+# --- Per-request profiling ---
+_profiles = deque(maxlen=MAX_PROFILES)
+_profiles_lock = threading.Lock()
+# Profiling requested for the current request: (mode, list collecting its reports)
+_requested_profile = contextvars.ContextVar("requested_profile", default=None)
+
+
+class SamplingProfiler:
+    """
+    Low-overhead statistical profiler: a background thread samples the target
+    thread's stack every interval and counts the innermost frames seen.
+    """
+
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL_SECONDS):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = 0
+        self.functions = Counter()  # "file:line function" -> samples (innermost frame)
+        self.stacks = Counter()     # collapsed "outer;...;inner" stack -> samples
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+                frame = frame.f_back
+            self.functions[names[0]] += 1
+            self.stacks[";".join(reversed(names))] += 1
+
+    def report(self, limit=25):
+        lines = [f"{self.samples} samples every {self.interval * 1000:.1f} ms"]
+        for name, count in self.functions.most_common(limit):
+            lines.append(f"{count / max(1, self.samples) * 100:6.1f}%  {name}")
+        return "\n".join(lines)
+
+
+def profile_mode():
+    """Profiling mode from METRICS_PROFILE: 'cprofile', 'sample' or None (off)."""
+    mode = os.getenv("METRICS_PROFILE", "").lower()
+    return mode if mode in ("cprofile", "sample") else None
+
+
+@contextlib.contextmanager
+def request_profiling(mode):
+    """
+    Turns on profiling (mode 'cprofile' or 'sample', None = off) for every
+    profile_request() block in this context, incl. work copied into thread pools.
+    Yields the list that collects the request's reports.
+    """
+    reports = []
+    token = _requested_profile.set((mode, reports) if mode else None)
+    try:
+        yield reports
+    finally:
+        _requested_profile.reset(token)
+
+
+@contextlib.contextmanager
+def profile_request(label, mode=None):
+    """
+    Profiles the with-block when mode (or the request's mode, or METRICS_PROFILE)
+    is 'cprofile' or 'sample'; otherwise does nothing. Yields a dict that receives
+    the report. cProfile only sees the calling thread.
+    """
+    requested = _requested_profile.get()
+    mode = mode or (requested[0] if requested else None) or profile_mode()
+    result = {"label": label, "mode": mode, "report": None}
+    if mode is None:
+        yield result
+        return
+    start = time.perf_counter()
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+            result["report"] = out.getvalue()
+    else:
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            yield result
+        finally:
+            profiler.stop()
+            result["report"] = profiler.report()
+    result["seconds"] = time.perf_counter() - start
+    result["created_at"] = time.time()
+    with _profiles_lock:
+        _profiles.append(result)
+    if requested:
+        requested[1].append(result)
+
+
+def recent_profiles():
+    """The most recent profiling reports (newest last)."""
+    with _profiles_lock:
+        return list(_profiles)
@@ -0,0 +1,221 @@
+# prefetch.py
+# Speculative answers for predictable follow-up questions (LLM_PREFETCH=1; off by default).
+# After a question about a fund, the next one is usually about its AMC, its primary
+# sector or one of its related factors - ids that are already in the dict returned by
+# graph_query.get_fund_details. For each of them the prefetcher phrases one canonical
+# question, builds its context and generates the answer into the answer cache in the
+# background. The UI and the API offer these questions as suggested follow-ups, so
+# asking one is an answer-cache hit instead of an LLM call.
+# Budget: at most PREFETCH_MAX_CONCURRENCY LLM calls at once, PREFETCH_MAX_PENDING
+# follow-ups waiting (more are dropped) and PREFETCH_QUOTA LLM calls per minute.
+# Answers already cached cost nothing. Prefetched entries are flagged in the answer
+# cache until first asked for, so its prefetch_hit_rate shows whether this pays off.
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import graph_query
+import metrics
+from answer_cache import get_answer_cache, normalize_query
+from context_builder import build_context, context_status
+from intent_parser import parse_intents
+from llm_handler import prefetch_llm_response
+
+# Background LLM calls at once (PREFETCH_MAX_CONCURRENCY)
+DEFAULT_MAX_CONCURRENCY = 2
+# Follow-ups waiting for a worker; new ones are dropped when full (PREFETCH_MAX_PENDING)
+DEFAULT_MAX_PENDING = 16
+# Prefetch LLM calls per minute (PREFETCH_QUOTA)
+DEFAULT_QUOTA_PER_MINUTE = 30
+# Follow-ups per fund: the AMC, the primary sector, then related factors (PREFETCH_MAX_FOLLOWUPS)
+DEFAULT_MAX_FOLLOWUPS = 4
+QUOTA_WINDOW_SECONDS = 60.0
+
+# Canonical question per follow-up: (intent, entities field, question template).
+# Only questions that parse back to that intent and entity are offered (a name can
+# contain another entity's name), so asking one rebuilds the prefetched context.
+FOLLOW_UPS = {
+    "amc": ("get_amc_details", "amc_id", "Tell me about {}"),
+    "sector": ("get_sector_details", "sector_id", "Tell me about the {} sector"),
+    "factor": ("get_factor_details", "factor_id", "Tell me about {}"),
+}
+
+
+def prefetch_enabled():
+    return os.getenv("LLM_PREFETCH", "0") == "1"
+
+
+def _name(details, fallback):
+    name = details.get("name") if details else None
+    return name if isinstance(name, str) and name else fallback
+
+
+def follow_up_requests(fund, max_followups=DEFAULT_MAX_FOLLOWUPS):
+    """
+    Likely next questions after a fund's details, most likely first.
+    Returns a list of (query, intent, entities) built from the get_fund_details dict;
+    intent and entities are what parse_intent makes of the query.
+    """
+    candidates = []
+    if isinstance(fund.get("amc_id"), str):
+        candidates.append(("amc", fund["amc_id"], graph_query.get_amc_details(fund["amc_id"])))
+    if isinstance(fund.get("primary_sector"), str):
+        candidates.append(("sector", fund["primary_sector"], graph_query.get_sector_details(fund["primary_sector"])))
+    for factor_id in fund.get("related_factors") or []:
+        if len(candidates) >= max_followups:
+            break
+        candidates.append(("factor", factor_id, graph_query.get_factor_details(factor_id)))
+
+    expected = []
+    for entity_type, entity_id, details in candidates[:max_followups]:
+        if details is not None:
+            intent, field, template = FOLLOW_UPS[entity_type]
+            expected.append((template.format(_name(details, entity_id)), intent, field, entity_id))
+    if not expected:
+        return []
+    # Parsing the suggestions is not a user request, so it stays out of the intent metrics
+    with metrics.muted():
+        parsed = parse_intents([query for query, _, _, _ in expected])
+    return [(query, parsed_intent, parsed_entities)
+            for (query, intent, field, entity_id), (parsed_intent, parsed_entities) in zip(expected, parsed)
+            if parsed_intent == intent and parsed_entities.get(field) == entity_id]
+
+
+class Prefetcher:
+    """
+    Generates answers for follow-up questions on a few daemon threads, within a
+    concurrency, queue and per-minute quota budget. schedule() never blocks.
+    """
+
+    def __init__(self, max_concurrency=None, max_pending=None, quota_per_minute=None, max_followups=None):
+        self.max_concurrency = max_concurrency or int(os.getenv("PREFETCH_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+        self.max_pending = max_pending or int(os.getenv("PREFETCH_MAX_PENDING", DEFAULT_MAX_PENDING))
+        self.quota_per_minute = quota_per_minute or int(os.getenv("PREFETCH_QUOTA", DEFAULT_QUOTA_PER_MINUTE))
+        self.max_followups = max_followups or int(os.getenv("PREFETCH_MAX_FOLLOWUPS", DEFAULT_MAX_FOLLOWUPS))
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        self._lock = threading.Lock()
+        self._in_flight = set()  # normalized queries queued or running
+        self._calls = deque()    # start times of prefetch LLM calls in the quota window
+        self.stats = {"scheduled": 0, "generated": 0, "cached": 0, "duplicate": 0, "queue_full": 0,
+                      "over_quota": 0, "no_context": 0, "no_cache": 0, "failed": 0}
+        self._threads = []
+        for i in range(self.max_concurrency):
+            # Daemon threads: queued speculative work never delays shutdown
+            thread = threading.Thread(target=self._work, name=f"kb-prefetch-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, result):
+        with self._lock:
+            self.stats[result] += 1
+        metrics.inc("prefetch", result=result)
+
+    def schedule_for_fund(self, fund):
+        """Queues the follow-ups of a get_fund_details dict; returns their questions (the suggestions)."""
+        requests = follow_up_requests(fund, self.max_followups)
+        for request in requests:
+            self.schedule(*request)
+        return [query for query, _, _ in requests]
+
+    def schedule(self, query, intent, entities):
+        """Queues one follow-up unless it is already queued or the queue is full; True if queued."""
+        key = normalize_query(query)
+        with self._lock:
+            if key in self._in_flight:
+                result = "duplicate"
+            else:
+                try:
+                    self._queue.put_nowait((query, intent, entities))
+                    self._in_flight.add(key)
+                    result = "scheduled"
+                except queue.Full:
+                    result = "queue_full"
+            self.stats[result] += 1
+        metrics.inc("prefetch", result=result)
+        return result == "scheduled"
+
+    def _take_quota(self):
+        """Claims one LLM call from the per-minute quota; False when it is used up."""
+        now = time.monotonic()
+        with self._lock:
+            while self._calls and now - self._calls[0] >= QUOTA_WINDOW_SECONDS:
+                self._calls.popleft()
+            if len(self._calls) >= self.quota_per_minute:
+                return False
+            self._calls.append(now)
+            return True
+
+    def _work(self):
+        while True:
+            query, intent, entities = self._queue.get()
+            try:
+                self._count(self._prefetch(query, intent, entities))
+            except Exception as e:
+                print(f"Warning: prefetching '{query}' failed: {e}")
+                self._count("failed")
+            finally:
+                with self._lock:
+                    self._in_flight.discard(normalize_query(query))
+
+    def _prefetch(self, query, intent, entities):
+        # Built as the pipeline builds it for the parsed question (against the current store)
+        with metrics.muted():
+            context, _ = build_context(intent, entities)
+        if context_status(intent, context) != "answerable":
+            return "no_context"
+        return prefetch_llm_response(context, query, self._take_quota)
+
+    def get_stats(self):
+        """Prefetch counters, queue depth and the answer cache's prefetch hit counts."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._in_flight)
+            stats["quota_used"] = len(self._calls)
+        cache = get_answer_cache()
+        if cache:
+            cache_stats = cache.get_stats()
+            for name in ("prefetch_stores", "prefetch_hits", "prefetch_hit_rate"):
+                stats[name] = cache_stats[name]
+        return stats
+
+
+# One prefetcher per process, created on first use (its threads start with it)
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+def get_prefetcher():
+    """Returns the process-wide Prefetcher, or None when LLM_PREFETCH is off."""
+    global _prefetcher
+    if not prefetch_enabled():
+        return None
+    if _prefetcher is None:
+        with _prefetcher_lock:
+            if _prefetcher is None:
+                _prefetcher = Prefetcher()
+    return _prefetcher
+
+
+def prefetch_follow_ups(intent, entities):
+    """
+    Called after a query is answered: for get_fund_details queries, schedules the
+    follow-ups and returns their questions. Returns [] when prefetching is off,
+    for other intents and on errors (prefetching never fails a request).
+    """
+    if intent != "get_fund_details":
+        return []
+    prefetcher = get_prefetcher()
+    if prefetcher is None:
+        return []
+    try:
+        fund = graph_query.get_fund_details(entities.get("fund_internal_key"))
+        return prefetcher.schedule_for_fund(fund) if fund else []
+    except Exception as e:
+        print(f"Warning: could not schedule follow-up prefetches: {e}")
+        return []
+
+
+def prefetch_stats():
+    """Stats of the process's prefetcher ({} when prefetching is off or nothing was scheduled yet)."""
+    return _prefetcher.get_stats() if _prefetcher is not None else {}
@@ -0,0 +1,299 @@
+# prompt_cache.py
+# Provider-side prompt prefix caching (PROMPT_CACHE=provider; off by default).
+# Every prompt starts with the same instruction block, and popular entities keep
+# producing the same context block. With caching on:
+#   - the instruction block becomes the model's system instruction, so it is not
+#     rebuilt into every prompt;
+#   - a context block sent HOT_CONTEXT_USES times is uploaded once, together with the
+#     instruction, as provider cached content (Gemini CachedContent), and later
+#     requests only send the question with a reference to it.
+# Entries live for a TTL, are refreshed while still in use and deleted when evicted.
+# Providers only cache prefixes above a minimum size (GeminiCacheProvider.min_tokens);
+# the instruction plus a context packed into CONTEXT_TOKEN_BUDGET must reach it, so
+# with Gemini the default 500-token budget has to be raised for blocks to be cached.
+# Saved input tokens and the latency of cached vs. uncached calls go to metrics.
+# StubCacheProvider keeps everything in memory for tests and benchmarks.
+import datetime
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from context_assembler import estimate_tokens, token_budget
+
+# Cached content lifetime (PROMPT_CACHE_TTL overrides)
+DEFAULT_TTL_SECONDS = 3600
+# Entries are refreshed once less than this share of their TTL remains
+REFRESH_MARGIN = 0.2
+# A context block is cached after it has been sent this many times (PROMPT_CACHE_HOT_USES)
+HOT_CONTEXT_USES = 3
+# Cached context blocks kept at once (least recently used are deleted first)
+MAX_CACHED_CONTEXTS = 64
+# Use counts kept per cached entry slot; the least recently sent blocks are forgotten first
+TRACKED_BLOCKS_PER_CONTEXT = 16
+# Use count marking a block whose cache entry is being created
+CREATING = float("-inf")
+
+
+def prompt_cache_enabled():
+    return os.getenv("PROMPT_CACHE", "off").lower() == "provider"
+
+
+class GeminiCacheProvider:
+    """Creates, refreshes and deletes Gemini CachedContent for one backend."""
+    # Gemini rejects smaller cached content (1,024 tokens for Flash models, more for Pro)
+    min_tokens = 1024
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, system_instruction, contents, ttl_seconds):
+        from google.generativeai import caching
+        return caching.CachedContent.create(
+            model=self.backend.model_name,
+            system_instruction=system_instruction,
+            contents=[contents],
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        )
+
+    def refresh(self, handle, ttl_seconds):
+        handle.update(ttl=datetime.timedelta(seconds=ttl_seconds))
+
+    def delete(self, handle):
+        self.backend.forget_cached(handle)
+        handle.delete()
+
+    def cached_tokens(self, handle, fallback):
+        usage = getattr(handle, "usage_metadata", None)
+        return getattr(usage, "total_token_count", None) or fallback
+
+
+class StubCachedContent:
+    """In-memory stand-in for a provider cache entry."""
+
+    def __init__(self, name, system_instruction, contents, expire_time):
+        self.name = name
+        self.system_instruction = system_instruction
+        self.contents = contents
+        self.expire_time = expire_time
+
+    @property
+    def text(self):
+        return self.system_instruction + self.contents
+
+
+class StubCacheProvider:
+    """Local provider for tests: entries are kept in a dict and expire on the wall clock."""
+    min_tokens = 0
+
+    def __init__(self):
+        self.entries = {}
+        self._ids = itertools.count(1)
+        self.created = self.refreshed = self.deleted = 0
+
+    def create(self, system_instruction, contents, ttl_seconds):
+        handle = StubCachedContent(f"cachedContents/stub-{next(self._ids)}", system_instruction, contents,
+                                   time.time() + ttl_seconds)
+        self.entries[handle.name] = handle
+        self.created += 1
+        return handle
+
+    def refresh(self, handle, ttl_seconds):
+        handle.expire_time = time.time() + ttl_seconds
+        self.refreshed += 1
+
+    def delete(self, handle):
+        if self.entries.pop(handle.name, None) is not None:
+            self.deleted += 1
+
+    def cached_tokens(self, handle, fallback):
+        return fallback
+
+
+class CacheEntry:
+    def __init__(self, handle, tokens, ttl_seconds):
+        self.handle = handle
+        self.tokens = tokens
+        self.expires_at = time.monotonic() + ttl_seconds
+        self.hits = 0
+
+
+class PromptCache:
+    """
+    Decides per request whether its context block is served from provider cached
+    content, creating, refreshing and evicting entries as needed. Blocks below
+    min_tokens (the provider's minimum unless PROMPT_CACHE_MIN_TOKENS is set) are
+    sent normally and not counted.
+    """
+
+    def __init__(self, provider, system_instruction, ttl_seconds=None, min_tokens=None,
+                 hot_uses=None, max_contexts=MAX_CACHED_CONTEXTS):
+        self.provider = provider
+        self.system_instruction = system_instruction
+        self.ttl_seconds = ttl_seconds or float(os.getenv("PROMPT_CACHE_TTL", DEFAULT_TTL_SECONDS))
+        if min_tokens is None:
+            min_tokens = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", provider.min_tokens))
+        self.min_tokens = min_tokens
+        self.hot_uses = hot_uses or int(os.getenv("PROMPT_CACHE_HOT_USES", HOT_CONTEXT_USES))
+        self.max_contexts = max_contexts
+        self._entries = OrderedDict()  # context key -> CacheEntry (LRU order)
+        self._uses = OrderedDict()     # context key -> times sent without a cache entry (LRU order)
+        self._max_tracked = max_contexts * TRACKED_BLOCKS_PER_CONTEXT
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "created": 0, "refreshed": 0, "evicted": 0, "errors": 0,
+                      "saved_tokens": 0}
+        self._latency = {"cached": [0, 0.0], "uncached": [0, 0.0]}  # kind -> [calls, seconds]
+        largest = estimate_tokens(system_instruction) + token_budget()
+        if largest < self.min_tokens:
+            print(f"Warning: prompt cache needs {self.min_tokens} tokens but instruction + context reach about "
+                  f"{largest}; raise CONTEXT_TOKEN_BUDGET for context blocks to be cached")
+
+    @staticmethod
+    def _key(block):
+        return hashlib.sha1(block.encode("utf-8")).hexdigest()
+
+    def lookup(self, context_block):
+        """
+        Returns the provider handle whose cached content already holds the system
+        instruction + context_block, or None if the block has to be sent in the prompt.
+        """
+        key = self._key(context_block)
+        now = time.monotonic()
+        create = refresh = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                # Expired on the provider side already; forget it locally
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                # Extend the lifetime ahead of expiry (pushed forward now so only one caller refreshes)
+                refresh = entry.expires_at - now < REFRESH_MARGIN * self.ttl_seconds
+                if refresh:
+                    entry.expires_at = now + self.ttl_seconds
+                entry.hits += 1
+                self.stats["hits"] += 1
+                self.stats["saved_tokens"] += entry.tokens
+            else:
+                self.stats["misses"] += 1
+                tokens = estimate_tokens(self.system_instruction) + estimate_tokens(context_block)
+                if tokens >= self.min_tokens:
+                    uses = self._uses.pop(key, 0) + 1
+                    create = uses >= self.hot_uses
+                    # CREATING claims the upload so concurrent requests do not send it twice
+                    self._uses[key] = CREATING if create else uses
+                    while len(self._uses) > self._max_tracked:
+                        self._uses.popitem(last=False)
+
+        if entry is not None:
+            metrics.inc("prompt_cache_requests", result="hit")
+            metrics.inc("prompt_cache_saved_tokens", entry.tokens)
+            if refresh:
+                self._refresh(entry)
+            return entry.handle
+        metrics.inc("prompt_cache_requests", result="miss")
+        if create:
+            # The upload runs outside the lock; this request still sends the block itself
+            self._create(key, context_block, tokens)
+        return None
+
+    def _create(self, key, context_block, tokens):
+        try:
+            handle = self.provider.create(self.system_instruction, context_block, self.ttl_seconds)
+        except Exception as e:
+            # e.g. below the provider's minimum size: keep sending the block normally
+            print(f"Warning: could not create prompt cache entry: {e}")
+            with self._lock:
+                self.stats["errors"] += 1
+                self._uses.pop(key, None)
+            return
+        evicted = []
+        with self._lock:
+            self._uses.pop(key, None)
+            self._entries[key] = CacheEntry(handle, self.provider.cached_tokens(handle, tokens), self.ttl_seconds)
+            self.stats["created"] += 1
+            while len(self._entries) > self.max_contexts:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for entry in evicted:
+            self._delete(entry)
+
+    def _refresh(self, entry):
+        try:
+            self.provider.refresh(entry.handle, self.ttl_seconds)
+        except Exception as e:
+            print(f"Warning: could not refresh prompt cache entry: {e}")
+            with self._lock:
+                self.stats["errors"] += 1
+            return
+        with self._lock:
+            self.stats["refreshed"] += 1
+
+    def _delete(self, entry):
+        try:
+            self.provider.delete(entry.handle)
+        except Exception as e:
+            print(f"Warning: could not delete prompt cache entry: {e}")
+            with self._lock:
+                self.stats["errors"] += 1
+            return
+        with self._lock:
+            self.stats["evicted"] += 1
+
+    def record_latency(self, cached, seconds):
+        """Records one LLM call's latency under llm_request_cached / llm_request_uncached."""
+        kind = "cached" if cached else "uncached"
+        metrics.observe(f"llm_request_{kind}", seconds)
+        with self._lock:
+            self._latency[kind][0] += 1
+            self._latency[kind][1] += seconds
+
+    def clear(self):
+        """Deletes every cached entry (e.g. on shutdown)."""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self._uses.clear()
+        for entry in entries:
+            self._delete(entry)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._entries))
+            for kind, (calls, seconds) in self._latency.items():
+                stats[f"{kind}_calls"] = calls
+                stats[f"{kind}_avg_ms"] = round(seconds / calls * 1000, 3) if calls else None
+        return stats
+
+
+# --- One cache per backend (the provider belongs to the backend) ---
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_prompt_cache(backend, system_instruction):
+    """Returns the prompt cache for a backend, or None when PROMPT_CACHE is off or the backend cannot cache."""
+    if not prompt_cache_enabled():
+        return None
+    cache = _caches.get(id(backend))
+    if cache is None:
+        provider = backend.cache_provider()
+        if provider is None:
+            return None
+        with _caches_lock:
+            cache = _caches.get(id(backend))
+            if cache is None:
+                # Keep the backend referenced so its id() is not reused while cached here
+                cache = _caches[id(backend)] = PromptCache(provider, system_instruction)
+                cache.backend = backend
+    return cache
+
+
+def prompt_cache_stats():
+    """Stats of every prompt cache in the process, keyed by backend name (empty when off)."""
+    with _caches_lock:
+        caches = list(_caches.values())
+    return {cache.backend.name: cache.get_stats() for cache in caches}
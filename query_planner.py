@@ -0,0 +1,176 @@
+# query_planner.py
+# Compound, multi-entity queries such as
+#   "high risk funds in Energy managed by AMC_X affected by Interest Rates".
+# Every entity / constraint in the query is extracted (not just the first match)
+# and executed as set algebra over fund bitsets: values of the same kind are
+# unioned ("Energy or Finance"), different kinds are intersected, and the
+# intersections run from the most selective set to the least, stopping as soon
+# as the running result is empty. Bitsets are packed numpy arrays (one bit per
+# fund row) built once per entity and cached with the knowledge-base version.
+import re
+from collections import namedtuple
+
+import numpy as np
+
+import data_loader
+from kb_codes import normalize_category
+from kg_index import get_graph_index
+
+# Constraint kinds, in the order they are listed in context headers
+CONSTRAINT_KINDS = ("risk", "sector", "amc", "factor")
+# Risk words only count as a constraint when they are whole words ("low", not "follow")
+# and the query talks about risk ("high risk", not "high growth")
+RISK_PATTERN = re.compile(r"\b(high|medium|low)\b")
+RISK_WORDS = ("risk", "risky")
+
+# One constraint: kind in CONSTRAINT_KINDS, value is the entity ID (or risk level)
+Constraint = namedtuple("Constraint", ["kind", "value"])
+# One executed step: the constraint group, its set size and the result size after the step
+PlanStep = namedtuple("PlanStep", ["kind", "values", "size", "result_size"])
+
+# Bits set in each byte value, for popcounts over packed bitsets
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bits):
+    """Number of funds in a packed bitset."""
+    return int(_POPCOUNT[bits].sum(dtype=np.int64))
+
+
+def extract_constraints(query_lower, matches):
+    """
+    Returns the constraints mentioned in a query as a list of Constraint, in query order.
+    matches are the entity matcher's EntityMatch tuples for the query; a match lying
+    inside a longer match (e.g. a sector name within a factor name) is not counted.
+    """
+    spans = [(m.start, m.end) for m in matches]
+    constraints = []
+    for match in sorted(matches, key=lambda m: (m.start, m.row)):
+        if match.entity_type not in CONSTRAINT_KINDS:
+            continue
+        if any(start <= match.start and match.end <= end and (end - start) > (match.end - match.start)
+               for start, end in spans):
+            continue
+        constraint = Constraint(match.entity_type, match.entity_id)
+        if constraint not in constraints:
+            constraints.append(constraint)
+    if not any(word in query_lower for word in RISK_WORDS):
+        return constraints
+    for level in RISK_PATTERN.findall(query_lower):
+        constraint = Constraint("risk", level.capitalize())
+        if constraint not in constraints:
+            constraints.append(constraint)
+    return constraints
+
+
+class FundBitsets:
+    """Per-entity fund bitsets (one bit per fund row), built on first use and cached."""
+
+    def __init__(self, index):
+        self.index = index
+        self.n_funds = index.n_funds
+        self._sets = {}  # (kind, value) -> (packed bits, size)
+
+    def _mask(self, kind, value):
+        """Boolean mask over fund rows for one constraint."""
+        index = self.index
+        if kind == "amc":
+            mask = np.zeros(self.n_funds, dtype=bool)
+            mask[index.amc_funds.neighbors(index.amcs.code(value))] = True
+            return mask
+        if kind == "risk":
+            mask = np.zeros(self.n_funds, dtype=bool)
+            mask[index.risk_funds.neighbors(index.risks.code(normalize_category(value)))] = True
+            return mask
+        if kind == "sector":
+            return index.sector_fund_codes(index.sectors.code(value))[index.fund_code]
+        if kind == "factor":
+            return index.factor_fund_codes(index.factors.code(value))[index.fund_code]
+        raise ValueError(f"Unknown constraint kind '{kind}'")
+
+    def get(self, kind, value):
+        """Returns (packed bitset, size) of the funds matching one constraint."""
+        key = (kind, value)
+        cached = self._sets.get(key)
+        if cached is None:
+            mask = self._mask(kind, value)
+            cached = self._sets[key] = (np.packbits(mask), int(mask.sum()))
+        return cached
+
+    def positions(self, bits):
+        """Fund row positions (CSV order) set in a packed bitset."""
+        return np.flatnonzero(np.unpackbits(bits, count=self.n_funds))
+
+
+def is_compound(query_lower, matches, constraints):
+    """True when a fund-list query names two or more constraints and no specific fund."""
+    if "fund" not in query_lower or len(constraints) < 2:
+        return False
+    return not any(match.entity_type == "fund" for match in matches)
+
+
+def get_fund_bitsets(store=None):
+    """Returns the bitset cache for the current (or given) knowledge-base store."""
+    return (store or data_loader.get_store()).derived(
+        "fund_bitsets", lambda store: FundBitsets(get_graph_index(store)))
+
+
+def execute_constraints(constraints):
+    """
+    Runs the constraints as set algebra over fund bitsets.
+    Same-kind values are unioned; the unions are intersected smallest first and the
+    loop stops once the result is empty. Returns (fund row positions, [PlanStep]).
+    """
+    bitsets = get_fund_bitsets()
+    groups = {}
+    for kind, value in constraints:
+        groups.setdefault(kind, []).append(value)
+
+    # Union within each kind, then order the groups by selectivity (smallest set first)
+    planned = []
+    for kind, values in groups.items():
+        bits = bitsets.get(kind, values[0])[0]
+        for value in values[1:]:
+            bits = np.bitwise_or(bits, bitsets.get(kind, value)[0])
+        planned.append((popcount(bits), kind, values, bits))
+    planned.sort(key=lambda group: group[0])
+
+    steps = []
+    result = None
+    for size, kind, values, bits in planned:
+        result = bits if result is None else np.bitwise_and(result, bits)
+        result_size = size if len(steps) == 0 else popcount(result)
+        steps.append(PlanStep(kind, tuple(values), size, result_size))
+        if result_size == 0:
+            break
+    if result is None:
+        return np.arange(0), steps
+    return bitsets.positions(result), steps
+
+
+def describe_constraints(constraints):
+    """Human-readable summary such as: with 'High' risk, investing in the 'Energy' sector, managed by 'AMC_X'."""
+    groups = {}
+    for kind, value in constraints:
+        groups.setdefault(kind, []).append(value)
+    parts = []
+    for kind in CONSTRAINT_KINDS:
+        values = groups.get(kind)
+        if not values:
+            continue
+        listed = " or ".join(f"'{v}'" for v in values)
+        if kind == "risk":
+            parts.append(f"with {listed} risk")
+        elif kind == "sector":
+            parts.append(f"investing in the {listed} sector")
+        elif kind == "amc":
+            parts.append(f"managed by {listed}")
+        else:
+            parts.append(f"affected by {listed}")
+    return ", ".join(parts)
+
+
+def describe_plan(steps):
+    """One line per executed step, e.g. "amc AMC_X: 3 funds -> 3 remaining"."""
+    return "\n".join(f"- {step.kind} {' or '.join(step.values)}: {step.size} funds -> {step.result_size} remaining"
+                     for step in steps)
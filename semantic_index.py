@@ -0,0 +1,227 @@
+# semantic_index.py
+# Embedding index over the free-text columns of funds, sectors and factors
+# (description, sensitivity_notes, impact_direction), used when exact keyword
+# matching in intent_parser finds nothing ("funds hurt by rising oil").
+# Vectors live in one contiguous float32 matrix; search is a batched
+# normalized dot product. Vectors are persisted with a per-document text hash,
+# so a restart only embeds documents whose text changed.
+import hashlib
+import math
+import os
+import re
+import zlib
+from collections import namedtuple
+
+import numpy as np
+import data_loader
+
+# One searchable document; entity_id uses the same key intent_parser returns
+# (internal_key for funds, sector_id / factor_id otherwise)
+SemanticDoc = namedtuple("SemanticDoc", ["entity_type", "entity_id", "name", "text"])
+SemanticHit = namedtuple("SemanticHit", ["score", "entity_type", "entity_id", "name", "text"])
+
+# Columns embedded per entity type: (table, id column, text columns)
+SEMANTIC_SOURCES = [
+    ("fund", "funds", "internal_key", ["name", "description"]),
+    ("sector", "sectors", "sector_id", ["name", "description", "sensitivity_notes"]),
+    ("factor", "factors", "factor_id", ["name", "description", "impact_direction"]),
+]
+
+# Words that carry no meaning for matching (incl. generic question/domain words)
+STOPWORDS = frozenset("""
+a an and are as at be by for from how in into is it its of on or the to was what which who with
+about any do does show tell me find list give all some most more like often can could would
+fund funds sector sectors factor factors
+""".split())
+
+DEFAULT_DIM = 1024
+
+
+def _tokens(text):
+    """Lowercase word tokens with stopwords removed and a light suffix strip."""
+    words = re.findall(r"[a-z0-9]+", (text or "").lower())
+    tokens = []
+    for word in words:
+        if word in STOPWORDS:
+            continue
+        # Crude stemming so "rising"/"rises"/"rise" share a feature
+        for suffix in ("ing", "es", "ed", "s"):
+            if len(word) > len(suffix) + 2 and word.endswith(suffix):
+                word = word[:-len(suffix)]
+                break
+        tokens.append(word)
+    return tokens
+
+
+class HashingEmbedder:
+    """
+    Dependency-free fallback: signed feature hashing of word unigrams, bigrams and
+    character trigrams with sublinear term frequency, L2-normalized.
+    Stateless (no corpus statistics), so a document's vector never changes unless
+    its text does - which is what makes incremental embedding exact.
+    """
+
+    def __init__(self, dim=DEFAULT_DIM):
+        self.dim = dim
+        self.model_id = f"hashing-v1-{dim}"
+
+    def _features(self, text):
+        tokens = _tokens(text)
+        features = {}
+        for i, token in enumerate(tokens):
+            grams = [("w", token, 1.0)]
+            if i + 1 < len(tokens):
+                grams.append(("b", token + " " + tokens[i + 1], 0.7))
+            padded = f"#{token}#"
+            grams.extend(("c", padded[j:j + 3], 0.3) for j in range(len(padded) - 2))
+            for kind, gram, weight in grams:
+                key = kind + gram
+                features[key] = features.get(key, 0.0) + weight
+        return features
+
+    def embed(self, texts):
+        """Returns a (len(texts) x dim) float32 matrix of unit vectors."""
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for key, count in self._features(text).items():
+                h = zlib.crc32(key.encode("utf-8"))
+                sign = 1.0 if h & 0x80000000 else -1.0
+                out[row, h % self.dim] += sign * math.log1p(count)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+class SentenceTransformerEmbedder:
+    """Local CPU embedding model (requires the optional sentence-transformers package)."""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self._model = SentenceTransformer(model_name, device="cpu")
+        self.model_id = f"st-{model_name}"
+
+    def embed(self, texts):
+        vectors = self._model.encode(list(texts), batch_size=64, normalize_embeddings=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def create_embedder():
+    """Uses SEMANTIC_MODEL (a sentence-transformers model) if set and installed, else hashing."""
+    model_name = os.getenv("SEMANTIC_MODEL")
+    if model_name:
+        try:
+            return SentenceTransformerEmbedder(model_name)
+        except Exception as e:
+            print(f"Warning: could not load embedding model '{model_name}' ({e}); using hashing embedder.")
+    return HashingEmbedder()
+
+
+def _text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class SemanticIndex:
+    """Contiguous float32 matrix of document vectors with batched top-k search."""
+
+    def __init__(self, docs, vectors, embedder):
+        self.docs = list(docs)
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.embedder = embedder
+
+    @classmethod
+    def build(cls, docs, embedder, persist_path=None):
+        """
+        Embeds docs, reusing vectors persisted at persist_path for documents whose
+        text is unchanged (same embedder), and writes the updated vectors back.
+        """
+        docs = list(docs)
+        keys = [f"{d.entity_type}\x1f{d.entity_id}" for d in docs]
+        hashes = [_text_hash(d.text) for d in docs]
+        dim = getattr(embedder, "dim", None)
+        cached = {}
+        if persist_path and os.path.exists(persist_path):
+            try:
+                with np.load(persist_path, allow_pickle=False) as saved:
+                    if str(saved["model_id"]) == embedder.model_id:
+                        saved_vectors = saved["vectors"]
+                        for key, text_hash, row in zip(saved["keys"].tolist(), saved["hashes"].tolist(), range(len(saved_vectors))):
+                            cached[(key, text_hash)] = saved_vectors[row]
+                        dim = saved_vectors.shape[1] if len(saved_vectors) else dim
+            except Exception as e:
+                print(f"Warning: ignoring unreadable semantic index cache ({e}).")
+                cached = {}
+
+        todo = [i for i, key in enumerate(keys) if (key, hashes[i]) not in cached]
+        new_vectors = embedder.embed([docs[i].text for i in todo]) if todo else None
+        if new_vectors is not None and len(new_vectors):
+            dim = new_vectors.shape[1]
+        vectors = np.zeros((len(docs), dim or 0), dtype=np.float32)
+        for i, key in enumerate(keys):
+            if (key, hashes[i]) in cached:
+                vectors[i] = cached[(key, hashes[i])]
+        for row, i in enumerate(todo):
+            vectors[i] = new_vectors[row]
+
+        stale = len(cached) != len(docs) or bool(todo)
+        if persist_path and stale:
+            try:
+                os.makedirs(os.path.dirname(persist_path), exist_ok=True)
+                tmp_path = persist_path + ".tmp.npz"
+                np.savez(tmp_path, model_id=np.array(embedder.model_id), keys=np.array(keys),
+                         hashes=np.array(hashes), vectors=vectors)
+                os.replace(tmp_path, persist_path)
+            except Exception as e:
+                print(f"Warning: could not persist semantic index: {e}")
+        if todo:
+            print(f"Semantic index: embedded {len(todo)} of {len(docs)} documents.")
+        return cls(docs, vectors, embedder)
+
+    def search_batch(self, queries, top_k=5):
+        """Returns one list of SemanticHit (best first) per query."""
+        if not len(self.docs) or not queries:
+            return [[] for _ in queries]
+        query_vectors = self.embedder.embed(list(queries))
+        scores = query_vectors @ self.vectors.T  # Unit vectors: dot product == cosine
+        k = min(top_k, scores.shape[1])
+        results = []
+        for row in scores:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top], kind="stable")]
+            results.append([SemanticHit(float(row[i]), *self.docs[i]) for i in top])
+        return results
+
+    def search(self, query, top_k=5):
+        """Returns the top_k most similar documents for one query."""
+        return self.search_batch([query], top_k)[0]
+
+
+def build_docs(tables):
+    """Builds one SemanticDoc per fund, sector and factor row."""
+    docs = []
+    for entity_type, table, id_col, text_cols in SEMANTIC_SOURCES:
+        df = tables.get(table)
+        if df is None or df.empty:
+            continue
+        columns = [c for c in text_cols if c in df.columns]
+        for record in df[[id_col] + [c for c in columns if c != id_col]].to_dict('records'):
+            parts = [str(record[c]) for c in columns if isinstance(record.get(c), str) and record.get(c)]
+            name = record.get("name") if isinstance(record.get("name"), str) else str(record[id_col])
+            docs.append(SemanticDoc(entity_type, record[id_col], name, ". ".join(parts)))
+    return docs
+
+
+def semantic_index_for(store):
+    """Returns the semantic index of the given store version, building it on first use."""
+    def _build(store):
+        tables = store.get_tables([table for _, table, _, _ in SEMANTIC_SOURCES])
+        if tables is None:
+            raise RuntimeError("Semantic index tables could not be loaded")
+        # In-memory fixture stores (use_snapshot=False) never touch the on-disk cache
+        persist_path = os.path.join(data_loader.cache_dir_for(store.data_dir), "semantic_index.npz") if store.use_snapshot else None
+        return SemanticIndex.build(build_docs(tables), create_embedder(), persist_path)
+    return store.derived("semantic_index", _build, depends_on=[table for _, table, _, _ in SEMANTIC_SOURCES])
+
+
+def get_semantic_index():
+    """Returns the semantic index for the current knowledge base, building it on first use."""
+    return semantic_index_for(data_loader.get_store())
@@ -0,0 +1,386 @@
+# shared_kb.py
+# Publishes the loaded knowledge base once into a memory-mapped file, so several
+# processes (pre-forked api_server workers, Streamlit replicas behind a proxy)
+# attach to one read-only copy instead of each holding its own DataFrames and
+# indexes.
+# A generation file holds every table as an Arrow IPC stream (strings stored as
+# large_string, which pandas wraps without copying) followed by the derived
+# indexes as aligned flat arrays: graph index codes and adjacency lists, the
+# entity matcher automaton and the fuzzy matcher's trigram postings. A JSON
+# manifest next to it records offsets, dtypes and the CSV signatures the tables
+# were read with. CURRENT.json holds the version counter: publishing writes
+# generation N+1 and then bumps it, and attached stores switch over on their next
+# poll (data_loader.refresh_if_changed / start_watcher).
+#
+# Enable with KB_SHARED_MEMORY=1 (api_server and app.py attach, publishing first if
+# needed); KB_SHARED_DIR moves the files, e.g. to /dev/shm.
+# Publish step:  python shared_kb.py
+import contextlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # Optional dependency: without it every process loads its own copy
+    pa = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: publishers are not serialized
+    fcntl = None
+
+import data_loader
+from entity_matcher import ENTITY_SOURCES, SharedEntityMatcher, get_entity_matcher
+from fuzzy_matcher import FuzzyMatcher, get_fuzzy_matcher
+from kb_codes import StringArray, prefixed, unprefixed
+from kg_index import KnowledgeGraphIndex, get_graph_index
+
+FORMAT_VERSION = 1
+CURRENT_FILE = "CURRENT.json"
+# Arrays and table streams start on this boundary in the generation file
+ALIGNMENT = 64
+# Generations kept on disk (a process may still be attaching to the previous one)
+KEEP_GENERATIONS = 2
+
+_ENTITY_TABLES = [table for _, table, _, _ in ENTITY_SOURCES]
+# Derived structures published with the tables -> tables they depend on
+SHARED_STRUCTURES = {
+    "graph_index": list(data_loader.TABLE_FILES),
+    "entity_matcher": _ENTITY_TABLES,
+    "fuzzy_matcher": _ENTITY_TABLES,
+}
+_EXPORTERS = {
+    "graph_index": lambda store: get_graph_index(store).to_arrays(),
+    "entity_matcher": lambda store: get_entity_matcher(store).to_arrays(),
+    "fuzzy_matcher": lambda store: get_fuzzy_matcher(store).to_arrays(),
+}
+
+
+def shared_kb_enabled():
+    return os.getenv("KB_SHARED_MEMORY", "0") == "1"
+
+
+def shared_dir_for(data_dir=None):
+    """Directory of the published generations (KB_SHARED_DIR overrides .cache/shared_kb)."""
+    return os.getenv("KB_SHARED_DIR") or os.path.join(data_loader.cache_dir_for(data_dir), "shared_kb")
+
+
+def _generation_path(directory, version):
+    return os.path.join(directory, f"kb-{version:06d}.bin")
+
+
+def _manifest_path(directory, version):
+    return os.path.join(directory, f"kb-{version:06d}.json")
+
+
+def _write_json(path, payload):
+    """Writes a JSON file atomically (readers never see it half-written)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def current_version(data_dir=None):
+    """The published version counter (0 if nothing is published)."""
+    try:
+        with open(os.path.join(shared_dir_for(data_dir), CURRENT_FILE)) as f:
+            return int(json.load(f)["version"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+@contextlib.contextmanager
+def _publish_lock(directory):
+    """Serializes publishers across processes (one rebuild per CSV change)."""
+    with open(os.path.join(directory, "publish.lock"), "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# --- Publishing ---
+
+def _table_stream(df):
+    """One table as an Arrow IPC stream; string columns become large_string (pandas maps those zero-copy)."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    schema = pa.schema([field.with_type(pa.large_string()) if pa.types.is_string(field.type) else field
+                        for field in table.schema])
+    table = table.cast(schema)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def _aligned_offset(f):
+    f.write(b"\0" * (-f.tell() % ALIGNMENT))
+    return f.tell()
+
+
+def _write_generation(directory, version, tables, arrays, signatures):
+    manifest = {"format_version": FORMAT_VERSION, "version": version, "created_at": time.time(),
+                "tables": {}, "arrays": {}}
+    path = _generation_path(directory, version)
+    with open(path + ".tmp", "wb") as f:
+        for name, df in tables.items():
+            data = _table_stream(df)
+            offset = _aligned_offset(f)
+            f.write(data)
+            manifest["tables"][name] = {"offset": offset, "length": data.size, "rows": len(df),
+                                        "signature": signatures.get(name)}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            offset = _aligned_offset(f)
+            f.write(array.tobytes())
+            manifest["arrays"][name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+        manifest["size"] = f.tell()
+    os.replace(path + ".tmp", path)
+    _write_json(_manifest_path(directory, version), manifest)
+    return manifest
+
+
+def _remove_old_generations(directory, version):
+    # Processes still mapping a removed file keep reading it (POSIX unlink semantics)
+    for filename in os.listdir(directory):
+        stem, ext = os.path.splitext(filename)
+        if not stem.startswith("kb-") or ext not in (".bin", ".json"):
+            continue
+        try:
+            if int(stem[3:]) <= version - KEEP_GENERATIONS:
+                os.remove(os.path.join(directory, filename))
+        except (ValueError, OSError):
+            pass
+
+
+def publish(data_dir=None, store=None, replaces=None):
+    """
+    Writes the tables and derived indexes of a private store (a fresh one for data_dir
+    by default) as the next generation and bumps the version counter.
+    With replaces=N nothing is written unless N is still the published version (another
+    process already republished). Returns the published version.
+    Raises if pyarrow is missing or the tables cannot be loaded.
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow is required to publish a shared knowledge base")
+    if store is None or store.shared is not None:
+        store = data_loader.DataStore(data_dir or (store.data_dir if store else None))
+    directory = shared_dir_for(store.data_dir)
+    os.makedirs(directory, exist_ok=True)
+    with _publish_lock(directory):
+        version = current_version(store.data_dir)
+        if replaces is not None and version != replaces:
+            return version
+        start = time.perf_counter()
+        tables = store.get_loaded_data()
+        if tables is None:
+            raise RuntimeError("Knowledge-base tables could not be loaded")
+        arrays = {}
+        for name, export in _EXPORTERS.items():
+            arrays.update(prefixed(name, export(store)))
+        version += 1
+        manifest = _write_generation(directory, version, tables, arrays, store.table_signatures())
+        _write_json(os.path.join(directory, CURRENT_FILE), {"version": version, "created_at": time.time()})
+        _remove_old_generations(directory, version)
+    print(f"Shared knowledge base version {version} published ({manifest['size'] / 2**20:.1f} MiB) "
+          f"in {time.perf_counter() - start:.2f}s.")
+    return version
+
+
+# --- Attaching ---
+
+def _string_dtype():
+    """pandas string dtype backed by Arrow with NaN for missing values (what object columns held)."""
+    try:
+        return pd.StringDtype("pyarrow", na_value=np.nan)  # pandas >= 2.3
+    except TypeError:
+        return pd.StringDtype("pyarrow_numpy")
+
+
+class TableRecords:
+    """
+    Read-only sequence of row dicts over an Arrow table, converted on access. String
+    columns are read straight from the mapped buffers and categorical ones through
+    their dictionary, so nothing per row is materialized up front.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.names = table.column_names
+        self.columns = [_Column(column) for column in table.columns]
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __getitem__(self, pos):
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError("TableRecords index out of range")
+        return {name: column.get(pos) for name, column in zip(self.names, self.columns)}
+
+    def __iter__(self):
+        return (self[pos] for pos in range(len(self)))
+
+    def take(self, positions):
+        """Row dicts at the given positions, converted column by column."""
+        positions = np.asarray(positions, dtype=np.int64)
+        columns = [column.take(positions) for column in self.columns]
+        return [dict(zip(self.names, row)) for row in zip(*columns)]
+
+
+class _Column:
+    """Python values of one Arrow column by row; missing cells are NaN, as DataFrame.to_dict('records') reports them."""
+
+    def __init__(self, column):
+        chunk = self.chunk = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+        self.missing = chunk.is_null().to_numpy(zero_copy_only=False) if chunk.null_count else None
+        self.dictionary = None
+        if pa.types.is_large_string(chunk.type):
+            # Same layout as kb_codes.StringArray: int64 offsets into UTF-8 bytes
+            _, offsets, data = chunk.buffers()
+            offsets = np.frombuffer(offsets, dtype=np.int64)[chunk.offset:chunk.offset + len(chunk) + 1]
+            data = np.frombuffer(data, dtype=np.uint8) if data is not None and data.size else np.zeros(0, dtype=np.uint8)
+            self.values = StringArray(offsets, data)
+        elif pa.types.is_dictionary(chunk.type):
+            # Missing entries point one past the dictionary, at its NaN
+            indices = chunk.indices.fill_null(len(chunk.dictionary)) if chunk.null_count else chunk.indices
+            self.values = indices.to_numpy()
+            self.dictionary = chunk.dictionary.to_pylist() + [float("nan")]
+        else:
+            # Other (numeric, ...) columns are converted once
+            self.values = [float("nan") if value is None else value for value in chunk.to_pylist()]
+
+    def get(self, pos):
+        if self.missing is not None and self.missing[pos]:
+            return float("nan")
+        if self.dictionary is not None:
+            return self.dictionary[self.values[pos]]
+        return self.values[pos]
+
+    def take(self, positions):
+        if self.dictionary is not None:
+            dictionary = self.dictionary
+            values = [dictionary[i] for i in self.values[positions].tolist()]
+        elif isinstance(self.values, StringArray):
+            # Arrow decodes many strings faster than one slice at a time
+            values = self.chunk.take(pa.array(positions)).to_pylist()
+        else:
+            column = self.values
+            values = [column[pos] for pos in positions.tolist()]
+        if self.missing is not None:
+            nan = float("nan")
+            values = [nan if missing else value for value, missing in zip(values, self.missing[positions].tolist())]
+        return values
+
+
+class SharedKB:
+    """One attached generation: its memory map, manifest and version."""
+
+    def __init__(self, data_dir, version, manifest, buffer):
+        self.data_dir = data_dir
+        self.version = version
+        self.manifest = manifest
+        self.buffer = buffer   # keeps the mapping alive while any view of it is in use
+
+    def _array(self, entry):
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        if not count:
+            return np.zeros(entry["shape"], dtype=dtype)
+        # Read-only view into the mapped file
+        return np.frombuffer(self.buffer, dtype=dtype, count=count, offset=entry["offset"]).reshape(entry["shape"])
+
+    def store(self):
+        """A DataStore over this generation; tables and indexes are views of the mapped file."""
+        arrow_tables, tables = {}, {}
+        mapper = {pa.large_string(): _string_dtype()}.get
+        for name, entry in self.manifest["tables"].items():
+            reader = pa.ipc.open_stream(self.buffer.slice(entry["offset"], entry["length"]))
+            arrow_tables[name] = reader.read_all()
+            tables[name] = arrow_tables[name].to_pandas(types_mapper=mapper, split_blocks=True)
+        arrays = {name: self._array(entry) for name, entry in self.manifest["arrays"].items()}
+
+        structures = {
+            "graph_index": KnowledgeGraphIndex.from_arrays(tables, unprefixed("graph_index", arrays),
+                                                           TableRecords(arrow_tables["funds"])),
+            "entity_matcher": SharedEntityMatcher(unprefixed("entity_matcher", arrays)),
+            "fuzzy_matcher": FuzzyMatcher.from_arrays(unprefixed("fuzzy_matcher", arrays)),
+        }
+        derived = {name: (value, SHARED_STRUCTURES[name]) for name, value in structures.items()}
+        signatures = {name: tuple(entry["signature"]) if entry.get("signature") else None
+                      for name, entry in self.manifest["tables"].items()}
+        return data_loader.DataStore.attached(self, tables, derived, signatures)
+
+    def refreshed(self, store, settle_seconds=0.5):
+        """
+        (new store, changed tables) once a newer generation is published, else (None, []).
+        With KB_HOT_RELOAD=1 an attached process that sees edited CSVs republishes them first.
+        Per-process structures not depending on the changed tables are carried over.
+        """
+        if (current_version(self.data_dir) <= self.version and os.getenv("KB_HOT_RELOAD", "0") == "1"
+                and store.changed_tables(settle_seconds)):
+            publish(self.data_dir, replaces=self.version)
+        if current_version(self.data_dir) <= self.version:
+            return None, []
+        new_store = attach(self.data_dir)
+        if new_store is None:
+            return None, []
+        new_tables = new_store.shared.manifest["tables"]
+        changed = [name for name, entry in new_tables.items()
+                   if entry.get("signature") != self.manifest["tables"].get(name, {}).get("signature")]
+        store.carry_over(new_store, changed)
+        return new_store, changed
+
+
+def attach(data_dir=None):
+    """
+    A read-only DataStore over the latest published generation, or None if nothing is
+    published, pyarrow is missing or the files cannot be read.
+    """
+    data_dir = data_dir or data_loader.default_data_dir()
+    version = current_version(data_dir)
+    if pa is None or not version:
+        return None
+    directory = shared_dir_for(data_dir)
+    try:
+        with open(_manifest_path(directory, version)) as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != FORMAT_VERSION:
+            return None
+        buffer = pa.memory_map(_generation_path(directory, version), "r").read_buffer()
+        return SharedKB(data_dir, version, manifest, buffer).store()
+    except Exception as e:
+        print(f"Warning: could not attach shared knowledge base version {version}: {e}")
+        return None
+
+
+def attach_or_publish(data_dir=None):
+    """
+    Attaches this process to the shared knowledge base, publishing it first if nothing
+    is published yet or the CSVs changed since, and installs the attached store as
+    data_loader's store. Returns it, or None if sharing is unavailable (the process
+    then loads its own copy as usual).
+    """
+    store = attach(data_dir)
+    if store is None or store.changed_tables():
+        try:
+            publish(data_dir, replaces=store.version if store is not None else current_version(data_dir))
+        except Exception as e:
+            print(f"Warning: could not publish the shared knowledge base: {e}")
+        store = attach(data_dir) or store
+    if store is not None:
+        data_loader.set_store(store)
+    return store
+
+
+if __name__ == "__main__":
+    publish()
@@ -0,0 +1,175 @@
+# synthetic_kb.py
+# Generates realistic, scalable versions of all seven knowledge-base CSVs for
+# load/latency benchmarks (bench_kb.py). Same files and columns as the shipped
+# CSVs; sizes, fan-outs and name collisions are configurable and the output is
+# deterministic for a given seed.
+#
+# Usage:  python synthetic_kb.py --funds 50000 --out bench_data/funds_50000
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# Vocabulary used to compose names and descriptions
+SECTOR_ROOTS = ["Technology", "Finance", "Energy", "Healthcare", "Infrastructure", "Consumer Goods",
+                "Automobile", "Chemicals", "Construction Materials", "Telecom", "Utilities", "Metals",
+                "Pharma", "Real Estate", "Media", "Logistics", "Textiles", "Agriculture", "Defence", "Retail"]
+FACTOR_ROOTS = ["Crude Oil Price", "Interest Rates", "Inflation", "Chip Shortage", "Government Spending",
+                "Geopolitical Tension", "Monsoon", "Currency Exchange Rate", "Commodity Prices", "Regulation",
+                "Consumer Sentiment", "Credit Growth", "Tax Policy", "Freight Costs", "Election Cycle"]
+FACTOR_QUALIFIERS = ["Global", "Domestic", "Asian", "US", "European", "Short-term", "Long-term"]
+AMC_WORDS = ["Alpha", "Beta", "Gamma", "Delta", "Sigma", "Apex", "Zenith", "Horizon", "Summit", "Pioneer",
+             "Vertex", "Harbor", "Crest", "Meridian", "Quantum", "Orbit", "Keystone", "Anchor"]
+AMC_SUFFIXES = ["Management Corp", "Investments", "Asset Management", "Capital", "Mutual Fund", "Advisors"]
+FUND_STYLES = ["Growth", "Value", "Bluechip", "Midcap", "Smallcap", "Flexicap", "Balanced", "Dividend Yield",
+               "Focus", "Opportunities", "Index", "Income", "Hybrid", "ESG", "Thematic"]
+PLAN_TYPES = ["Direct", "Regular", "Institutional", "Retail"]
+RISK_LEVELS = ["High", "Medium", "Low"]
+RISK_WEIGHTS = [0.45, 0.4, 0.15]
+IMPACT_DIRECTIONS = ["Varies", "Negative for growth stocks, positive for banks.",
+                     "Raises input costs for manufacturers.", "Positive for exporters.",
+                     "Often drives volatility across markets."]
+
+
+def _poisson_fanout(rng, n, mean, maximum):
+    """Per-row link counts: Poisson around mean, at least 1, capped at maximum."""
+    return np.clip(rng.poisson(mean, n), 1, maximum)
+
+
+def generate_knowledge_base(n_funds=1000, n_amcs=None, n_sectors=40, n_factors=60, secondary_fanout=3.0,
+                            factor_fanout=4.0, factor_sector_fanout=5.0, name_collision_rate=0.02, seed=0):
+    """
+    Returns {table_name: DataFrame} for all seven tables.
+    - n_amcs defaults to ~1 AMC per 250 funds (at least 3)
+    - *_fanout are mean link counts (secondary sectors per fund, factors per fund,
+      affected sectors per factor); link rows scale as n_funds * fan-out
+    - name_collision_rate is the share of funds reusing another fund's name
+      (different AMC/plan), which stresses entity matching
+    """
+    rng = np.random.default_rng(seed)
+    n_amcs = n_amcs or max(3, n_funds // 250)
+
+    # --- Sectors (roots first, then numbered sub-industries) ---
+    sector_names = [SECTOR_ROOTS[i] if i < len(SECTOR_ROOTS) else f"{SECTOR_ROOTS[i % len(SECTOR_ROOTS)]} {i // len(SECTOR_ROOTS)}"
+                    for i in range(n_sectors)]
+    sectors = pd.DataFrame({
+        "sector_id": sector_names,
+        "name": sector_names,
+        "description": [f"Companies in the {name.lower()} industry and related services." for name in sector_names],
+        "sensitivity_notes": [f"Sensitive to {FACTOR_ROOTS[i % len(FACTOR_ROOTS)].lower()} and "
+                              f"{FACTOR_ROOTS[(i * 7 + 3) % len(FACTOR_ROOTS)].lower()}." for i in range(n_sectors)],
+    })
+
+    # --- Factors (roots, then qualified variants) ---
+    factor_names = []
+    for i in range(n_factors):
+        root = FACTOR_ROOTS[i % len(FACTOR_ROOTS)]
+        level = i // len(FACTOR_ROOTS)
+        factor_names.append(root if level == 0 else f"{FACTOR_QUALIFIERS[(level - 1) % len(FACTOR_QUALIFIERS)]} {root}"
+                            + (f" {level}" if level > len(FACTOR_QUALIFIERS) else ""))
+    factors = pd.DataFrame({
+        "factor_id": factor_names,
+        "name": factor_names,
+        "description": [f"Changes in {name.lower()}." for name in factor_names],
+        "impact_direction": [IMPACT_DIRECTIONS[i % len(IMPACT_DIRECTIONS)] for i in range(n_factors)],
+    })
+
+    # Factor -> sector links (each factor hits a few sectors)
+    counts = _poisson_fanout(rng, n_factors, factor_sector_fanout, n_sectors)
+    factor_affected_sectors = pd.DataFrame([
+        (factor_names[f], sector_names[s])
+        for f in range(n_factors) for s in rng.choice(n_sectors, counts[f], replace=False)
+    ], columns=["factor_id", "sector_id"])
+
+    # --- AMCs ---
+    amc_ids = [f"AMC_{i:04d}" for i in range(n_amcs)]
+    amc_names = [f"{AMC_WORDS[i % len(AMC_WORDS)]}{'' if i < len(AMC_WORDS) else ' ' + str(i // len(AMC_WORDS))} "
+                 f"{AMC_SUFFIXES[i % len(AMC_SUFFIXES)]}" for i in range(n_amcs)]
+    amcs = pd.DataFrame({
+        "amc_id": amc_ids,
+        "name": amc_names,
+        "established": rng.integers(1990, 2021, n_amcs),
+        "aum_group": rng.choice(["Large", "Medium", "Small"], n_amcs, p=[0.2, 0.5, 0.3]),
+    })
+
+    # --- Funds (AMC sizes are skewed: a few large houses run most funds) ---
+    amc_weights = rng.pareto(1.2, n_amcs) + 1
+    fund_amc = rng.choice(n_amcs, n_funds, p=amc_weights / amc_weights.sum())
+    primary = rng.integers(0, n_sectors, n_funds)
+    styles = rng.integers(0, len(FUND_STYLES), n_funds)
+    plans = rng.integers(0, len(PLAN_TYPES), n_funds)
+    names = [f"{AMC_WORDS[a % len(AMC_WORDS)]} {sector_names[p]} {FUND_STYLES[st]} {PLAN_TYPES[pl]} {i}"
+             for i, (a, p, st, pl) in enumerate(zip(fund_amc, primary, styles, plans))]
+    # Name collisions: some funds copy an earlier fund's name
+    for i in np.flatnonzero(rng.random(n_funds) < name_collision_rate):
+        if i > 0:
+            names[i] = names[rng.integers(0, i)]
+    fund_ids = [f"F{i:06d}" for i in range(n_funds)]
+    funds = pd.DataFrame({
+        "fund_id": fund_ids,
+        "internal_key": [f"{name.replace(' ', '_')}_{i}" for i, name in enumerate(names)],
+        "name": names,
+        "amc_id": [amc_ids[a] for a in fund_amc],
+        "risk": rng.choice(RISK_LEVELS, n_funds, p=RISK_WEIGHTS),
+        "primary_sector": [sector_names[p] for p in primary],
+        "description": [f"{FUND_STYLES[st]} strategy investing mainly in {sector_names[p].lower()} companies "
+                        f"managed by {amc_names[a]}." for a, p, st in zip(fund_amc, primary, styles)],
+    })
+
+    # --- Fund link tables ---
+    counts = _poisson_fanout(rng, n_funds, secondary_fanout, n_sectors - 1)
+    rows = np.repeat(np.arange(n_funds), counts)
+    fund_secondary_sectors = pd.DataFrame({
+        "fund_id": np.array(fund_ids)[rows],
+        "sector_id": np.array(sector_names)[rng.integers(0, n_sectors, len(rows))],
+    }).drop_duplicates()
+
+    counts = _poisson_fanout(rng, n_funds, factor_fanout, n_factors)
+    rows = np.repeat(np.arange(n_funds), counts)
+    fund_related_factors = pd.DataFrame({
+        "fund_id": np.array(fund_ids)[rows],
+        "factor_id": np.array(factor_names)[rng.integers(0, n_factors, len(rows))],
+    }).drop_duplicates()
+
+    return {
+        "funds": funds,
+        "fund_secondary_sectors": fund_secondary_sectors,
+        "fund_related_factors": fund_related_factors,
+        "amcs": amcs,
+        "sectors": sectors,
+        "factors": factors,
+        "factor_affected_sectors": factor_affected_sectors,
+    }
+
+
+def write_knowledge_base(tables, out_dir):
+    """Writes the tables as the seven CSV files into out_dir."""
+    import data_loader
+    os.makedirs(out_dir, exist_ok=True)
+    for table, filename in data_loader.TABLE_FILES.items():
+        tables[table].to_csv(os.path.join(out_dir, filename), index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic knowledge base (all seven CSVs).")
+    parser.add_argument("--funds", type=int, default=10000)
+    parser.add_argument("--amcs", type=int, default=None)
+    parser.add_argument("--sectors", type=int, default=40)
+    parser.add_argument("--factors", type=int, default=60)
+    parser.add_argument("--secondary-fanout", type=float, default=3.0, help="mean secondary sectors per fund")
+    parser.add_argument("--factor-fanout", type=float, default=4.0, help="mean related factors per fund")
+    parser.add_argument("--factor-sector-fanout", type=float, default=5.0, help="mean affected sectors per factor")
+    parser.add_argument("--collisions", type=float, default=0.02, help="share of funds with a duplicate name")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", required=True, help="output directory")
+    args = parser.parse_args()
+
+    tables = generate_knowledge_base(args.funds, args.amcs, args.sectors, args.factors, args.secondary_fanout,
+                                     args.factor_fanout, args.factor_sector_fanout, args.collisions, args.seed)
+    write_knowledge_base(tables, args.out)
+    print(f"Wrote {args.out}: " + ", ".join(f"{name}={len(df)}" for name, df in tables.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+# tests/conftest.py
+# Tests run against the sample CSVs in the repository root with the offline stub LLM.
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Set before the modules under test read them (backends and caches are created on first use)
+os.environ.setdefault("LLM_BACKEND", "stub")
+os.environ.setdefault("ANSWER_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="mf_rag_tests_"), "answers.sqlite3"))
+
+import pytest
+
+
+@pytest.fixture
+def answer_cache(tmp_path):
+    """A fresh on-disk AnswerCache in a temporary directory."""
+    from answer_cache import AnswerCache
+    return AnswerCache(db_path=str(tmp_path / "answers.sqlite3"))
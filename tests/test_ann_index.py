@@ -0,0 +1,45 @@
+# tests/test_ann_index.py
+import numpy as np
+
+import data_loader
+from ann_index import PassageIndex, build_passages, semantic_vectors
+from semantic_index import build_docs, get_semantic_index
+
+
+class _CountingEmbedder:
+    """Wraps an embedder and records every text it is asked to embed."""
+
+    def __init__(self, embedder):
+        self._embedder = embedder
+        self.model_id = embedder.model_id
+        self.texts = []
+
+    def embed(self, texts):
+        self.texts.extend(texts)
+        return self._embedder.embed(texts)
+
+
+def _tables():
+    return data_loader.get_store().get_tables(["funds", "sectors", "factors", "fund_documents"])
+
+
+def test_descriptions_reuse_the_semantic_index_vectors():
+    semantic = get_semantic_index()
+    passages = build_passages(_tables())
+    known = semantic_vectors(passages, semantic)
+    # Every short description is a semantic document verbatim
+    short = [doc for doc in build_docs(_tables()) if len(doc.text.split()) <= 120]
+    assert len(known) == len(short) > 0
+    # The rows are views into the semantic matrix, not copies
+    assert all(np.shares_memory(vector, semantic.vectors) for vector in known.values())
+
+    embedder = _CountingEmbedder(semantic.embedder)
+    index = PassageIndex.build(passages, embedder, known_vectors=known)
+    assert len(embedder.texts) == len(passages) - len(known)
+    assert not set(embedder.texts) & {passages[i].text for i in known}
+    # Same vectors as embedding everything
+    reference = PassageIndex.build(passages, semantic.embedder)
+    for query in ["rising oil prices", "interest rate sensitivity", "technology growth"]:
+        assert ([hit.entity_id for hit in index.search(query)] ==
+                [hit.entity_id for hit in reference.search(query)])
+
@@ -0,0 +1,107 @@
+# tests/test_answer_cache.py
+import os
+import shutil
+import sqlite3
+import time
+
+import pytest
+
+import data_loader
+from data_loader import DataStore
+
+
+@pytest.fixture
+def kb_dir(tmp_path):
+    """A private copy of the sample CSVs, served as the current store."""
+    data_dir = tmp_path / "kb"
+    data_dir.mkdir()
+    for filename in data_loader.TABLE_FILES.values():
+        shutil.copy(os.path.join(data_loader.default_data_dir(), filename), data_dir / filename)
+    previous = data_loader.get_store()
+    data_loader.set_store(DataStore(str(data_dir), use_snapshot=False))
+    yield data_dir
+    data_loader.set_store(previous)
+
+
+def _edit_funds(data_dir):
+    path = data_dir / data_loader.TABLE_FILES["funds"]
+    # Appending changes the size, so the edit is seen even within the mtime resolution
+    with open(path, "a") as f:
+        f.write("\n")
+
+
+def test_fingerprint_is_computed_once_per_store_version(kb_dir, answer_cache, monkeypatch):
+    calls = []
+    real = data_loader.data_fingerprint
+    monkeypatch.setattr(data_loader, "data_fingerprint", lambda *args: calls.append(args) or real(*args))
+    for i in range(5):
+        answer_cache.put(f"key{i}", "answer")
+        assert answer_cache.get(f"key{i}") == "answer"
+    assert len(calls) == 1
+
+
+def test_entries_survive_until_a_changed_kb_is_loaded(kb_dir, answer_cache):
+    data_loader.get_store().get_tables(["funds"])
+    answer_cache.put("key", "answer")
+    # Edited on disk but not reloaded: answers still match the data being served
+    _edit_funds(kb_dir)
+    assert answer_cache.get("key") == "answer"
+
+    assert data_loader.refresh_if_changed(settle_seconds=0) == ["funds"]
+    assert answer_cache.get("key") is None
+    assert answer_cache.get_stats()["invalidations"] == 1
+    answer_cache.put("key", "new answer")
+    assert answer_cache.get("key") == "new answer"
+
+
+def test_disk_entries_from_an_older_kb_are_dropped(kb_dir, tmp_path):
+    from answer_cache import AnswerCache
+    db_path = str(tmp_path / "answers.sqlite3")
+    AnswerCache(db_path=db_path).put("key", "answer")
+    assert AnswerCache(db_path=db_path).get("key") == "answer"
+
+    # A restart against edited CSVs starts a new store version
+    _edit_funds(kb_dir)
+    data_loader.set_store(DataStore(str(kb_dir), use_snapshot=False))
+    assert AnswerCache(db_path=db_path).get("key") is None
+
+
+def test_processes_on_different_versions_keep_each_others_entries(tmp_path):
+    from answer_cache import AnswerCache
+    db_path = str(tmp_path / "answers.sqlite3")
+    old = AnswerCache(db_path=db_path, fingerprint_fn=lambda: "v1")
+    old.put("key", "old answer")
+    # Another worker has already reloaded the changed CSVs
+    new = AnswerCache(db_path=db_path, fingerprint_fn=lambda: "v2")
+    assert new.get("key") is None
+    new.put("key", "new answer")
+    fresh = AnswerCache(db_path=db_path, fingerprint_fn=lambda: "v1")
+    assert fresh.get("key") == "old answer"
+    assert AnswerCache(db_path=db_path, fingerprint_fn=lambda: "v2").get("key") == "new answer"
+
+
+def test_only_recent_versions_and_unexpired_entries_stay_on_disk(tmp_path):
+    from answer_cache import AnswerCache
+    db_path = str(tmp_path / "answers.sqlite3")
+    for version in ("v1", "v2", "v3", "v4"):
+        AnswerCache(db_path=db_path, fingerprint_fn=lambda v=version: v, kept_versions=2).put("key", version)
+    versions = {row[0] for row in sqlite3.connect(db_path).execute("SELECT data_version FROM answers")}
+    assert versions == {"v3", "v4"}
+    # Entries past their TTL go too, whatever their version
+    time.sleep(0.05)
+    AnswerCache(db_path=db_path, ttl_seconds=0.01, fingerprint_fn=lambda: "v5").get("key")
+    assert sqlite3.connect(db_path).execute("SELECT COUNT(*) FROM answers").fetchone()[0] == 0
+
+
+def test_caches_keyed_on_key_alone_are_migrated(tmp_path):
+    from answer_cache import AnswerCache
+    db_path = str(tmp_path / "answers.sqlite3")
+    db = sqlite3.connect(db_path)
+    db.execute("CREATE TABLE answers (key TEXT PRIMARY KEY, answer TEXT NOT NULL, data_version TEXT NOT NULL,"
+               " created_at REAL NOT NULL, last_access REAL NOT NULL)")
+    db.execute("INSERT INTO answers VALUES ('key', 'answer', 'v1', strftime('%s','now'), strftime('%s','now'))")
+    db.commit()
+    db.close()
+    assert AnswerCache(db_path=db_path, fingerprint_fn=lambda: "v1").get("key") == "answer"
+    AnswerCache(db_path=db_path, fingerprint_fn=lambda: "v2").put("key", "new answer")
+    assert AnswerCache(db_path=db_path, fingerprint_fn=lambda: "v1").get("key") == "answer"
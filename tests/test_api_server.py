@@ -0,0 +1,50 @@
+# tests/test_api_server.py
+import asyncio
+import threading
+
+import pytest
+
+import api_server
+import data_loader
+from kg_index import get_graph_index
+
+
+def _dispatch(path):
+    async def main():
+        return await api_server.APIServer().dispatch("GET", path, {}, b"", None)
+    return asyncio.run(main())
+
+
+def test_workers_keep_the_parents_loaded_store():
+    store = data_loader.get_store()
+    index = get_graph_index()
+    assert api_server._worker_store(store) is store
+    # Derived indexes built before forking are reused, not rebuilt
+    assert store.derived("graph_index", None) is index
+
+
+def test_worker_retries_a_failed_load(tmp_path):
+    empty = data_loader.DataStore(str(tmp_path), use_snapshot=False)
+    assert api_server._worker_store(empty) is None
+
+
+def test_entities_and_funds_run_in_the_cpu_pool(monkeypatch):
+    threads = []
+    for name in ("entities_payload", "fund_payload"):
+        original = getattr(api_server, name)
+        def recording(*args, _original=original):
+            threads.append(threading.current_thread().name)
+            return _original(*args)
+        monkeypatch.setattr(api_server, name, recording)
+
+    entities = _dispatch("/entities")
+    fund = _dispatch("/funds/F001")
+    assert any(f["id"] == "FundA_Growth" for f in entities["funds"])
+    assert fund["internal_key"] == "FundA_Growth"
+    assert all(name.startswith("kb-cpu") for name in threads) and len(threads) == 2
+
+
+def test_unknown_fund_is_a_404():
+    with pytest.raises(api_server.HTTPError) as e:
+        _dispatch("/funds/NOPE")
+    assert e.value.status == 404
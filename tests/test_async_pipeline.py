@@ -0,0 +1,91 @@
+# tests/test_async_pipeline.py
+import asyncio
+
+import pytest
+
+import async_pipeline
+from async_pipeline import QueryService
+from context_builder import build_context
+from intent_parser import parse_intent
+
+QUERIES = ["Tell me about FundA Growth", "Find high risk funds", "Which funds are affected by Crude Oil Price?",
+           "Tell me about Beta Investments", "Funds investing in Energy", "What is Interest Rates?"]
+
+
+class _SlowLLM:
+    """Awaitable fake LLM that records how many calls are in flight and which were cancelled."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled = 0
+
+    async def __call__(self, context, query):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        return f"answer to {query}"
+
+
+@pytest.fixture
+def slow_llm(monkeypatch):
+    llm = _SlowLLM(0.2)
+    monkeypatch.setattr(async_pipeline, "get_llm_response_async", llm)
+    return llm
+
+
+def test_answers_match_the_sync_pipeline(slow_llm):
+    results = asyncio.run(QueryService().answer_many(QUERIES))
+    for query, result in zip(QUERIES, results):
+        intent, entities = parse_intent(query)
+        assert (result["intent"], result["entities"]) == (intent, entities)
+        assert (result["context"], result["explanation"]) == build_context(intent, entities)
+        assert result["status"] == "answered" and result["answer"] == f"answer to {query}"
+
+
+def test_concurrency_is_bounded_and_llm_waits_overlap(slow_llm):
+    async def run():
+        service = QueryService(max_concurrency=2)
+        await service.answer_many(QUERIES[:1])  # Warm the indexes outside the timing
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await service.answer_many(QUERIES)
+        return service, loop.time() - start
+    service, elapsed = asyncio.run(run())
+    assert slow_llm.max_in_flight == 2
+    # Six 0.2s calls, two at a time: about 0.6s rather than 1.2s
+    assert elapsed < 1.0
+    assert service.get_stats()["completed"] == len(QUERIES) + 1
+
+
+def test_cancelling_a_request_cancels_its_llm_call(monkeypatch):
+    llm = _SlowLLM(5.0)
+    monkeypatch.setattr(async_pipeline, "get_llm_response_async", llm)
+
+    async def run():
+        service = QueryService()
+        request_id, task = service.submit("Tell me about FundA Growth")
+        while not llm.in_flight:
+            await asyncio.sleep(0.01)
+        assert service.cancel(request_id)
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return service
+    service = asyncio.run(asyncio.wait_for(run(), timeout=3))
+    assert llm.cancelled == 1
+    assert service.get_stats()["cancelled"] == 1
+    assert service.get_stats()["pending"] == 0
+
+
+def test_unknown_query_makes_no_llm_call(slow_llm):
+    result = asyncio.run(QueryService().answer("xyzzy plugh"))
+    assert result["intent"] == "unknown" and result["answer"] is None
+    assert "llm" not in result["timings_ms"] and result["tokens"]["prompt"] == 0
+    assert slow_llm.max_in_flight == 0
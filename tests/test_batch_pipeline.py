@@ -0,0 +1,70 @@
+# tests/test_batch_pipeline.py
+import json
+import threading
+
+import batch_pipeline
+from batch_pipeline import load_queries, run_batch
+from context_builder import build_context
+from intent_parser import parse_intent
+
+# rate_per_minute=0 turns the rate limiter off (the fake LLM below is free)
+QUERIES = [
+    "Tell me about FundA Growth",
+    "tell me about funda growth?",        # same question, same context
+    "Which funds are affected by Crude Oil Price?",
+    "Tell me about FundA Growth",         # exact duplicate
+    "Find high risk funds",
+    "xyzzy plugh",                         # unknown: no context, no call
+]
+
+
+def _fake_llm(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def _answer(context, query):
+        with lock:
+            calls.append((context, query))
+        return f"answer to {query}"
+    monkeypatch.setattr(batch_pipeline, "get_llm_response", _answer)
+    return calls
+
+
+def test_batch_matches_one_query_at_a_time(monkeypatch):
+    _fake_llm(monkeypatch)
+    records, _ = run_batch(QUERIES, rate_per_minute=0)
+    assert [r["query"] for r in records] == QUERIES
+    for record in records:
+        intent, entities = parse_intent(record["query"])
+        assert (record["intent"], record["entities"]) == (intent, entities)
+        if intent != "unknown":
+            assert (record["context"], record["explanation"]) == build_context(intent, entities)
+    assert records[-1]["status"] == "unknown_intent" and records[-1]["answer"] is None
+
+
+def test_each_distinct_prompt_is_sent_once(monkeypatch):
+    calls = _fake_llm(monkeypatch)
+    records, summary = run_batch(QUERIES, max_concurrency=3, rate_per_minute=0)
+    # FundA (three spellings of one question), the factor list and the risk list
+    assert len(calls) == summary["llm_calls"] == 3
+    assert summary["queries"] == 6 and summary["distinct_queries"] == 5
+    fund_records = [r for r in records if r["intent"] == "get_fund_details"]
+    assert [r["deduplicated"] for r in fund_records] == [False, True, True]
+    assert len({r["answer"] for r in fund_records}) == 1
+    assert summary["status_counts"] == {"answered": 5, "unknown_intent": 1}
+
+
+def test_inputs_and_jsonl_output(monkeypatch, tmp_path):
+    _fake_llm(monkeypatch)
+    (tmp_path / "q.txt").write_text("Find high risk funds\n\nTell me about FundA Growth\n")
+    (tmp_path / "q.jsonl").write_text('{"id": "a", "query": "Find high risk funds"}\n')
+    (tmp_path / "q.csv").write_text("query,id\nFind high risk funds,x1\n")
+    assert load_queries(str(tmp_path / "q.txt")) == [{"id": 0, "query": "Find high risk funds"},
+                                                     {"id": 1, "query": "Tell me about FundA Growth"}]
+    assert load_queries(str(tmp_path / "q.jsonl")) == [{"id": "a", "query": "Find high risk funds"}]
+    assert load_queries(str(tmp_path / "q.csv")) == [{"id": "x1", "query": "Find high risk funds"}]
+
+    output = tmp_path / "out.jsonl"
+    records, _ = run_batch(load_queries(str(tmp_path / "q.txt")), output_path=str(output), rate_per_minute=0)
+    written = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [(r["id"], r["answer"]) for r in written] == [(r["id"], r["answer"]) for r in records]
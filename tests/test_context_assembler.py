@@ -0,0 +1,41 @@
+# tests/test_context_assembler.py
+from context_assembler import assemble, estimate_tokens, fact
+from context_builder import format_fund_window, format_list_of_funds
+
+
+def _funds(n):
+    return [{"name": f"Fund{i}", "risk": "High", "primary_sector": "Energy", "amc_id": "AMC_X"} for i in range(n)]
+
+
+def test_assemble_keeps_required_and_best_facts():
+    facts = [fact("Header", required=True), fact("low " * 10, 0.1), fact("high " * 10, 0.9)]
+    packed = assemble(facts, budget=20)
+    assert packed.text.startswith("Header\n")
+    assert "high" in packed.text and "low" not in packed.text
+    assert packed.tokens <= 20
+
+
+def test_overflow_line_counts_dropped_facts():
+    facts = [fact("Header", required=True)] + [fact("fact " * 10, 1.0 - i / 10) for i in range(5)]
+    packed = assemble(facts, budget=30, overflow=lambda n: f"...and {n} more.")
+    assert packed.text.rstrip().endswith(f"...and {5 - (packed.included - 1)} more.")
+
+
+def test_overflow_line_for_funds_beyond_the_window_when_window_fits():
+    # Every windowed fund fits the budget, but 8 more were never formatted
+    text = format_fund_window(_funds(2), 10, "in Energy", budget=500)
+    assert text.startswith("Found 10 fund(s) in Energy:")
+    assert "Fund0" in text and "Fund1" in text
+    assert text.rstrip().endswith("...and 8 more.")
+
+
+def test_overflow_combines_dropped_and_hidden_funds():
+    text = format_list_of_funds(_funds(50), "in Energy", budget=120)
+    listed = sum(1 for line in text.splitlines() if line.startswith("- "))
+    assert text.rstrip().endswith(f"...and {50 - listed} more.")
+    assert estimate_tokens(text) <= 120 + 2
+
+
+def test_no_overflow_line_when_everything_is_shown():
+    text = format_fund_window(_funds(3), 3, budget=500)
+    assert "more." not in text
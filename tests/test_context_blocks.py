@@ -0,0 +1,70 @@
+# tests/test_context_blocks.py
+import pytest
+
+import data_loader
+from context_blocks import ContextBlocks, block_key, get_context_blocks, materialize
+from context_builder import build_context
+from data_loader import DataStore
+from synthetic_kb import generate_knowledge_base
+
+
+def _requests(tables):
+    """One request per materialized intent and entity, plus unknown entities."""
+    requests = [("get_fund_details", {"fund_internal_key": key}) for key in tables["funds"]["internal_key"]]
+    for amc_id in tables["amcs"]["amc_id"]:
+        requests += [("get_amc_details", {"amc_id": amc_id}), ("find_funds_by_amc", {"amc_id": amc_id})]
+    for sector_id in tables["sectors"]["sector_id"]:
+        requests += [("get_sector_details", {"sector_id": sector_id}), ("find_funds_by_sector", {"sector_id": sector_id})]
+    requests += [("get_factor_details", {"factor_id": factor_id}) for factor_id in tables["factors"]["factor_id"]]
+    requests += [("find_funds_by_risk", {"risk_level": level}) for level in ("High", "Medium", "Low")]
+    requests += [("get_fund_details", {"fund_internal_key": "NoSuchFund"}), ("find_funds_by_amc", {"amc_id": "NoSuchAMC"})]
+    return requests
+
+
+@pytest.fixture(params=["sample", "synthetic"])
+def kb(request):
+    previous = data_loader.get_store()
+    if request.param == "sample":
+        store = DataStore(data_loader.default_data_dir(), use_snapshot=False)
+    else:
+        store = DataStore.from_frames(generate_knowledge_base(n_funds=300, n_sectors=8, n_factors=10, seed=2))
+    data_loader.set_store(store)
+    yield store.get_tables(list(data_loader.TABLE_FILES))
+    data_loader.set_store(previous)
+
+
+def test_blocks_match_live_contexts(kb, monkeypatch):
+    requests = _requests(kb)
+    materialized = [build_context(intent, entities)[0] for intent, entities in requests]
+    assert get_context_blocks().stats["blocks"] > 0
+    monkeypatch.setenv("CONTEXT_BLOCKS", "0")
+    live = [build_context(intent, entities)[0] for intent, entities in requests]
+    for request, block, context in zip(requests, materialized, live):
+        assert block == context, request
+
+
+def test_only_changed_blocks_are_rendered_again():
+    tables = generate_knowledge_base(n_funds=300, n_sectors=8, n_factors=10, seed=2)
+    first = materialize(DataStore.from_frames(tables))
+
+    funds = tables["funds"].copy()
+    funds.loc[5, "description"] = "Rewritten description."
+    edited = DataStore.from_frames({**tables, "funds": funds})
+    second = materialize(edited, first)
+    fresh = materialize(DataStore.from_frames({**tables, "funds": funds}))
+    # The fund's own block, plus at most the AMC/sector/risk lists showing it
+    assert 1 <= second.stats["rendered"] <= 1 + 2 + len(tables["sectors"])
+    assert second.keys == fresh.keys
+    assert all(second.get(key) == fresh.get(key) for key in fresh.keys)
+    key = block_key("get_fund_details", funds.loc[5, "internal_key"])
+    assert "Rewritten description." in second.get(key) and second.get(key) != first.get(key)
+
+
+def test_saved_blocks_round_trip(tmp_path):
+    blocks = materialize(DataStore.from_frames(generate_knowledge_base(n_funds=50, seed=4)))
+    path = str(tmp_path / "context_blocks.npz")
+    blocks.save(path)
+    loaded = ContextBlocks.load(path)
+    assert loaded.keys == blocks.keys and loaded.budget == blocks.budget
+    assert all(loaded.get(key) == blocks.get(key) for key in blocks.keys)
+    assert ContextBlocks.load(str(tmp_path / "missing.npz")) is None
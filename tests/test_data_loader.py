@@ -0,0 +1,158 @@
+# tests/test_data_loader.py
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import data_loader
+from data_loader import DataStore
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def kb_dir(tmp_path):
+    """A private copy of the sample CSVs."""
+    data_dir = tmp_path / "kb"
+    data_dir.mkdir()
+    for filename in data_loader.TABLE_FILES.values():
+        shutil.copy(os.path.join(data_loader.default_data_dir(), filename), data_dir / filename)
+    return str(data_dir)
+
+
+def test_importing_the_pipeline_loads_nothing():
+    code = ("import data_loader, intent_parser, graph_query, context_builder, entity_matcher, kg_index\n"
+            "store = data_loader._store\n"
+            "print('loaded:', sorted(store._tables) if store else [])")
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, capture_output=True, text=True, check=True,
+                         env={**os.environ, "LLM_BACKEND": "stub"}).stdout
+    assert "loaded: []" in out
+
+
+def test_tables_are_read_on_first_access_only(kb_dir):
+    store = DataStore(kb_dir, use_snapshot=False)
+    assert store.load_stats == {}
+    funds = store.get_tables(["funds"])["funds"]
+    assert set(store.load_stats) == {"funds"}
+    assert store.table("funds") is funds
+    store.get_loaded_data()
+    assert set(store.load_stats) == set(data_loader.TABLE_FILES)
+
+
+def test_missing_csv_fails_the_load_without_raising(kb_dir, capsys):
+    os.remove(os.path.join(kb_dir, data_loader.TABLE_FILES["sectors"]))
+    store = DataStore(kb_dir, use_snapshot=False)
+    assert store.get_tables(["funds"]) is not None
+    assert store.get_tables() is None
+    assert "Error loading data" in capsys.readouterr().out
+
+
+def test_fixture_stores_treat_missing_tables_as_empty():
+    store = DataStore.from_frames({"funds": data_loader.read_csv_table("funds")})
+    assert store.table("amcs").empty
+    with pytest.raises(KeyError):
+        store.table("no_such_table")
+
+
+def test_legacy_module_attributes_still_work(kb_dir):
+    previous = data_loader.get_store()
+    data_loader.set_store(DataStore(kb_dir, use_snapshot=False))
+    try:
+        assert data_loader.funds_df.equals(data_loader.get_store().table("funds"))
+        assert set(data_loader.loaded_data) == set(data_loader.TABLE_FILES)
+    finally:
+        data_loader.set_store(previous)
+
+
+def test_derived_structures_are_built_once_per_store():
+    store = DataStore.from_frames({})
+    calls = []
+    build = lambda s: calls.append(s) or object()
+    value = store.derived("thing", build, depends_on=["funds"])
+    assert store.derived("thing", build) is value and store.derived("thing", None) is value
+    assert calls == [store]
+
+
+@pytest.fixture
+def live_kb(kb_dir):
+    """The kb_dir copy served as the current store, with every table loaded."""
+    previous = data_loader.get_store()
+    data_loader.set_store(DataStore(kb_dir, use_snapshot=False))
+    data_loader.get_store().get_loaded_data()
+    yield kb_dir
+    data_loader.set_store(previous)
+
+
+def _append(data_dir, table, line):
+    # Appending changes the size, so the edit is seen even within the mtime resolution
+    with open(os.path.join(data_dir, data_loader.TABLE_FILES[table]), "a") as f:
+        f.write(line + "\n")
+
+
+def _markers(store):
+    """Derived markers depending on amcs, on funds, and on every table."""
+    return {deps: store.derived(f"marker_{deps}", lambda s: object(), depends_on=None if deps == "all" else [deps])
+            for deps in ("amcs", "funds", "all")}
+
+
+def test_derived_values_are_rebuilt_only_when_their_tables_change(live_kb):
+    old_store = data_loader.get_store()
+    old = _markers(old_store)
+    _append(live_kb, "amcs", "AMC_Z,Zeta Funds,2020,Small")
+    assert data_loader.refresh_if_changed(settle_seconds=0) == ["amcs"]
+
+    new_store = data_loader.get_store()
+    assert new_store is not old_store and new_store.version == old_store.version + 1
+    # Structures to rebuild can start from the value they replace (until they are rebuilt)
+    assert new_store.previous_derived("marker_amcs") is old["amcs"]
+    assert new_store.previous_derived("marker_funds") is None
+    new = _markers(new_store)
+    assert new["funds"] is old["funds"]
+    assert new["amcs"] is not old["amcs"] and new["all"] is not old["all"]
+    assert new_store.previous_derived("marker_amcs") is None
+    # Unchanged tables are the same DataFrames; nothing more changed on disk
+    assert new_store.table("funds") is old_store.table("funds")
+    assert "AMC_Z" in set(new_store.table("amcs")["amc_id"])
+    assert data_loader.refresh_if_changed(settle_seconds=0) == []
+
+
+def test_carry_over_keeps_real_indexes_that_do_not_read_the_changed_table(live_kb):
+    from entity_matcher import get_entity_matcher
+    from kg_index import get_graph_index
+    matcher, graph_index = get_entity_matcher(), get_graph_index()
+    _append(live_kb, "fund_secondary_sectors", "F001,Energy")
+    assert data_loader.refresh_if_changed(settle_seconds=0) == ["fund_secondary_sectors"]
+    # The matcher only reads names; the graph index holds the secondary-sector links
+    assert get_entity_matcher() is matcher
+    assert get_graph_index() is not graph_index
+
+    _append(live_kb, "amcs", "AMC_Z,Zeta Funds,2020,Small")
+    data_loader.refresh_if_changed(settle_seconds=0)
+    assert get_entity_matcher() is not matcher
+    assert get_entity_matcher().best_by_type("Tell me about Zeta Funds")["amc"].entity_id == "AMC_Z"
+
+
+def test_previous_values_survive_versions_that_did_not_rebuild_them(live_kb):
+    old = _markers(data_loader.get_store())
+    _append(live_kb, "amcs", "AMC_Z,Zeta Funds,2020,Small")
+    data_loader.refresh_if_changed(settle_seconds=0)
+    # marker_amcs is not used in this version, and funds changes next
+    _append(live_kb, "funds", "")
+    data_loader.refresh_if_changed(settle_seconds=0)
+    assert data_loader.get_store().previous_derived("marker_amcs") is old["amcs"]
+
+
+def test_requests_keep_their_version_and_failed_reloads_keep_serving(live_kb, capsys):
+    with data_loader.pinned_store() as pinned:
+        _append(live_kb, "amcs", "AMC_Z,Zeta Funds,2020,Small")
+        data_loader.refresh_if_changed(settle_seconds=0)
+        assert data_loader.get_store() is pinned
+    current = data_loader.get_store()
+    assert current is not pinned
+
+    os.remove(os.path.join(live_kb, data_loader.TABLE_FILES["sectors"]))
+    assert data_loader.refresh_if_changed(settle_seconds=0) == []
+    assert data_loader.get_store() is current
+    assert "hot reload of sectors failed" in capsys.readouterr().out
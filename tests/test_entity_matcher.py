@@ -0,0 +1,81 @@
+# tests/test_entity_matcher.py
+import pytest
+
+import data_loader
+from data_loader import DataStore
+from entity_matcher import ENTITY_SOURCES, EntityMatcher, SharedEntityMatcher, build_entity_matcher, get_entity_matcher
+from synthetic_kb import generate_knowledge_base
+
+QUERIES = [
+    "Tell me about FundA Growth",
+    "tell me about funda growth?",
+    "Which funds are affected by Crude Oil Price?",
+    "How sensitive is FundD Energy Focus to Interest Rates?",
+    "What funds does AMC_X manage?",
+    "Tell me about Beta Investments",
+    "Show funds investing in the Energy sector",
+    "Funds in Technology or Finance affected by Interest Rates",
+    "What is Inflation?",
+    "High risk funds in Energy managed by Alpha Management Corp",
+    "Which funds follow Energy?",
+    "xyzzy plugh",
+    "",
+]
+
+
+def _substring_matches(tables, query):
+    """
+    The pre-automaton matcher: per entity type, the first row (CSV order) whose
+    name or ID occurs in the lowercased query, as {entity_type: entity_id}.
+    """
+    query_lower = query.lower()
+    found = {}
+    for entity_type, table, id_col, match_cols in ENTITY_SOURCES:
+        df = tables[table]
+        for _, row in df.iterrows():
+            if any(isinstance(row[col], str) and row[col] and row[col].lower() in query_lower for col in match_cols):
+                found[entity_type] = row[id_col]
+                break
+    return found
+
+
+def _automaton_matches(matcher, query):
+    return {entity_type: match.entity_id for entity_type, match in matcher.best_by_type(query).items()}
+
+
+def test_matches_equal_the_substring_matcher_on_sample_queries():
+    tables = data_loader.get_store().get_tables([table for _, table, _, _ in ENTITY_SOURCES])
+    matcher = get_entity_matcher()
+    for query in QUERIES:
+        assert _automaton_matches(matcher, query) == _substring_matches(tables, query), query
+
+
+def test_matches_equal_the_substring_matcher_on_generated_names():
+    tables = generate_knowledge_base(n_funds=200, n_sectors=8, n_factors=10, seed=3)
+    matcher = build_entity_matcher(tables)
+    names = [tables[table][cols[0]].iloc[i] for _, table, _, cols in ENTITY_SOURCES for i in (0, -1)]
+    queries = [f"tell me about {name}" for name in names]
+    queries += [f"Is {a} exposed to {b}?" for a, b in zip(names, reversed(names))]
+    for query in queries:
+        assert _automaton_matches(matcher, query) == _substring_matches(tables, query), query
+
+
+def test_overlapping_and_repeated_patterns_are_all_reported():
+    matcher = EntityMatcher([("he", "a", "A", 0), ("she", "b", "B", 0), ("hers", "c", "C", 0), ("HE", "d", "D", 1)])
+    found = sorted((m.start, m.end, m.entity_id, m.text) for m in matcher.find_all("uSHErs"))
+    assert found == [(1, 4, "B", "SHE"), (2, 4, "A", "HE"), (2, 4, "D", "HE"), (2, 6, "C", "HErs")]
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_flattened_automaton_finds_the_same_matches(query):
+    matcher = get_entity_matcher()
+    shared = SharedEntityMatcher(matcher.to_arrays())
+    assert shared.find_all(query) == matcher.find_all(query)
+
+
+def test_matcher_is_rebuilt_per_store():
+    tables = generate_knowledge_base(n_funds=20, seed=1)
+    store = DataStore.from_frames(tables)
+    name = tables["funds"]["name"].iloc[0]
+    assert get_entity_matcher(store).best_by_type(f"about {name}")["fund"].entity_id == tables["funds"]["internal_key"].iloc[0]
+    assert get_entity_matcher(store) is get_entity_matcher(store)
@@ -0,0 +1,65 @@
+# tests/test_factor_impact.py
+import numpy as np
+import pytest
+
+import graph_query
+from context_builder import build_context
+from factor_impact import SparseRows, get_impact_engine
+from kg_index import get_graph_index
+
+FACTORS = ["Crude Oil Price", "Interest Rates", "Inflation", "Chip Shortage", "GDP Growth"]
+
+
+def test_co_occurrence_matches_dense_product():
+    rows = [0, 0, 1, 1, 2, 3, 3]
+    cols = [0, 1, 1, 2, 2, 0, 2]
+    sparse = SparseRows(rows, cols, np.ones(len(rows)), 4, 3)
+    dense = (sparse.to_dense() > 0).astype(np.float64)
+    assert np.array_equal(sparse.co_occurrence(), dense @ dense.T)
+
+
+def test_tiers_split_the_total_exposure():
+    engine = get_impact_engine()
+    direct, indirect = engine.exposure_tiers(FACTORS)
+    assert np.allclose(direct + indirect, engine.exposure_scores(FACTORS))
+    # No fund is in both tiers
+    assert not np.any((direct > 0) & (indirect > 0))
+
+
+@pytest.mark.parametrize("factor_id", FACTORS)
+def test_direct_tier_is_the_funds_linked_to_the_factor(factor_id):
+    index = get_graph_index()
+    linked = {f["internal_key"] for f in graph_query.find_funds_related_to_factor(factor_id)}
+    direct = graph_query.rank_funds_by_factor(factor_id)
+    indirect = graph_query.rank_funds_by_factor(factor_id, tier="indirect")
+    assert {f["internal_key"] for f in direct} == linked
+    assert not linked & {f["internal_key"] for f in indirect}
+    assert all(f["exposure_tier"] == "direct" for f in direct)
+    assert all(f["exposure_tier"] == "indirect" for f in indirect)
+    scores = [f["exposure_score"] for f in direct]
+    assert scores == sorted(scores, reverse=True)
+    assert len(direct) + len(indirect) <= index.n_funds
+
+
+def test_indirect_funds_are_listed_separately_in_the_context():
+    # FundA Growth holds no sector Crude Oil Price affects
+    context, _ = build_context("find_funds_by_factor", {"factor_id": "Crude Oil Price"})
+    affected, _, indirect = context.partition("only indirectly exposed")
+    assert "FundA Growth" not in affected
+    assert "FundA Growth" in indirect
+    assert "FundD Energy Focus" in affected
+
+
+@pytest.mark.parametrize("factor_id", FACTORS)
+def test_both_tiers_come_from_one_traversal(factor_id, monkeypatch):
+    direct, indirect = graph_query.rank_funds_by_factor_tiers(factor_id)
+    assert direct == graph_query.rank_funds_by_factor(factor_id)
+    assert indirect == graph_query.rank_funds_by_factor(factor_id, tier="indirect")
+
+    engine = get_impact_engine()
+    calls = []
+    real = engine.exposure_tiers
+    monkeypatch.setattr(engine, "exposure_tiers", lambda *args, **kwargs: calls.append(args) or real(*args, **kwargs))
+    monkeypatch.setenv("CONTEXT_BLOCKS", "0")
+    build_context("find_funds_by_factor", {"factor_id": factor_id})
+    assert len(calls) == 1
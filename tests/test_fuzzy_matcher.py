@@ -0,0 +1,57 @@
+# tests/test_fuzzy_matcher.py
+import pytest
+
+from fuzzy_matcher import FuzzyMatcher, build_fuzzy_matcher, get_fuzzy_matcher
+from intent_parser import parse_intent
+from synthetic_kb import generate_knowledge_base
+
+
+@pytest.mark.parametrize("query, intent, field, entity_id", [
+    ("tell me about fund a growht", "get_fund_details", "fund_internal_key", "FundA_Growth"),
+    ("funds managed by alpha managment", "find_funds_by_amc", "amc_id", "AMC_X"),
+    ("amcx funds", "find_funds_by_amc", "amc_id", "AMC_X"),
+    ("how does crude oill price affect funds", "find_funds_by_factor", "factor_id", "Crude Oil Price"),
+    ("funds in the helthcare sector", "find_funds_by_sector", "sector_id", "Healthcare"),
+])
+def test_misspelled_names_resolve(query, intent, field, entity_id):
+    parsed_intent, entities = parse_intent(query)
+    assert parsed_intent == intent
+    assert entities[field] == entity_id
+    assert 0 < entities["fuzzy_score"] <= 1
+
+
+def test_unrelated_query_resolves_nothing():
+    assert get_fuzzy_matcher().resolve("what is the weather today") == []
+    assert parse_intent("what is the weather today")[0] == "unknown"
+
+
+def test_lookup_ranks_the_closest_name_first():
+    hits = get_fuzzy_matcher().lookup("Zenit Capitl")
+    assert hits[0][1:3] == ("amc", "AMC_Z")
+    assert get_fuzzy_matcher().lookup("Zenit Capitl", entity_type="fund") == []
+
+
+@pytest.fixture(scope="module")
+def large_kb():
+    tables = generate_knowledge_base(n_funds=5000, seed=1)
+    return tables, build_fuzzy_matcher(tables)
+
+
+def test_typos_resolve_among_thousands_of_similar_names(large_kb):
+    # Fund names share most of their trigrams ("... Growth Regular"), so candidates
+    # come from the rare-trigram seeds rather than the exact prefix lookup
+    tables, matcher = large_kb
+    names = tables["funds"]["name"].tolist()[:100]
+    for name in names:
+        typo = name.lower()[:3] + name.lower()[4:]
+        hits = matcher.lookup(typo, entity_type="fund", limit=1)
+        # Reused names (name collisions) may resolve to another fund with the same name
+        assert hits and hits[0][3] == name, typo
+
+
+def test_matcher_rebuilt_from_arrays_resolves_the_same(large_kb):
+    tables, matcher = large_kb
+    restored = FuzzyMatcher.from_arrays(matcher.to_arrays())
+    for name in tables["funds"]["name"].tolist()[:20]:
+        query = "tell me about " + name.lower().replace("o", "0", 1)
+        assert restored.resolve(query) == matcher.resolve(query)
@@ -0,0 +1,147 @@
+# tests/test_graph_query.py
+# The index-backed graph_query functions must return what the original pandas
+# filters over the CSV tables returned (same rows, same order), on the sample
+# CSVs and on a generated knowledge base with many funds per sector and factor.
+import math
+
+import pandas as pd
+import pytest
+
+import data_loader
+import graph_query
+from data_loader import DataStore
+from synthetic_kb import generate_knowledge_base
+
+
+# --- Reference implementations (the pre-index pandas queries) ---
+
+def pandas_fund_details(t, fund_internal_key):
+    fund_series = t["funds"][t["funds"]['internal_key'] == fund_internal_key]
+    if fund_series.empty:
+        return None
+    fund_dict = fund_series.iloc[0].to_dict()
+    fund_id = fund_dict['fund_id']
+    sec = t["fund_secondary_sectors"]
+    rel = t["fund_related_factors"]
+    fund_dict['secondary_sectors'] = sec[sec['fund_id'] == fund_id]['sector_id'].tolist()
+    fund_dict['related_factors'] = rel[rel['fund_id'] == fund_id]['factor_id'].tolist()
+    return fund_dict
+
+
+def pandas_factor_details(t, factor_id):
+    factor_series = t["factors"][t["factors"]['factor_id'] == factor_id]
+    if factor_series.empty:
+        return None
+    factor_dict = factor_series.iloc[0].to_dict()
+    affected = t["factor_affected_sectors"]
+    factor_dict['typically_affected_sectors'] = affected[affected['factor_id'] == factor_id]['sector_id'].tolist()
+    return factor_dict
+
+
+def pandas_funds_by_amc(t, amc_id):
+    return t["funds"][t["funds"]['amc_id'] == amc_id].to_dict('records')
+
+
+def pandas_funds_by_sector(t, sector_id):
+    funds = t["funds"]
+    sec = t["fund_secondary_sectors"]
+    primary = funds[funds['primary_sector'] == sector_id]
+    secondary_ids = sec[sec['sector_id'] == sector_id]['fund_id'].unique()
+    secondary = funds[funds['fund_id'].isin(secondary_ids)]
+    return pd.concat([primary, secondary]).drop_duplicates(subset=['fund_id']).to_dict('records')
+
+
+def pandas_funds_related_to_factor(t, factor_id):
+    funds = t["funds"]
+    rel = t["fund_related_factors"]
+    affected = t["factor_affected_sectors"]
+    sec = t["fund_secondary_sectors"]
+    ids = set(rel[rel['factor_id'] == factor_id]['fund_id'].unique())
+    sectors = affected[affected['factor_id'] == factor_id]['sector_id'].unique()
+    if len(sectors) > 0:
+        ids.update(funds[funds['primary_sector'].isin(sectors)]['fund_id'].unique())
+        ids.update(sec[sec['sector_id'].isin(sectors)]['fund_id'].unique())
+    if not ids:
+        return []
+    return funds[funds['fund_id'].isin(list(ids))].to_dict('records')
+
+
+def pandas_funds_by_risk(t, risk_level):
+    funds = t["funds"]
+    return funds[funds['risk'].str.lower() == risk_level.lower()].to_dict('records')
+
+
+# --- Helpers ---
+
+def _same(a, b):
+    if isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b):
+        return True
+    return a == b
+
+
+def assert_same_record(actual, expected):
+    if expected is None:
+        assert actual is None
+        return
+    assert actual is not None
+    assert set(actual) == set(expected)
+    for column, value in expected.items():
+        assert _same(actual[column], value), column
+
+
+def assert_same_records(actual, expected):
+    assert [r['fund_id'] for r in actual] == [r['fund_id'] for r in expected]
+    for a, e in zip(actual, expected):
+        assert_same_record(a, e)
+
+
+@pytest.fixture(params=["sample", "synthetic"])
+def kb(request):
+    """Tables of the knowledge base the current store serves."""
+    previous = data_loader.get_store()
+    if request.param == "sample":
+        store = DataStore(data_loader.default_data_dir(), use_snapshot=False)
+    else:
+        store = DataStore.from_frames(generate_knowledge_base(n_funds=400, n_sectors=12, n_factors=15, seed=7))
+    data_loader.set_store(store)
+    yield store.get_tables(list(data_loader.TABLE_FILES))
+    data_loader.set_store(previous)
+
+
+def test_entity_details_match_pandas(kb):
+    for key in kb["funds"]['internal_key'].tolist() + ["NoSuchFund"]:
+        assert_same_record(graph_query.get_fund_details(key), pandas_fund_details(kb, key))
+    for factor_id in kb["factors"]['factor_id'].tolist() + ["NoSuchFactor"]:
+        assert_same_record(graph_query.get_factor_details(factor_id), pandas_factor_details(kb, factor_id))
+    for amc in kb["amcs"].to_dict('records'):
+        assert_same_record(graph_query.get_amc_details(amc['amc_id']), amc)
+    for sector in kb["sectors"].to_dict('records'):
+        assert_same_record(graph_query.get_sector_details(sector['sector_id']), sector)
+
+
+def test_fund_lists_match_pandas(kb):
+    for amc_id in kb["amcs"]['amc_id'].tolist() + ["NoSuchAMC"]:
+        assert_same_records(graph_query.find_funds_by_amc(amc_id), pandas_funds_by_amc(kb, amc_id))
+    for sector_id in kb["sectors"]['sector_id'].tolist() + ["NoSuchSector"]:
+        assert_same_records(graph_query.find_funds_by_sector(sector_id), pandas_funds_by_sector(kb, sector_id))
+    for factor_id in kb["factors"]['factor_id'].tolist() + ["NoSuchFactor"]:
+        assert_same_records(graph_query.find_funds_related_to_factor(factor_id),
+                            pandas_funds_related_to_factor(kb, factor_id))
+    for risk in ["High", "medium", "LOW", "Unknown"]:
+        assert_same_records(graph_query.find_funds_by_risk(risk), pandas_funds_by_risk(kb, risk))
+
+
+def test_constraints_match_pandas_intersection(kb):
+    sector_id = kb["sectors"]['sector_id'].iloc[0]
+    amc_id = kb["funds"]['amc_id'].iloc[0]
+    funds, steps = graph_query.find_funds_by_constraints([("risk", "High"), ("sector", sector_id)])
+    expected = {r['fund_id'] for r in pandas_funds_by_risk(kb, "High")} & \
+               {r['fund_id'] for r in pandas_funds_by_sector(kb, sector_id)}
+    assert [f['fund_id'] for f in funds] == [i for i in kb["funds"]['fund_id'].tolist() if i in expected]
+    assert steps
+    # Two values of one kind are OR-ed
+    funds, _ = graph_query.find_funds_by_constraints([("amc", amc_id), ("risk", "High"), ("risk", "Low")])
+    expected = {r['fund_id'] for r in pandas_funds_by_amc(kb, amc_id)} & \
+               ({r['fund_id'] for r in pandas_funds_by_risk(kb, "High")} |
+                {r['fund_id'] for r in pandas_funds_by_risk(kb, "Low")})
+    assert {f['fund_id'] for f in funds} == expected
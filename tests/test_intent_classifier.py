@@ -0,0 +1,75 @@
+# tests/test_intent_classifier.py
+import numpy as np
+import pytest
+
+import intent_parser
+from intent_classifier import IntentClassifier
+from intent_parser import parse_intents
+
+QUERIES = [
+    "Tell me about FundA Growth",
+    "Which funds are affected by Crude Oil Price?",
+    "What is Interest Rates?",
+    "Show funds managed by Alpha Management Corp",
+    "Tell me about Beta Investments",
+    "Funds investing in Energy",
+    "Describe the Healthcare sector",
+    "Find high risk funds",
+]
+
+
+class _FixedClassifier:
+    """Predicts the same (intent, probability) for every query."""
+
+    def __init__(self, intent, probability):
+        self.prediction = (intent, probability)
+
+    def predict(self, texts):
+        return [self.prediction] * len(texts)
+
+
+@pytest.fixture
+def rules(monkeypatch):
+    """What the keyword rules alone make of QUERIES."""
+    monkeypatch.setenv("INTENT_CLASSIFIER", "0")
+    results = parse_intents(QUERIES)
+    monkeypatch.delenv("INTENT_CLASSIFIER")
+    return results
+
+
+def test_low_confidence_falls_back_to_rules(rules):
+    assert parse_intents(QUERIES, classifier=_FixedClassifier("get_amc_details", 0.2)) == rules
+
+
+def test_prediction_without_its_entity_falls_back_to_rules(rules):
+    # Confident: accepted where an AMC is mentioned, the rules decide everywhere else
+    results = parse_intents(QUERIES, classifier=_FixedClassifier("get_amc_details", 0.99))
+    for query, result, rule in zip(QUERIES, results, rules):
+        if "amc_id" in rule[1]:
+            assert result == ("get_amc_details", {"amc_id": rule[1]["amc_id"]}), query
+        else:
+            assert result == rule, query
+
+
+def test_unavailable_classifier_falls_back_to_rules(rules, monkeypatch, capsys):
+    def _broken():
+        raise RuntimeError("no model and no labelled queries")
+    monkeypatch.setattr(intent_parser, "get_intent_classifier", _broken)
+    assert parse_intents(QUERIES) == rules
+    assert "using keyword rules" in capsys.readouterr().out
+
+
+def test_trained_classifier_agrees_with_rules_on_plain_queries(rules):
+    assert [intent for intent, _ in parse_intents(QUERIES)] == [intent for intent, _ in rules]
+
+
+def test_saved_model_is_only_loaded_for_the_same_training_data(tmp_path):
+    model = IntentClassifier.train(["tell me about _fund_", "funds managed by _amc_"],
+                                   ["get_fund_details", "find_funds_by_amc"], epochs=50)
+    path = str(tmp_path / "intent_model.npz")
+    model.save(path, "signature-1")
+    loaded = IntentClassifier.load(path, "signature-1")
+    assert loaded.labels == model.labels
+    assert np.array_equal(loaded.weights, model.weights)
+    assert IntentClassifier.load(path, "signature-2") is None
+    assert [intent for intent, _ in loaded.predict(["tell me about _fund_"])] == ["get_fund_details"]
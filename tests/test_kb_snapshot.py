@@ -0,0 +1,84 @@
+# tests/test_kb_snapshot.py
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import data_loader
+import kb_snapshot
+from data_loader import DataStore
+
+
+@pytest.fixture
+def kb_dir(tmp_path):
+    """A private copy of the sample CSVs (its snapshot goes to kb/.cache/)."""
+    data_dir = tmp_path / "kb"
+    data_dir.mkdir()
+    for filename in data_loader.TABLE_FILES.values():
+        shutil.copy(os.path.join(data_loader.default_data_dir(), filename), data_dir / filename)
+    return str(data_dir)
+
+
+def _write(data_dir):
+    tables = data_loader.load_csv_tables(data_dir)
+    kb_snapshot.write_snapshot(tables, data_loader.table_paths(data_dir), data_loader.snapshot_path_for(data_dir))
+    return tables
+
+
+def _load(data_dir):
+    return kb_snapshot.load_snapshot(data_loader.table_paths(data_dir), data_loader.snapshot_path_for(data_dir))
+
+
+def test_snapshot_round_trips_the_csv_tables(kb_dir):
+    tables = _write(kb_dir)
+    loaded = _load(kb_dir)
+    assert set(loaded) == set(tables)
+    for name, df in tables.items():
+        pd.testing.assert_frame_equal(loaded[name], df, check_dtype=False, check_categorical=False)
+
+
+def test_edited_csv_makes_the_snapshot_stale(kb_dir):
+    _write(kb_dir)
+    path = data_loader.table_paths(kb_dir)["amcs"]
+    with open(path, "a") as f:
+        f.write("AMC_Z,Zeta Funds,2020,Small\n")
+    assert not kb_snapshot.snapshot_is_fresh(data_loader.table_paths(kb_dir), data_loader.snapshot_path_for(kb_dir))
+    assert _load(kb_dir) is None
+    # The store falls back to the CSV and sees the new row
+    store = DataStore(kb_dir)
+    assert "AMC_Z" in set(store.table("amcs")["amc_id"])
+    assert store.load_stats["amcs"]["source"] == "CSV file"
+
+
+def test_same_size_edit_is_caught_by_the_hash(kb_dir):
+    _write(kb_dir)
+    path = data_loader.table_paths(kb_dir)["funds"]
+    with open(path) as f:
+        text = f.read()
+    with open(path, "w") as f:
+        f.write(text.replace("High", "HIGH", 1))
+    # Make sure the mtime moved even on coarse-grained filesystems
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert _load(kb_dir) is None
+
+
+def test_touched_but_unchanged_csv_keeps_the_snapshot(kb_dir):
+    _write(kb_dir)
+    path = data_loader.table_paths(kb_dir)["funds"]
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert _load(kb_dir) is not None
+
+
+def test_store_uses_and_rebuilds_the_snapshot(kb_dir):
+    first = DataStore(kb_dir)
+    first.get_loaded_data()
+    assert {s["source"] for s in first.load_stats.values()} == {"CSV file"}
+    # Every table came from CSV, so the store wrote the snapshot the next one loads
+    second = DataStore(kb_dir)
+    second.get_loaded_data()
+    assert {s["source"] for s in second.load_stats.values()} == {"snapshot"}
@@ -0,0 +1,65 @@
+# tests/test_kg_index.py
+import numpy as np
+import pandas as pd
+
+import graph_query
+from kb_codes import NO_CODE, Adjacency, CodeBook
+from kg_index import KnowledgeGraphIndex
+from synthetic_kb import generate_knowledge_base
+
+
+def test_codebook_round_trip_and_missing_values():
+    book = CodeBook(["b", "a", None, "b"])
+    assert book.strings == ["b", "a"]
+    assert book.encode(["a", "b", "zzz", None]).tolist() == [1, 0, NO_CODE, NO_CODE]
+    assert book.decode(book.encode(["a", "b"])) == ["a", "b"]
+    restored = CodeBook.from_arrays(book.to_arrays())
+    assert restored.code("a") == 1 and restored.code("zzz") == NO_CODE
+    assert restored.decode([0, 1]) == ["b", "a"]
+
+
+def test_adjacency_matches_groupby_in_row_order():
+    pairs = pd.DataFrame({"src": [2, 0, 2, 1, 0, -1, 2], "dst": [5, 3, 4, 7, 3, 9, -1]})
+    adjacency = Adjacency(pairs["src"], pairs["dst"], 4)
+    valid = pairs[(pairs["src"] >= 0) & (pairs["dst"] >= 0)]
+    for src in range(4):
+        assert adjacency.neighbors(src).tolist() == valid[valid["src"] == src]["dst"].tolist()
+    assert adjacency.neighbors(NO_CODE).tolist() == []
+    items, targets = adjacency.expand([2, 0])
+    assert items.tolist() == [0, 0, 1, 1] and targets.tolist() == [5, 4, 3, 3]
+
+
+def test_links_with_missing_ids_are_ignored():
+    tables = generate_knowledge_base(n_funds=50, n_sectors=5, n_factors=5, seed=3)
+    fss = tables["fund_secondary_sectors"]
+    tables["fund_secondary_sectors"] = pd.concat(
+        [fss, pd.DataFrame({"fund_id": [None, fss["fund_id"].iloc[0]], "sector_id": [fss["sector_id"].iloc[0], None]})],
+        ignore_index=True)
+    index = KnowledgeGraphIndex(tables)
+    fund_code = index.funds.code(fss["fund_id"].iloc[0])
+    expected = fss[fss["fund_id"] == fss["fund_id"].iloc[0]]["sector_id"].tolist()
+    assert index.sectors.decode(index.fund_sectors.neighbors(fund_code)) == expected
+
+
+def test_index_rebuilt_from_arrays_answers_the_same(monkeypatch):
+    tables = generate_knowledge_base(n_funds=200, n_sectors=8, n_factors=10, seed=11)
+    built = KnowledgeGraphIndex(tables)
+    # Same path shared_kb takes for attached workers
+    restored = KnowledgeGraphIndex.from_arrays(tables, built.to_arrays(), built.fund_records)
+
+    def answers(index):
+        monkeypatch.setattr(graph_query, "get_graph_index", lambda: index)
+        result = []
+        for key in tables["funds"]["internal_key"].tolist()[:20]:
+            result.append(graph_query.get_fund_details(key))
+        for sector_id in tables["sectors"]["sector_id"]:
+            result.append(graph_query.find_funds_by_sector(sector_id))
+        for factor_id in tables["factors"]["factor_id"]:
+            result.append(graph_query.find_funds_related_to_factor(factor_id))
+            result.append(graph_query.get_factor_details(factor_id))
+        for amc_id in tables["amcs"]["amc_id"]:
+            result.append(graph_query.find_funds_by_amc(amc_id))
+        return result
+
+    assert answers(restored) == answers(built)
+    assert np.array_equal(restored.fund_code, built.fund_code)
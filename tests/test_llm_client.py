@@ -0,0 +1,81 @@
+# tests/test_llm_client.py
+import asyncio
+
+import pytest
+
+import llm_client
+from llm_client import GeminiBackend, StubBackend, get_backend, set_backend
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _FlakyModel:
+    """Fake GenerativeModel failing with `errors` before answering."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def _next(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        self._next()
+        return iter([_Chunk("a"), _Chunk("b")]) if stream else "answer"
+
+    async def generate_content_async(self, prompt, request_options=None):
+        self._next()
+        return "answer"
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    monkeypatch.setattr(llm_client.time, "sleep", lambda seconds: None)
+    return GeminiBackend("models/test", max_retries=2, backoff_seconds=0.0)
+
+
+def _with_model(backend, errors):
+    backend._model = _FlakyModel(errors)
+    return backend._model
+
+
+def test_quota_errors_are_retried_the_same_way_on_every_path(gemini):
+    quota = [RuntimeError("429 Resource has been exhausted")] * 2
+    model = _with_model(gemini, quota)
+    assert gemini.generate("prompt") == "answer" and model.calls == 3
+    model = _with_model(gemini, quota)
+    assert asyncio.run(gemini.generate_async("prompt")) == "answer" and model.calls == 3
+    model = _with_model(gemini, quota)
+    assert list(gemini.generate_stream("prompt")) == ["a", "b"] and model.calls == 3
+
+
+def test_other_errors_and_exhausted_retries_raise(gemini):
+    model = _with_model(gemini, [ValueError("invalid argument")])
+    with pytest.raises(ValueError):
+        gemini.generate("prompt")
+    assert model.calls == 1
+    model = _with_model(gemini, [RuntimeError("503 service unavailable")] * 3)
+    with pytest.raises(RuntimeError):
+        asyncio.run(gemini.generate_async("prompt"))
+    assert model.calls == 3
+
+
+def test_one_backend_per_system_instruction(monkeypatch):
+    monkeypatch.setenv("LLM_BACKEND", "stub")
+    set_backend(None)
+    try:
+        plain = get_backend("stub")
+        instructed = get_backend("stub", system_instruction="Be brief.")
+        assert plain is get_backend("stub") and instructed is get_backend("stub", system_instruction="Be brief.")
+        assert plain.system_instruction is None and instructed.system_instruction == "Be brief."
+        # An installed backend serves every caller
+        stub = StubBackend()
+        set_backend(stub)
+        assert get_backend("stub", system_instruction="Be brief.") is stub
+    finally:
+        set_backend(None)
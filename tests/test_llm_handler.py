@@ -0,0 +1,58 @@
+# tests/test_llm_handler.py
+import time
+
+import pytest
+
+import llm_handler
+from llm_client import StubBackend, set_backend
+from llm_handler import StreamTimer, get_llm_response, stream_llm_response
+
+CONTEXT = "Fund: FundA Growth\nRisk: High"
+QUERY = "What is its risk?"
+
+
+@pytest.fixture
+def stub(monkeypatch, answer_cache):
+    backend = StubBackend(latency_seconds=0.05)
+    set_backend(backend)
+    monkeypatch.setattr(llm_handler, "get_answer_cache", lambda: answer_cache)
+    yield backend
+    set_backend(None)
+
+
+def test_stream_timer_records_first_token_and_total_time():
+    def chunks():
+        time.sleep(0.02)
+        yield "a"
+        time.sleep(0.05)
+        yield "b"
+    timer = StreamTimer()
+    assert list(timer.wrap(chunks())) == ["a", "b"]
+    assert timer.chunks == 2
+    assert 0.02 <= timer.time_to_first_token < timer.total_time
+    assert timer.total_time >= 0.07
+
+    empty = StreamTimer()
+    assert list(empty.wrap(iter([]))) == []
+    assert empty.time_to_first_token is None and empty.chunks == 0 and empty.total_time is not None
+
+
+def test_streamed_answer_is_the_full_answer_and_is_cached(stub, answer_cache):
+    chunks = list(stream_llm_response(CONTEXT, QUERY))
+    assert len(chunks) > 1
+    answer = "".join(chunks)
+    assert stub.calls == 1
+    # Cached once the stream completed: served whole, without another call
+    assert list(stream_llm_response(CONTEXT, QUERY)) == [answer]
+    assert get_llm_response(CONTEXT, QUERY) == answer
+    assert stub.calls == 1
+
+
+def test_stream_errors_are_yielded_and_not_cached(stub, answer_cache, monkeypatch):
+    def failing(prompt, cached=None):
+        yield "partial"
+        raise RuntimeError("429 quota exceeded")
+    monkeypatch.setattr(stub, "generate_stream", failing)
+    chunks = list(stream_llm_response(CONTEXT, QUERY))
+    assert chunks[0] == "partial" and chunks[-1].lstrip().startswith("Error: Google API quota exceeded")
+    assert answer_cache.get_stats()["stores"] == 0
@@ -0,0 +1,82 @@
+# tests/test_metrics.py
+import asyncio
+import re
+import threading
+
+import pytest
+
+import async_pipeline
+import metrics
+from async_pipeline import QueryService
+from metrics import LatencyHistogram, MetricsRegistry
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = LatencyHistogram(buckets=(0.01, 0.1), window=100)
+    for ms in range(1, 101):
+        histogram.observe(ms / 1000)
+    assert histogram.count == 100
+    assert histogram.bucket_counts == [10, 90, 0]
+    assert histogram.quantiles() == {0.5: 0.051, 0.95: 0.096, 0.99: 0.1}
+    assert LatencyHistogram().quantiles()[0.5] is None
+
+
+def test_prometheus_text_is_cumulative_and_labelled():
+    registry = MetricsRegistry()
+    registry.enabled = True
+    for seconds in (0.0002, 0.003, 0.003, 2.0):
+        registry.observe("parse", seconds)
+    registry.inc("requests", status="answered")
+    registry.inc("requests", 2, status='we"ird')
+    text = registry.prometheus_text()
+    buckets = re.findall(r'mf_rag_stage_latency_seconds_bucket\{stage="parse",le="([^"]+)"\} (\d+)', text)
+    counts = [int(n) for _, n in buckets]
+    assert counts == sorted(counts) and counts[-1] == 4 and buckets[-1][0] == "+Inf"
+    assert 'mf_rag_stage_latency_seconds_count{stage="parse"} 4' in text
+    assert 'mf_rag_requests_total{status="answered"} 1' in text
+    assert 'mf_rag_requests_total{status="we\\"ird"} 2' in text
+
+
+def test_muted_work_is_not_recorded(monkeypatch):
+    registry = MetricsRegistry()
+    registry.enabled = True
+    monkeypatch.setattr(metrics, "registry", registry)
+    with metrics.muted():
+        with metrics.timed("background"):
+            pass
+        metrics.inc("prefetch", result="generated")
+    # A thread started elsewhere is not muted
+    thread = threading.Thread(target=metrics.inc, args=("requests",))
+    thread.start()
+    thread.join()
+    snapshot = metrics.snapshot()
+    assert snapshot["stages"] == {}
+    assert snapshot["counters"] == [{"name": "requests", "labels": {}, "value": 1}]
+
+
+def test_requests_record_stage_latencies(monkeypatch):
+    registry = MetricsRegistry()
+    registry.enabled = True
+    monkeypatch.setattr(metrics, "registry", registry)
+
+    async def fake_llm(context, query):
+        return "answer"
+    monkeypatch.setattr(async_pipeline, "get_llm_response_async", fake_llm)
+    asyncio.run(QueryService().answer_many(["Tell me about FundA Growth", "Find high risk funds"]))
+    stages = metrics.snapshot()["stages"]
+    assert stages["request"]["count"] == 2
+    assert stages["intent_parse"]["count"] == 2
+    assert stages["build_context"]["count"] == 2
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sample"])
+def test_profiled_request_returns_its_reports(monkeypatch, mode):
+    async def fake_llm(context, query):
+        return "answer"
+    monkeypatch.setattr(async_pipeline, "get_llm_response_async", fake_llm)
+    result = asyncio.run(QueryService().answer("Tell me about FundA Growth", profile=mode))
+    stages = [p["stage"] for p in result["profiles"]]
+    assert stages[:2] == ["parse_intent", "build_context"]
+    assert all(p["mode"] == mode and p["report"] for p in result["profiles"])
+    # Unprofiled requests carry no profiles key
+    assert "profiles" not in asyncio.run(QueryService().answer("Tell me about FundA Growth"))
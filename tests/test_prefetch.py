@@ -0,0 +1,83 @@
+# tests/test_prefetch.py
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import async_pipeline
+import llm_handler
+from async_pipeline import QueryService
+
+
+def test_follow_ups_do_not_hold_up_other_requests(monkeypatch):
+    started = threading.Event()
+    started_at = []
+
+    def slow_follow_ups(intent, entities):
+        if intent != "get_fund_details":
+            return []
+        started_at.append(time.perf_counter())
+        started.set()
+        time.sleep(0.5)
+        return ["Tell me about Alpha Management Corp"]
+
+    monkeypatch.setattr(async_pipeline, "prefetch_follow_ups", slow_follow_ups)
+    # Several CPU workers, as on a multi-core host (the default is one per core)
+    monkeypatch.setattr(async_pipeline, "_cpu_executor", ThreadPoolExecutor(max_workers=4))
+
+    async def main():
+        service = QueryService()
+        # Warm the indexes and the classifier so only the follow-ups are slow
+        await service.answer("Find high risk funds")
+        fund_task = asyncio.create_task(service.answer("Tell me about FundA Growth"))
+        while not started.is_set():
+            await asyncio.sleep(0.005)
+        other = await service.answer("Find high risk funds")
+        other_done = time.perf_counter()
+        return await fund_task, other, other_done
+
+    fund, other, other_done = asyncio.run(main())
+    assert fund["follow_ups"] == ["Tell me about Alpha Management Corp"]
+    assert other["status"] == "answered"
+    # The event loop kept serving while the follow-ups were prepared in the CPU pool
+    assert other_done - started_at[0] < 0.4
+
+
+def test_no_follow_ups_after_a_failed_answer(monkeypatch):
+    calls = []
+
+    async def failing_llm(context, query):
+        return "Error: Google API quota exceeded (e.g., requests per minute)."
+
+    monkeypatch.setattr(async_pipeline, "get_llm_response_async", failing_llm)
+    monkeypatch.setattr(async_pipeline, "prefetch_follow_ups", lambda *args: calls.append(args) or ["x"])
+    result = asyncio.run(QueryService().answer("Tell me about FundA Growth"))
+    assert result["follow_ups"] == []
+    assert calls == []
+
+
+class _FailingBackend:
+    model_name = "stub"
+    system_instruction = None
+
+    def generate(self, prompt, cached=None):
+        raise RuntimeError("resource has been exhausted")
+
+
+def test_failed_prefetch_writes_no_cache_entry(monkeypatch, answer_cache):
+    monkeypatch.setattr(llm_handler, "get_answer_cache", lambda: answer_cache)
+    monkeypatch.setattr(llm_handler, "_resolve_backend", lambda: (_FailingBackend(), None))
+    result = llm_handler.prefetch_llm_response("Fund Name: FundA Growth", "Tell me about FundA Growth")
+    assert result == "failed"
+    stats = answer_cache.get_stats()
+    assert stats["stores"] == 0 and stats["prefetch_stores"] == 0
+
+
+def test_prefetched_answer_counts_one_hit(answer_cache):
+    answer_cache.put("key", "answer", prefetched=True)
+    assert answer_cache.contains("key")
+    assert answer_cache.get("key") == "answer"
+    assert answer_cache.get("key") == "answer"
+    stats = answer_cache.get_stats()
+    assert stats["prefetch_stores"] == 1 and stats["prefetch_hits"] == 1
+    assert stats["prefetch_hit_rate"] == 1.0
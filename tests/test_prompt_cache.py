@@ -0,0 +1,119 @@
+# tests/test_prompt_cache.py
+import threading
+import time
+
+from context_builder import build_context
+from llm_client import StubBackend
+from llm_handler import SYSTEM_INSTRUCTION, _join_prompt, build_request
+from prompt_cache import TRACKED_BLOCKS_PER_CONTEXT, PromptCache, StubCacheProvider
+
+
+def _cache(provider=None, **kwargs):
+    settings = dict(ttl_seconds=60, min_tokens=0, hot_uses=3)
+    settings.update(kwargs)
+    return PromptCache(provider or StubCacheProvider(), "instruction", **settings)
+
+
+def test_block_is_cached_once_it_is_hot():
+    cache = _cache()
+    assert [cache.lookup("block") for _ in range(3)] == [None, None, None]
+    assert cache.provider.created == 1
+    handle = cache.lookup("block")
+    assert handle is not None and handle.text == "instruction" + "block"
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 3, 1)
+    assert stats["saved_tokens"] > 0
+
+
+def test_small_blocks_are_never_uploaded():
+    cache = _cache(min_tokens=10_000)
+    for _ in range(5):
+        assert cache.lookup("block") is None
+    assert cache.provider.created == 0
+
+
+def test_expired_entries_are_recreated_and_near_expiry_refreshed():
+    cache = _cache(hot_uses=1)
+    cache.lookup("block")
+    entry = next(iter(cache._entries.values()))
+    # Inside the refresh margin: still a hit, and the provider entry is extended
+    entry.expires_at = time.monotonic() + 1
+    assert cache.lookup("block") is not None
+    assert cache.provider.refreshed == 1
+    # Past expiry: forgotten locally and uploaded again on the next hot use
+    entry.expires_at = time.monotonic() - 1
+    assert cache.lookup("block") is None
+    assert cache.provider.created == 2
+
+
+def test_least_recently_used_entries_are_deleted():
+    cache = _cache(hot_uses=1, max_contexts=2)
+    for block in ("a", "b", "a", "c"):
+        cache.lookup(block)
+    assert cache.provider.deleted == 1
+    assert cache.lookup("a") is not None and cache.lookup("c") is not None
+    assert cache.lookup("b") is None
+
+
+def test_failed_upload_keeps_sending_the_block():
+    class _Rejecting(StubCacheProvider):
+        def create(self, *args):
+            raise ValueError("cached content is too small")
+    cache = _cache(_Rejecting(), hot_uses=1)
+    assert cache.lookup("block") is None
+    assert cache.lookup("block") is None
+    assert cache.get_stats()["errors"] == 2
+
+
+def test_concurrent_requests_upload_a_block_once():
+    class _Slow(StubCacheProvider):
+        def create(self, *args):
+            time.sleep(0.05)
+            return super().create(*args)
+    cache = _cache(_Slow(), hot_uses=1)
+    threads = [threading.Thread(target=cache.lookup, args=("block",)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.provider.created == 1
+
+
+def test_model_sees_the_same_prompt_with_and_without_the_cache(monkeypatch):
+    monkeypatch.setenv("PROMPT_CACHE", "provider")
+    monkeypatch.setenv("PROMPT_CACHE_MIN_TOKENS", "0")
+    backend = StubBackend(system_instruction=SYSTEM_INSTRUCTION)
+    context, query = "Fund: FundA Growth\nRisk: High", "What is its risk?"
+    seen = []
+    for _ in range(5):
+        prompt, cached, _ = build_request(backend, context, query)
+        seen.append((cached is not None, backend._full_prompt(prompt, cached)))
+    assert [hit for hit, _ in seen] == [False, False, False, True, True]
+    assert {full for _, full in seen} == {_join_prompt(context, query)}
+
+
+def test_default_settings_cache_hot_blocks(monkeypatch):
+    monkeypatch.setenv("PROMPT_CACHE", "provider")
+    monkeypatch.delenv("PROMPT_CACHE_MIN_TOKENS", raising=False)
+    backend = StubBackend(system_instruction=SYSTEM_INSTRUCTION)
+    context = build_context("find_funds_by_risk", {"risk_level": "High"})[0]
+    hits = [build_request(backend, context, "Which funds are high risk?")[1] is not None for _ in range(5)]
+    assert hits == [False, False, False, True, True]
+
+
+def test_blocks_below_the_provider_minimum_are_not_tracked(capsys):
+    class _Gemini(StubCacheProvider):
+        min_tokens = 1024
+    cache = PromptCache(_Gemini(), SYSTEM_INSTRUCTION)
+    # The default 500-token context budget can never reach Gemini's minimum
+    assert "raise CONTEXT_TOKEN_BUDGET" in capsys.readouterr().out
+    for i in range(100):
+        assert cache.lookup(f"context {i}") is None
+    assert cache.provider.created == 0 and not cache._uses
+
+
+def test_use_counts_are_bounded():
+    cache = _cache(hot_uses=10, max_contexts=2)
+    for i in range(1000):
+        cache.lookup(f"block {i}")
+    assert len(cache._uses) == 2 * TRACKED_BLOCKS_PER_CONTEXT
@@ -0,0 +1,78 @@
+# tests/test_query_planner.py
+import itertools
+
+import pytest
+
+import data_loader
+import graph_query
+from data_loader import DataStore
+from intent_parser import parse_intent
+from query_planner import execute_constraints
+from synthetic_kb import generate_knowledge_base
+
+
+@pytest.fixture(scope="module")
+def synthetic_tables():
+    return generate_knowledge_base(n_funds=600, n_sectors=10, n_factors=12, seed=5)
+
+
+@pytest.fixture
+def synthetic_kb(synthetic_tables):
+    previous = data_loader.get_store()
+    data_loader.set_store(DataStore.from_frames(synthetic_tables))
+    yield synthetic_tables
+    data_loader.set_store(previous)
+
+
+def _fund_ids(kind, value):
+    """The funds one constraint selects, from the single-constraint graph queries."""
+    funds = {"risk": graph_query.find_funds_by_risk, "sector": graph_query.find_funds_by_sector,
+             "amc": graph_query.find_funds_by_amc, "factor": graph_query.find_funds_related_to_factor}[kind](value)
+    return {f["fund_id"] for f in funds}
+
+
+def test_constraints_match_set_algebra_over_single_queries(synthetic_kb):
+    candidates = [("risk", "High"), ("risk", "Low"),
+                  ("sector", synthetic_kb["sectors"]["sector_id"].iloc[0]),
+                  ("sector", synthetic_kb["sectors"]["sector_id"].iloc[3]),
+                  ("amc", synthetic_kb["amcs"]["amc_id"].iloc[1]),
+                  ("factor", synthetic_kb["factors"]["factor_id"].iloc[2])]
+    fund_ids = synthetic_kb["funds"]["fund_id"].tolist()
+    for n in (2, 3):
+        for constraints in itertools.combinations(candidates, n):
+            expected = None
+            for kind in {kind for kind, _ in constraints}:
+                union = set().union(*(_fund_ids(k, v) for k, v in constraints if k == kind))
+                expected = union if expected is None else expected & union
+            positions, steps = execute_constraints(list(constraints))
+            assert [fund_ids[p] for p in positions] == [i for i in fund_ids if i in expected], constraints
+            # Smallest group first, and the loop stops once nothing is left
+            assert [s.size for s in steps] == sorted(s.size for s in steps)
+            assert all(s.result_size > 0 for s in steps[:-1])
+
+
+def test_factor_constraints_rank_by_exposure(synthetic_kb):
+    factor_id = synthetic_kb["factors"]["factor_id"].iloc[0]
+    funds, _ = graph_query.find_funds_by_constraints([("risk", "High"), ("factor", factor_id)])
+    scores = [f["exposure_score"] for f in funds]
+    assert funds and scores == sorted(scores, reverse=True)
+
+
+@pytest.mark.parametrize("query, constraints", [
+    ("High risk funds in Energy managed by Alpha Management Corp",
+     (("sector", "Energy"), ("amc", "AMC_X"), ("risk", "High"))),
+    ("Funds in Technology or Finance affected by Interest Rates",
+     (("sector", "Technology"), ("sector", "Finance"), ("factor", "Interest Rates"))),
+])
+def test_compound_queries_are_parsed(query, constraints):
+    intent, entities = parse_intent(query)
+    assert intent == "find_funds_compound"
+    assert set(entities["constraints"]) == set(constraints)
+
+
+def test_single_constraint_and_incidental_words_are_not_compound():
+    # "low" inside "follow" and "high" without "risk" are not risk constraints
+    assert parse_intent("Which funds follow Energy?")[0] == "find_funds_by_sector"
+    assert parse_intent("High growth funds in Energy")[0] == "find_funds_by_sector"
+    # A named fund is a details question even with other entities in it
+    assert parse_intent("Tell me about FundD Energy Focus")[0] == "get_fund_details"
@@ -0,0 +1,48 @@
+# tests/test_semantic_index.py
+import numpy as np
+import pytest
+
+from intent_parser import parse_intent
+from semantic_index import HashingEmbedder, SemanticDoc, SemanticIndex
+
+
+@pytest.mark.parametrize("query, intent, field, entity_id", [
+    ("funds hurt by rising oil", "find_funds_by_factor", "factor_id", "Crude Oil Price"),
+    ("which funds benefit from semiconductors supply", "find_funds_by_factor", "factor_id", "Chip Shortage"),
+    ("tell me about banks and insurance", "get_sector_details", "sector_id", "Finance"),
+    ("public expenditure on roads", "get_factor_details", "factor_id", "Government Spending"),
+])
+def test_descriptions_resolve_queries_without_a_name(query, intent, field, entity_id):
+    parsed_intent, entities = parse_intent(query)
+    assert (parsed_intent, entities[field]) == (intent, entity_id)
+    assert entities["semantic_score"] > 0
+
+
+def test_unrelated_query_stays_unknown():
+    assert parse_intent("xyzzy plugh") == ("unknown", {})
+
+
+class _CountingEmbedder(HashingEmbedder):
+    def __init__(self):
+        super().__init__(dim=256)
+        self.embedded = []
+
+    def embed(self, texts):
+        self.embedded.extend(texts)
+        return super().embed(texts)
+
+
+def test_restart_only_embeds_changed_documents(tmp_path):
+    path = str(tmp_path / "semantic_index.npz")
+    docs = [SemanticDoc("sector", "Energy", "Energy", "Oil and gas producers"),
+            SemanticDoc("sector", "Finance", "Finance", "Banks and insurers"),
+            SemanticDoc("factor", "Inflation", "Inflation", "Rising prices")]
+    first = SemanticIndex.build(docs, _CountingEmbedder(), path)
+
+    docs[1] = docs[1]._replace(text="Banks, insurers and brokers")
+    embedder = _CountingEmbedder()
+    second = SemanticIndex.build(docs, embedder, path)
+    assert embedder.embedded == ["Banks, insurers and brokers"]
+    assert np.array_equal(second.vectors[[0, 2]], first.vectors[[0, 2]])
+    assert np.allclose(second.vectors[1], HashingEmbedder(dim=256).embed(["Banks, insurers and brokers"])[0])
+    assert second.search("insurance brokers", top_k=1)[0].entity_id == "Finance"
@@ -0,0 +1,97 @@
+# tests/test_shared_kb.py
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import data_loader
+import graph_query
+import shared_kb
+from data_loader import DataStore
+
+
+@pytest.fixture
+def kb_dir(tmp_path, monkeypatch):
+    """A private copy of the sample CSVs with its own shared-memory directory."""
+    data_dir = tmp_path / "kb"
+    data_dir.mkdir()
+    for filename in data_loader.TABLE_FILES.values():
+        shutil.copy(os.path.join(data_loader.default_data_dir(), filename), data_dir / filename)
+    monkeypatch.setenv("KB_SHARED_DIR", str(tmp_path / "shared"))
+    previous = data_loader.get_store()
+    yield str(data_dir)
+    data_loader.set_store(previous)
+
+
+def _rename_fund(data_dir, old, new):
+    path = os.path.join(data_dir, data_loader.TABLE_FILES["funds"])
+    with open(path) as f:
+        text = f.read()
+    with open(path, "w") as f:
+        f.write(text.replace(f",{old},", f",{new},"))
+
+
+def _answers():
+    return (graph_query.get_fund_details("FundA_Growth"),
+            graph_query.find_funds_by_amc("AMC_X"),
+            graph_query.find_funds_by_sector("Energy"),
+            graph_query.find_funds_related_to_factor("Crude Oil Price"),
+            graph_query.get_factor_details("Interest Rates"))
+
+
+def test_nothing_to_attach_until_published(kb_dir):
+    assert shared_kb.current_version(kb_dir) == 0
+    assert shared_kb.attach(kb_dir) is None
+
+
+def test_attached_store_answers_like_a_private_one(kb_dir):
+    data_loader.set_store(DataStore(kb_dir, use_snapshot=False))
+    private = _answers()
+
+    assert shared_kb.publish(kb_dir) == 1
+    store = shared_kb.attach(kb_dir)
+    assert store.version == 1 and store.shared is not None
+    # The indexes come from the map instead of being built in this process
+    for name in shared_kb.SHARED_STRUCTURES:
+        assert store.derived(name, None) is not None
+    data_loader.set_store(store)
+    assert _answers() == private
+
+
+def test_publish_is_skipped_when_someone_else_already_republished(kb_dir):
+    assert shared_kb.publish(kb_dir) == 1
+    assert shared_kb.publish(kb_dir, replaces=1) == 2
+    # A second process that also saw version 1 does not publish version 3
+    assert shared_kb.publish(kb_dir, replaces=1) == 2
+    assert shared_kb.current_version(kb_dir) == 2
+
+
+def test_attached_store_follows_version_bumps(kb_dir):
+    shared_kb.publish(kb_dir)
+    store = shared_kb.attach(kb_dir)
+    data_loader.set_store(store)
+    # Nothing new published: the store stays
+    assert data_loader.refresh_if_changed(settle_seconds=0) == []
+    # A per-process structure over a table that will not change is carried over
+    marker = store.derived("amc_marker", lambda s: object(), depends_on=["amcs"])
+
+    _rename_fund(kb_dir, "FundA Growth", "FundA Growth Plus")
+    assert shared_kb.publish(kb_dir, replaces=1) == 2
+    assert data_loader.refresh_if_changed(settle_seconds=0) == ["funds"]
+    new_store = data_loader.get_store()
+    assert new_store is not store and new_store.version == 2
+    assert graph_query.get_fund_details("FundA_Growth")["name"] == "FundA Growth Plus"
+    assert new_store.derived("amc_marker", None) is marker
+
+
+def test_answer_cache_is_invalidated_by_a_shared_version_bump(kb_dir, answer_cache):
+    shared_kb.publish(kb_dir)
+    data_loader.set_store(shared_kb.attach(kb_dir))
+    answer_cache.put("key", "answer")
+    _rename_fund(kb_dir, "FundA Growth", "FundA Growth Plus")
+    shared_kb.publish(kb_dir, replaces=1)
+    assert answer_cache.get("key") == "answer"
+    data_loader.refresh_if_changed(settle_seconds=0)
+    assert answer_cache.get("key") is None